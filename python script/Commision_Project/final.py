@@ -1,10 +1,51 @@
-import pandas as pd
 import os
 import glob
+import csv
 import datetime
-import xlsxwriter
-from xlsxwriter.utility import xl_rowcol_to_cell, xl_col_to_name
+import hashlib
+import importlib
+import importlib.util
+import json
+import pickle
 import re
+import shutil
+import sqlite3
+import sys
+import time
+import uuid
+import zipfile
+
+# ==============================================================================
+# LAZY IMPORTS
+# ==============================================================================
+# pandas/numpy/xlsxwriter/openpyxl take most of a cold start; they load the first
+# time a stage touches them, so the CLI prompts (and plain imports) stay fast.
+
+class _LazyModule:
+    """Stands in for a module until first use, then rebinds the global to the real module"""
+    def __init__(self, alias, name):
+        self._alias = alias
+        self._name = name
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+def _lazy_function(module_name, func_name):
+    """Stands in for a library function until first call, then rebinds the global to it"""
+    def load_and_call(*args, **kwargs):
+        func = getattr(importlib.import_module(module_name), func_name)
+        globals()[func_name] = func
+        return func(*args, **kwargs)
+    return load_and_call
+
+pd = _LazyModule('pd', 'pandas')
+np = _LazyModule('np', 'numpy')
+xlsxwriter = _LazyModule('xlsxwriter', 'xlsxwriter')
+openpyxl = _LazyModule('openpyxl', 'openpyxl')
+xl_rowcol_to_cell = _lazy_function('xlsxwriter.utility', 'xl_rowcol_to_cell')
+xl_col_to_name = _lazy_function('xlsxwriter.utility', 'xl_col_to_name')
 
 # ==============================================================================
 # CONFIGURATION
@@ -12,8 +53,26 @@ import re
 INPUT_FOLDER = 'Input_Raw'
 OUTPUT_FOLDER = 'Output'
 
-os.makedirs(INPUT_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+# Rows of each sheet searched for the report header (title/preamble rows sit above it)
+HEADER_SCAN_ROWS = 30
+
+# Header text of the employee ID column, most specific first ('SSN' itself always wins);
+# only IDs from an SSN column are reformatted as SSNs
+SSN_COLUMN_PATTERNS = ['ssn', 'social security', 'tax id']
+ID_COLUMN_PATTERNS = SSN_COLUMN_PATTERNS + ['employee id', 'emp id']
+
+# Deduction codes read from the payroll reports: code -> keywords its column header contains.
+# The primary code drives the report; the others are loaded in the same pass and, when a
+# run asks for them (config['deduction_codes']), commissioned with the same plan
+# thresholds and rate tables, per code and in total.
+DEDUCTION_CODES = {
+    'PPC125': ['ppc', '125'],
+    'PPCREWARD': ['ppcreward'],
+}
+PRIMARY_DEDUCTION_CODE = 'PPC125'
+
+# Optional agent -> SSN / company code table used to credit each agent with their own book
+ASSIGNMENTS_FILE = 'Agent_Assignments.csv'
 
 # Group Types
 GROUP_TYPE_HARRY = "Harry's Group"
@@ -21,6 +80,9 @@ GROUP_TYPE_ADAM = "Adam's Group"
 GROUP_TYPE_OTHER = "Other Groups"
 GROUP_TYPE_DYNAMIC = "Dynamic Group"
 
+# Report sections that can be written on their own (Harry's/Adam's Group reports)
+SHEET_SECTIONS = ['dates', 'unpaid', 'commissions', 'totals', 'downline', 'codes', 'enrollment', 'clawbacks']
+
 # Dynamic Groups Storage
 DYNAMIC_GROUPS = {}
 
@@ -32,6 +94,18 @@ PLAN_MAP = {
     1000: {'Weekly': 230.77, 'BiWeekly': 461.54, 'SemiMonthly': 500, 'Monthly': 1000}
 }
 
+# Minimum deduction per frequency for each plan level (highest plan first).
+# Mirrors the "Plan" column formulas written into the Commissions/Unpaid tabs.
+PLAN_THRESHOLDS = {
+    'Weekly': [(360, 1600), (315, 1400), (270, 1200), (220, 1000)],
+    'BiWeekly': [(720, 1600), (630, 1400), (540, 1200), (450, 1000)],
+    'SemiMonthly': [(780, 1600), (680, 1400), (580, 1200), (480, 1000)],
+    'Monthly': [(1550, 1600), (1350, 1400), (1150, 1200), (950, 1000)]
+}
+
+# Pay periods per year for each frequency (deduction * periods / 12 = monthly plan value)
+FREQUENCY_PERIODS = {'Weekly': 52, 'BiWeekly': 26, 'SemiMonthly': 24, 'Monthly': 12}
+
 # ==============================================================================
 # SYSTEM 1: HARRY'S GROUP - CLIENT-BASED RATES
 # ==============================================================================
@@ -64,6 +138,16 @@ HARRY_DOWNLINE_RATES = {
     }
 }
 
+# Harry's Group main agents - monthly commission per plan (divided by pay frequency per week)
+HARRY_MAIN_AGENT_RATES = {
+    'Charles': {1600: 15, 1400: 10, 1200: 5, 1000: 1.5},
+    'Harry': {1600: 97, 1400: 78, 1200: 60, 1000: 25},
+    'LightHouse': {1600: 25, 1400: 20, 1200: 15, 1000: 2}
+}
+
+# Sub-heading shown above PLAN COUNTING (falls back to the detected frequency)
+PLAN_COUNT_LABELS = {2: 'BiWeekly', 3: 'BiWeekly', 4: 'Weekly'}
+
 # Confidence special multipliers based on number of weeks
 CONFIDENCE_MULTIPLIERS = {
     2: {'1000': 5, 'other': 15},
@@ -174,6 +258,222 @@ def get_rate_for_plan(rates, plan):
     # Fallback
     return rates.get('1000', 0)
 
+def plan_counting_formulas(plan_cols, last_data_row):
+    """
+    Excel PLAN COUNTING formulas over the Plan columns of any number of weeks
+    
+    Returns: (plan_1000_formula, other_plans_formula)
+    """
+    ranges = [f"{xl_col_to_name(c)}3:{xl_col_to_name(c)}{last_data_row}" for c in plan_cols]
+    
+    any_1000 = '+'.join(f'ISNUMBER(SEARCH("Plan 1000",{r}))' for r in ranges)
+    week_is_other = [
+        '--((' + '+'.join(f'ISNUMBER(SEARCH("Plan {plan}",{r}))' for plan in (1200, 1400, 1600)) + ')>0)'
+        for r in ranges
+    ]
+    
+    plan_1000_formula = f'=SUMPRODUCT(--(({any_1000})>0))'
+    other_plans_formula = f'=SUMPRODUCT(--(({any_1000})=0),{",".join(week_is_other)})'
+    return plan_1000_formula, other_plans_formula
+
+def plan_level_formula(ppc_cell, freq_name):
+    """Excel "Plan" column formula for one PPC125 cell, using that week's frequency thresholds"""
+    formula = '""'
+    for minimum, plan in reversed(PLAN_THRESHOLDS.get(freq_name, PLAN_THRESHOLDS['Monthly'])):
+        formula = f'IF(ABS({ppc_cell})>={minimum},"Plan {plan}",{formula})'
+    return f'={formula}'
+
+def ppc_lookup_formula(ssn_cell, tab_date, reversals=False, client=None):
+    """
+    Excel formula fetching an SSN's deduction from a date tab; when the tab
+    holds reversals (booked positive there), they count as no deduction.
+    With client, the tab is a shared (consolidated) one and the row must also
+    match its Client column, since one SSN can be on several clients' payrolls.
+    """
+    if client is None:
+        lookup = f"VLOOKUP({ssn_cell},'{tab_date}'!A:B,2,FALSE)"
+    else:
+        client_text = client.replace('"', '""')
+        lookup = f"SUMIFS('{tab_date}'!B:B,'{tab_date}'!A:A,{ssn_cell},'{tab_date}'!D:D,\"{client_text}\")"
+    if reversals:
+        lookup = f"MIN({lookup},0)"
+    return f"=IFERROR({lookup},0)"
+
+def plan_rate_formula(plan_cell, rates, freq_val):
+    """Excel formula paying rates[plan]*12/freq_val for the plan shown in plan_cell"""
+    formula = '0'
+    for plan in (1000, 1200, 1400, 1600):
+        formula = f'IF({plan_cell}="Plan {plan}",{rates[plan]}*12/{freq_val},{formula})'
+    return '=' + formula
+
+# ==============================================================================
+# SHARED CELL FORMATS
+# ==============================================================================
+
+# One definition per cell style, reused by every builder and every workbook
+CELL_STYLES = {
+    'header': {'bold': True, 'bg_color': '#D9E1F2', 'border': 1, 'align': 'center', 'valign': 'vcenter'},
+    'currency': {'num_format': '$#,##0.00'},
+    'text': {'num_format': '@'},
+    'date': {'num_format': 'mm/dd/yyyy'},
+    'date_header': {'bold': True, 'bg_color': '#4472C4', 'font_color': '#FFFFFF', 'border': 1, 'align': 'center'},
+    'charles': {'num_format': '$#,##0.00', 'bg_color': '#D9E1F2'},
+    'harry': {'num_format': '$#,##0.00', 'bg_color': '#E2EFDA'},
+    'lighthouse': {'num_format': '$#,##0.00', 'bg_color': '#FCE4D6'},
+    'total_header': {'bold': True, 'bg_color': '#000000', 'font_color': '#FFFFFF', 'align': 'center', 'border': 1},
+    'total_value': {'num_format': '$#,##0.00', 'bold': True, 'bg_color': '#FFFF00', 'border': 1, 'align': 'center', 'font_size': 12},
+    'weekly_total': {'num_format': '$#,##0.00', 'bold': True, 'bg_color': '#FFE699', 'border': 1, 'top': 2},
+    'agent_weekly_total': {'bold': True, 'bg_color': '#FFE699', 'border': 1},
+    'plan_count_header': {'bold': True, 'bg_color': '#FFF2CC', 'border': 1, 'align': 'center', 'font_size': 11},
+    'plan_count_value': {'bold': True, 'bg_color': '#FFF2CC', 'border': 1, 'align': 'center', 'font_size': 11},
+    'downline_header': {'bold': True, 'bg_color': '#C6E0B4', 'border': 1, 'align': 'center', 'font_size': 12},
+    'downline_client': {'bold': True, 'bg_color': '#E2EFDA', 'border': 1, 'align': 'left'},
+    'downline_agent': {'bg_color': '#F4F7F0', 'border': 1, 'align': 'left', 'indent': 1},
+    'downline_commission': {'num_format': '$#,##0.00', 'bg_color': '#E2EFDA', 'border': 1},
+    'agent_header': {'bold': True, 'bg_color': '#C6E0B4', 'border': 1, 'align': 'center', 'font_size': 11},
+    'client_header': {'bold': True, 'bg_color': '#FFD966', 'border': 1, 'align': 'center', 'font_size': 11},
+    'breakdown_row': {'indent': 1, 'border': 1}
+}
+
+# Fill colors cycled through for dynamic-group main agents
+AGENT_COLORS = ['#D9E1F2', '#E2EFDA', '#FCE4D6', '#F4B084', '#C5E0B4', '#FFE699']
+
+# Frozen lookup keys, computed once per style for the whole run
+_STYLE_KEYS = {name: tuple(sorted(props.items())) for name, props in CELL_STYLES.items()}
+
+def get_format(workbook, style):
+    """
+    Return the workbook Format for a style name (see CELL_STYLES) or a style dict
+    
+    Identical style dicts map to a single Format per workbook, so builders can
+    ask for a format wherever they need it without growing the style table.
+    """
+    if isinstance(style, str):
+        key = _STYLE_KEYS[style]
+        props = CELL_STYLES[style]
+    else:
+        key = tuple(sorted(style.items()))
+        props = style
+    
+    cache = getattr(workbook, '_format_registry', None)
+    if cache is None:
+        cache = workbook._format_registry = {}
+    
+    if key not in cache:
+        cache[key] = workbook.add_format(dict(props))
+    return cache[key]
+
+# ==============================================================================
+# OUTPUT FILES - TEMP FILE, FSYNC, ATOMIC RENAME
+# ==============================================================================
+
+# How a finished report is named when the target already exists:
+#   overwrite - replace it (an open/locked workbook falls back to 'versioned')
+#   versioned - keep it and write name_v2.xlsx, name_v3.xlsx, ...
+#   hashed    - name_<content hash>.xlsx, so identical reports share one file
+OUTPUT_NAMING_MODES = ['overwrite', 'versioned', 'hashed']
+
+class OutputLockedError(RuntimeError):
+    """The target workbook is open in Excel/LibreOffice (a lock file sits next to it)"""
+
+def output_lock_files(path):
+    """Excel (~$name) and LibreOffice (.~lock.name#) lock files present for an output path"""
+    folder, name = os.path.split(path)
+    candidates = [os.path.join(folder, f"~${name}"), os.path.join(folder, f".~lock.{name}#")]
+    return [lock for lock in candidates if os.path.exists(lock)]
+
+def start_output(filename, naming=None, folder=None):
+    """
+    Reserve a hidden temp file next to the report's final location
+    
+    Lock files are checked here, before anything is built: a workbook that is
+    open elsewhere switches 'overwrite' to 'versioned' instead of failing at
+    the final rename.
+    Returns: {'target': final path, 'temp': path to write to, 'naming': mode}
+    """
+    folder = folder or OUTPUT_FOLDER
+    naming = naming or 'overwrite'
+    if naming not in OUTPUT_NAMING_MODES:
+        raise ValueError(f"unknown naming mode '{naming}' (choose from {', '.join(OUTPUT_NAMING_MODES)})")
+    os.makedirs(folder, exist_ok=True)
+    
+    target = os.path.join(folder, filename)
+    if naming == 'overwrite' and output_lock_files(target):
+        print(f"⚠️ {filename} is open in another program; writing a new version next to it")
+        naming = 'versioned'
+    temp = os.path.join(folder, f".{filename}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    return {'target': target, 'temp': temp, 'naming': naming}
+
+def output_digest(path):
+    """SHA-256 of a file's content; for xlsx/zip files only the parts, not the timestamped properties"""
+    digest = hashlib.sha256()
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if not name.startswith('docProps/'):
+                    digest.update(name.encode())
+                    digest.update(archive.read(name))
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def place_output_file(source, target, naming='overwrite'):
+    """
+    Move a finished file to its final name in one atomic step
+    
+    'versioned' never replaces an existing file (hard link + unlink, falling
+    back to an existence check where links aren't supported); 'overwrite'
+    falls back to 'versioned' if the target can't be replaced (open on Windows).
+    Returns: the final path
+    """
+    stem, ext = os.path.splitext(target)
+    if naming == 'hashed':
+        target = f"{stem}_{output_digest(source)[:12]}{ext}"
+    
+    if naming != 'versioned':
+        try:
+            os.replace(source, target)
+            return target
+        except PermissionError:
+            print(f"⚠️ {os.path.basename(target)} is in use; writing a new version next to it")
+    
+    version = 1
+    candidate = target
+    while True:
+        try:
+            os.link(source, candidate)
+            os.unlink(source)
+            return candidate
+        except FileExistsError:
+            pass
+        except (OSError, AttributeError):
+            if not os.path.exists(candidate):
+                os.replace(source, candidate)
+                return candidate
+        version += 1
+        candidate = f"{stem}_v{version}{ext}"
+
+def finish_output(output):
+    """Flush the temp file to disk and rename it into place; returns the final path"""
+    with open(output['temp'], 'r+b') as f:
+        os.fsync(f.fileno())
+    path = place_output_file(output['temp'], output['target'], output['naming'])
+    
+    # Persist the rename itself (directories can't be opened on Windows)
+    try:
+        dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        return path
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+    return path
+
 # ==============================================================================
 # 1. LOGIC ENGINE - FILE PROCESSING
 # ==============================================================================
@@ -216,6 +516,12 @@ def get_frequency_from_deduction(deduction):
         
     return None, "Unknown"
 
+def frequency_label(packets):
+    """Console label for a batch's frequency, listing each cadence when files are mixed"""
+    cadences = list(dict.fromkeys((p['freq_name'], p['freq'] if p['freq'] else 52) for p in packets))
+    label = ', '.join(f"{name} (÷{freq})" for name, freq in cadences)
+    return label if len(cadences) == 1 else f"Mixed - {label}"
+
 def detect_plan_from_amount(amount, freq_name):
     """Detect plan level from deduction amount"""
     if amount == 0:
@@ -230,39 +536,209 @@ def detect_plan_from_amount(amount, freq_name):
     
     return 'PPC1000'  # Default fallback
 
-def process_raw_files():
-    """Process all CSV/Excel files from Input_Raw folder"""
-    files = glob.glob(os.path.join(INPUT_FOLDER, '*.*'))
+def canonicalize_ssns(ids, ssn_format=True):
+    """
+    One text form per employee ID so the same SSN matches across files
+    
+    '123-45-6789', '123456789', ' 123 45 6789 ' and a float-coerced '123456789.0'
+    all become '123-45-6789'; numeric SSNs that lost leading zeros to Excel
+    (7-8 digits) are padded back to 9. Other IDs, and every ID when ssn_format
+    is off (the column is not an SSN column, see is_ssn_column), are only stripped.
+    """
+    ids = ids.astype(str).str.strip()
+    if not ssn_format:
+        return ids
+    digits = ids.str.replace(r'\.0+$', '', regex=True).str.replace(r'[\s\-]', '', regex=True)
+    is_ssn = digits.str.fullmatch(r'\d{7,9}')
+    padded = digits[is_ssn].str.zfill(9)
+    return ids.mask(is_ssn, padded.str[:3] + '-' + padded.str[3:5] + '-' + padded.str[5:])
+
+def intern_ssns(packets):
+    """
+    Map every packet's (canonical) IDs to integer keys into one shared sorted table
+    
+    Adds p['ssn_keys'] (key per row of p['df']) and p['ssn_table'] (the same
+    array of SSNs for every packet), so later stages index arrays by key
+    instead of re-matching strings.
+    """
+    if not packets:
+        return packets
+    ids = pd.concat([p['df'][p['id_col']] for p in packets], ignore_index=True)
+    keys, table = pd.factorize(ids, sort=True)
+    table = np.asarray(table, dtype=object)
+    start = 0
+    for p in packets:
+        end = start + len(p['df'])
+        p['ssn_keys'] = keys[start:end].astype(np.int32)
+        p['ssn_table'] = table
+        start = end
+    return packets
+
+def match_deduction_code(name):
+    """DEDUCTION_CODES code whose keywords all appear in a column header, or None"""
+    lowered = name.lower()
+    return next((code for code, keywords in DEDUCTION_CODES.items() if all(k in lowered for k in keywords)), None)
+
+def find_deduction_columns(columns):
+    """{code: column} for every registered deduction code present (first matching column per code)"""
+    found = {}
+    for column in columns:
+        code = match_deduction_code(column)
+        if code and code not in found:
+            found[code] = column
+    return found
+
+def is_ssn_column(column):
+    """True when an ID column header names an SSN (rather than e.g. an employee number)"""
+    return any(pattern in str(column).lower() for pattern in SSN_COLUMN_PATTERNS)
+
+def find_id_column(columns):
+    """The employee ID column of a report header, or None"""
+    if 'SSN' in columns:
+        return 'SSN'
+    for pattern in ID_COLUMN_PATTERNS:
+        match = next((c for c in columns if pattern in c.lower()), None)
+        if match:
+            return match
+    return None
+
+def read_preview(filepath, num_rows=None):
+    """
+    First num_rows rows of every sheet, without loading the whole file
+    
+    .xlsx goes through openpyxl in read-only mode (rows stream off the zip);
+    CSV through the csv module. Returns: {sheet name: [row values]}, a single
+    None sheet for CSV.
+    """
+    num_rows = num_rows or HEADER_SCAN_ROWS
+    if filepath.endswith('.csv'):
+        with open(filepath, newline='', encoding='utf-8-sig', errors='replace') as f:
+            reader = csv.reader(f)
+            return {None: [row for row, _ in zip(reader, range(num_rows))]}
+    if filepath.endswith('.xlsx'):
+        workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+        try:
+            return {ws.title: list(ws.iter_rows(max_row=num_rows, values_only=True)) for ws in workbook.worksheets}
+        finally:
+            workbook.close()
+    sheets = pd.read_excel(filepath, sheet_name=None, header=None, nrows=num_rows, dtype=str)
+    return {name: df.values.tolist() for name, df in sheets.items()}
+
+def header_score(row):
+    """PPC125/SSN/date signature of a candidate header row: 0 without a PPC125 column"""
+    cells = [c.strip() for c in row if isinstance(c, str) and c.strip()]
+    if PRIMARY_DEDUCTION_CODE not in find_deduction_columns(cells):
+        return 0
+    score = 2
+    if find_id_column(cells):
+        score += 2
+    if any('date' in c.lower() for c in cells):
+        score += 1
+    return score
+
+def locate_header(preview):
+    """
+    The sheet and row of the report header in a read_preview() result
+    
+    The row with the best signature wins (ties go to the first sheet/row), so
+    title rows above the header are skipped and a multi-sheet workbook is read
+    from the sheet that actually holds the confirmation data.
+    Returns: (sheet name or None, header row index), or None when no row has a PPC125 column
+    """
+    best = None
+    for sheet, rows in preview.items():
+        for row_idx, row in enumerate(rows):
+            score = header_score(row)
+            if score and (best is None or score > best[0]):
+                best = (score, sheet, row_idx)
+    return best[1:] if best else None
+
+def aggregate_duplicate_ssns(df, id_col, ded_col, freq_name, other_ded_cols=()):
+    """
+    Collapse multiple rows for the same SSN (corrections, split checks) into one
+    
+    Deductions (ded_col and any other_ded_cols) are summed per SSN; every other
+    column keeps its first value.
+    A duplicate is flagged as a conflict when more than one row carried a
+    deduction and the combined amount no longer matches a known plan amount.
+    
+    id_col must already be canonical (see canonicalize_ssns).
+    Returns: (aggregated_df, duplicates_df)
+    """
+    if not df[id_col].duplicated().any():
+        return df, pd.DataFrame(columns=['ssn', 'rows', 'amount', 'conflict'])
+    
+    grouped = df.groupby(id_col, sort=False)
+    stats = pd.DataFrame({
+        'rows': grouped.size(),
+        'nonzero_rows': (df[ded_col] != 0).groupby(df[id_col], sort=False).sum(),
+        'amount': grouped[ded_col].sum()
+    })
+    
+    sum_cols = [ded_col, *other_ded_cols]
+    other_cols = [c for c in df.columns if c != id_col and c not in sum_cols]
+    aggregated = grouped[other_cols].first() if other_cols else pd.DataFrame(index=stats.index)
+    aggregated[sum_cols] = grouped[sum_cols].sum()
+    aggregated = aggregated.reset_index()[list(df.columns)]
+    
+    duplicates = stats[stats['rows'] > 1].copy()
+    plan_amounts = np.array([freq_rates[freq_name] for freq_rates in PLAN_MAP.values()])
+    matches_plan = (np.abs(np.abs(duplicates['amount'].to_numpy())[:, None] - plan_amounts) < 1.0).any(axis=1)
+    duplicates['conflict'] = (duplicates['nonzero_rows'].to_numpy() > 1) & ~matches_plan
+    duplicates = duplicates.reset_index().rename(columns={id_col: 'ssn'})
+    
+    return aggregated, duplicates[['ssn', 'rows', 'amount', 'conflict']]
+
+def process_raw_files(input_folder=None):
+    """Process all CSV/Excel files from Input_Raw folder (or the given folder)"""
+    input_folder = input_folder or INPUT_FOLDER
+    files = glob.glob(os.path.join(input_folder, '*.*'))
     valid_files = [f for f in files if f.endswith(('.csv', '.xlsx', '.xls'))]
     
     if not valid_files:
-        print("⚠️ No files in Input_Raw!")
+        print(f"⚠️ No files in {input_folder}!")
         return []
 
     processed = []
     
     for filepath in valid_files:
+        # Find the header from a few rows, then read the matching sheet from the header down
         try:
+            preview = read_preview(filepath)
+            if 'Commissions' in preview:
+                print(f"⚠️ Skipping {filepath}: commission workbook, not a payroll report (use it as a reconciliation reference)")
+                continue
+            header = locate_header(preview)
+            if header is None:
+                print(f"⚠️ Skipping {filepath}: No PPC125 column found")
+                continue
+            sheet, header_row = header
             if filepath.endswith('.csv'):
-                df = pd.read_csv(filepath, dtype=str)
+                df = pd.read_csv(filepath, dtype=str, skiprows=header_row)
             else:
-                df = pd.read_excel(filepath, dtype=str)
+                df = pd.read_excel(filepath, sheet_name=sheet, header=header_row, dtype=str)
         except Exception as e:
             print(f"❌ Skipping {filepath}: {e}")
             continue
             
-        df.columns = df.columns.str.strip()
+        df.columns = df.columns.astype(str).str.strip()
         
         # Find required columns
-        ded_col = next((c for c in df.columns if 'ppc' in c.lower() and '125' in c.lower()), None)
+        ded_cols = find_deduction_columns(df.columns)
+        ded_col = ded_cols.get(PRIMARY_DEDUCTION_CODE)
         date_col = next((c for c in df.columns if 'date' in c.lower()), None)
-        id_col = 'SSN' if 'SSN' in df.columns else df.columns[0]
+        id_col = find_id_column(df.columns)
+        company_col = next((c for c in df.columns if 'company' in c.lower() and 'code' in c.lower()), None)
         
         if not ded_col:
             print(f"⚠️ Skipping {filepath}: No PPC125 column found")
             continue
+        if id_col is None:
+            id_col = df.columns[0]
+            print(f"⚠️ {os.path.basename(filepath)}: no SSN column found, using '{id_col}' as the employee ID")
 
-        df = df.dropna(subset=[id_col])
+        df = df.dropna(subset=[id_col]).copy()
+        df[id_col] = canonicalize_ssns(df[id_col], ssn_format=is_ssn_column(id_col))
         
         # Extract date
         check_date = None
@@ -276,9 +752,10 @@ def process_raw_files():
             check_date = datetime.datetime.now()
             print(f"⚠️ No date found for {filepath}, using current date")
         
-        # Clean deduction column
-        df[ded_col] = df[ded_col].astype(str).str.replace('$', '', regex=False).str.replace(',', '', regex=False)
-        df[ded_col] = pd.to_numeric(df[ded_col], errors='coerce').fillna(0)
+        # Clean every deduction column in one pass
+        for col in ded_cols.values():
+            df[col] = df[col].astype(str).str.replace('$', '', regex=False).str.replace(',', '', regex=False)
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
         
         # Determine frequency
         freq = 52
@@ -291,20 +768,657 @@ def process_raw_files():
                 freq, freq_name = f, n
                 break
         
+        # Combine duplicate SSN rows so each employee has one deduction per pay date
+        other_ded_cols = [col for code, col in ded_cols.items() if code != PRIMARY_DEDUCTION_CODE]
+        df, duplicates = aggregate_duplicate_ssns(df, id_col, ded_col, freq_name, other_ded_cols)
+        if not duplicates.empty:
+            num_conflicts = int(duplicates['conflict'].sum())
+            print(f"⚠️ {os.path.basename(filepath)}: combined {len(duplicates)} SSN(s) with multiple rows"
+                  f"{f' ({num_conflicts} conflict(s) to review)' if num_conflicts else ''}")
+        
         processed.append({
             'df': df,
             'date': check_date,
             'freq': freq,
             'freq_name': freq_name,
             'ded_col': ded_col,
+            'ded_cols': ded_cols,
             'id_col': id_col,
             'date_col': date_col,
-            'filename': os.path.basename(filepath)
+            'company_col': company_col,
+            'filename': os.path.basename(filepath),
+            'duplicates': duplicates
         })
         
     # Sort by date (oldest first)
     processed.sort(key=lambda x: x['date'])
-    return processed
+    return intern_ssns(processed)
+
+# ==============================================================================
+# 1B. PAYMENT MATRIX - EMPLOYEE x WEEK
+# ==============================================================================
+
+def build_payment_matrix(packets):
+    """
+    Build the employee x week payment matrix shared by every builder
+
+    Returns: {
+        'ssns': sorted array of every (canonical) SSN seen in any file,
+        'amounts': float matrix (employees x weeks), 0 where nothing was deducted or the deduction was reversed,
+        'present': bool matrix, True where the SSN is listed in that week's file,
+        'paid': bool matrix, True where a non-zero deduction was taken (reversals excluded),
+        'reversed': bool matrix, True where the week's deduction was a reversal (amount set to 0),
+        'booked_amounts': the primary deductions as the files booked them, reversals included,
+        'freqs': pay periods per year of each week's file (52/26/24/12),
+        'freq_names': frequency name of each week's file,
+        'plan_values': deductions normalized to a monthly plan value (deduction * freq / 12),
+        'companies': payroll company code per SSN ('' when the files have none),
+        'codes': deduction codes found in the files, PRIMARY_DEDUCTION_CODE first,
+        'code_amounts': float array (codes x employees x weeks); code_amounts[0] is 'amounts',
+        'code_reversed': bool array (codes x employees x weeks); code_reversed[0] is 'reversed'
+    }
+    
+    'amounts' and everything derived from it describe the primary deduction
+    code; deduction_code_matrix() gives the same view for any other code.
+    Every packet keeps its own frequency, so a batch that switches cadence
+    mid-month (or mixes Weekly and BiWeekly files) is classified in one pass.
+    """
+    num_weeks = len(packets)
+    
+    # process_raw_files() interns SSNs once; hand-built or regrouped packets are interned here
+    table = packets[0].get('ssn_table') if packets else None
+    if any('ssn_keys' not in p or p['ssn_table'] is not table for p in packets):
+        packets = [dict(p) for p in packets]
+        for p in packets:
+            p['df'] = p['df'].dropna(subset=[p['id_col']]).copy()
+            p['df'][p['id_col']] = canonicalize_ssns(p['df'][p['id_col']], ssn_format=is_ssn_column(p['id_col']))
+        intern_ssns(packets)
+    
+    # Keep only SSNs listed in these packets, renumbered to rows of the matrix
+    all_keys = np.concatenate([p['ssn_keys'] for p in packets])
+    used = np.unique(all_keys)
+    ssns = packets[0]['ssn_table'][used]
+    row_of_key = np.full(len(packets[0]['ssn_table']), -1, dtype=np.int64)
+    row_of_key[used] = np.arange(len(used))
+    
+    # Every registered code any file carries, primary first; one amounts layer per code
+    packet_codes = [p.get('ded_cols') or {PRIMARY_DEDUCTION_CODE: p['ded_col']} for p in packets]
+    codes = [PRIMARY_DEDUCTION_CODE] + [code for code in DEDUCTION_CODES
+                                        if code != PRIMARY_DEDUCTION_CODE and any(code in c for c in packet_codes)]
+    
+    present = np.zeros((len(ssns), num_weeks), dtype=bool)
+    code_amounts = np.zeros((len(codes), len(ssns), num_weeks), dtype=float)
+    for week_idx, p in enumerate(packets):
+        rows = row_of_key[p['ssn_keys']]
+        present[rows, week_idx] = True
+        for code_idx, code in enumerate(codes):
+            col = p['ded_col'] if code == PRIMARY_DEDUCTION_CODE else packet_codes[week_idx].get(code)
+            if col is None:
+                continue
+            week_amounts = p['df'][col].to_numpy(dtype=float)
+            # process_raw_files() already collapsed duplicate SSN rows; for hand-built packets the first deduction wins
+            paid = week_amounts != 0
+            paid_rows, first = np.unique(rows[paid], return_index=True)
+            code_amounts[code_idx, paid_rows, week_idx] = week_amounts[paid][first]
+    
+    # A reversal is booked with the opposite sign to most of its week's deductions (a refund);
+    # it earns nothing, so the cell is unpaid for classification, plans and commissions.
+    # The date tabs still show the primary code as booked.
+    usual_sign = np.sign((code_amounts > 0).sum(axis=1, keepdims=True) - (code_amounts < 0).sum(axis=1, keepdims=True))
+    code_reversed = code_amounts * usual_sign < 0
+    booked_amounts = code_amounts[0].copy()
+    code_amounts[code_reversed] = 0
+    amounts = code_amounts[0]
+    
+    freqs = np.array([p['freq'] if p['freq'] else 52 for p in packets], dtype=int)
+    
+    # Company code per SSN (first one seen), used for company-level agent assignments
+    companies = np.full(len(ssns), '', dtype=object)
+    company_packets = [p for p in packets if p.get('company_col')]
+    if company_packets:
+        company_long = pd.DataFrame({
+            'row': np.concatenate([row_of_key[p['ssn_keys']] for p in company_packets]),
+            'company': pd.concat([p['df'][p['company_col']] for p in company_packets], ignore_index=True)
+        }).dropna().drop_duplicates('row')
+        companies[company_long['row'].to_numpy()] = company_long['company'].astype(str).str.strip().to_numpy()
+    
+    return {
+        'ssns': ssns,
+        'amounts': amounts,
+        'booked_amounts': booked_amounts,
+        'present': present,
+        'paid': amounts != 0,
+        'reversed': code_reversed[0],
+        'freqs': freqs,
+        'freq_names': [p['freq_name'] for p in packets],
+        'plan_values': plan_values_from_amounts(amounts, freqs),
+        'companies': companies,
+        'codes': codes,
+        'code_amounts': code_amounts,
+        'code_reversed': code_reversed
+    }
+
+def deduction_code_matrix(matrix, code):
+    """The payment matrix seen through one deduction code (same employees, weeks and frequencies)"""
+    if code == PRIMARY_DEDUCTION_CODE:
+        return matrix
+    code_idx = matrix['codes'].index(code)
+    amounts = matrix['code_amounts'][code_idx]
+    return dict(matrix, amounts=amounts, paid=amounts != 0, reversed=matrix['code_reversed'][code_idx],
+                plan_values=plan_values_from_amounts(amounts, matrix['freqs']))
+
+def active_deduction_codes(config, matrix):
+    """
+    Deduction codes to commission for a run: the primary code plus any
+    config['deduction_codes'] the payroll files actually carry
+    """
+    requested = (config or {}).get('deduction_codes') or []
+    return [PRIMARY_DEDUCTION_CODE] + [code for code in requested
+                                       if code != PRIMARY_DEDUCTION_CODE and code in matrix.get('codes', [])]
+
+def classify_employees(matrix):
+    """
+    Split employees into perfect (paid every week) and imperfect in one pass
+
+    Returns: {
+        'perfect': bool mask over matrix['ssns'],
+        'imperfect': bool mask over matrix['ssns'],
+        'missed_bitmap': uint8 packed bits per employee, bit i set = week i missed
+    }
+    """
+    paid = matrix['paid']
+    perfect = paid.all(axis=1)
+
+    return {
+        'perfect': perfect,
+        'imperfect': ~perfect,
+        'missed_bitmap': np.packbits(~paid, axis=1, bitorder='little')
+    }
+
+def classify_tier_employees(matrix):
+    """
+    Tier-report classification: only employees listed in every week's file count
+    
+    Returns: {
+        'perfect': bool mask, paid every week,
+        'imperfect': bool mask, paid some but not all weeks,
+        'plan_matrix': 'PPC1600'... per employee x week (None where unpaid),
+        'employee_plans': plan taken from each employee's first non-zero payment
+    }
+    """
+    paid = matrix['paid']
+    plan_matrix = detect_plans_from_values(matrix['plan_values'], matrix['freq_names'])
+    
+    in_every_week = matrix['present'].all(axis=1)
+    perfect = in_every_week & paid.all(axis=1)
+    imperfect = in_every_week & paid.any(axis=1) & ~perfect
+    
+    first_paid_week = paid.argmax(axis=1)
+    employee_plans = plan_matrix[np.arange(len(matrix['ssns'])), first_paid_week]
+    
+    return {
+        'perfect': perfect,
+        'imperfect': imperfect,
+        'plan_matrix': plan_matrix,
+        'employee_plans': employee_plans
+    }
+
+def plan_values_from_amounts(amounts, freqs):
+    """Normalize deductions to a monthly plan value (|deduction| * freq / 12), one frequency per week column"""
+    return np.abs(np.asarray(amounts, dtype=float)) * np.asarray(freqs) / 12
+
+def plan_levels_from_values(plan_values, freq_names):
+    """Vectorized plan level (1600/1400/1200/1000, 0 if below all) from normalized plan values"""
+    plan_values = np.asarray(plan_values, dtype=float)
+    periods = np.array([FREQUENCY_PERIODS.get(name, 12) for name in freq_names])
+    
+    # Each week's PLAN_THRESHOLDS normalized the same way as its deductions
+    minimums = np.array([
+        [minimum for minimum, _ in PLAN_THRESHOLDS.get(name, PLAN_THRESHOLDS['Monthly'])]
+        for name in freq_names
+    ]) * periods[:, None] / 12
+    
+    conditions = [plan_values >= minimums[:, level] for level in range(minimums.shape[1])]
+    choices = [plan for _, plan in PLAN_THRESHOLDS['Monthly']]
+    return np.select(conditions, choices, default=0)
+
+def detect_plans_from_values(plan_values, freq_names):
+    """Vectorized detect_plan_from_amount on normalized values: 'PPC1600'... per cell, None where 0"""
+    plan_values = np.asarray(plan_values, dtype=float)
+    periods = np.array([FREQUENCY_PERIODS.get(name, 12) for name in freq_names])
+    
+    targets = np.array([[freq_rates[name] for freq_rates in PLAN_MAP.values()] for name in freq_names]) * periods[:, None] / 12
+    tolerance = 1.0 * periods / 12
+    
+    conditions = [np.abs(plan_values - targets[:, level]) < tolerance for level in range(targets.shape[1])]
+    choices = [f'PPC{plan_num}' for plan_num in PLAN_MAP]
+    plans = np.select(conditions, choices, default='PPC1000').astype(object)
+    plans[plan_values == 0] = None
+    return plans
+
+def format_missed_weeks(bitmap_row, packets):
+    """Build the Unpaid reason text for one employee from their missed-week bitmap"""
+    missed = np.unpackbits(bitmap_row, count=len(packets), bitorder='little')
+    missed_weeks = [packets[i]['date'].strftime('%m/%d/%Y') for i in np.flatnonzero(missed)]
+    return f"Missing payment in week(s): {', '.join(missed_weeks)}" if missed_weeks else "Incomplete data"
+
+# ==============================================================================
+# 1C. DATE TAB WRITERS
+# ==============================================================================
+
+def week_column(matrix, week_idx):
+    """SSNs listed in one week's file (sorted), their deduction as booked and which of those were reversals"""
+    rows = np.flatnonzero(matrix['present'][:, week_idx])
+    return matrix['ssns'][rows], matrix['booked_amounts'][rows, week_idx], matrix['reversed'][rows, week_idx]
+
+def write_date_tab(ws, packet, ssns, amounts, workbook, reversed_rows=None, clients=None):
+    """
+    Write a Harry/Dynamic date tab in bulk: SSN | PPC125 (negative) | SUM row
+    
+    ssns must already be sorted; unpaid employees get an empty PPC125 cell.
+    Reversals keep their amount, booked positive, and are marked REVERSED.
+    clients adds a Client column (D) for tabs shared by several clients.
+    """
+    fmt_header = get_format(workbook, 'header')
+    fmt_text = get_format(workbook, 'text')
+    fmt_currency = get_format(workbook, 'currency')
+    
+    ws.write(0, 0, "SSN", fmt_header)
+    ws.write(0, 1, "PPC125", fmt_header)
+    ws.write(0, 2, packet['date'].strftime('%m/%d/%Y'), fmt_header)
+    ws.set_column(0, 0, 15)
+    ws.set_column(1, 2, 12)
+    
+    values = (-np.abs(amounts)).astype(object)
+    values[amounts == 0] = ""
+    if reversed_rows is not None and reversed_rows.any():
+        values[reversed_rows] = np.abs(amounts[reversed_rows])
+        for row in np.flatnonzero(reversed_rows):
+            ws.write_string(row + 1, 2, "REVERSED")
+    
+    ws.write_column(1, 0, ssns.tolist(), fmt_text)
+    ws.write_column(1, 1, values.tolist(), fmt_currency)
+    if clients is not None:
+        ws.write(0, 3, "Client", fmt_header)
+        ws.set_column(3, 3, 24)
+        ws.write_column(1, 3, list(clients), fmt_text)
+    
+    # Add total row
+    row_idx = len(ssns) + 1
+    ws.write_string(row_idx, 0, "", fmt_text)
+    ws.write_formula(row_idx, 1, f'=SUM(B2:B{row_idx})', fmt_currency)
+
+def write_tier_date_tab(ws, packet, ssns, amounts, workbook, reversed_rows=None):
+    """Write a tier-report date tab in bulk: SSN | PPC | paid date, UNPAID or REVERSED"""
+    fmt_header = get_format(workbook, 'header')
+    fmt_text = get_format(workbook, 'text')
+    fmt_currency = get_format(workbook, 'currency')
+    
+    ws.write(0, 0, "SSN", fmt_header)
+    ws.write(0, 1, "PPC125", fmt_header)
+    ws.write(0, 2, packet['date'].strftime('%m/%d/%Y'), fmt_header)
+    ws.set_column(0, 0, 15)
+    ws.set_column(1, 2, 12)
+    
+    status = np.where(amounts != 0, packet['date'].strftime('%m/%d/%Y'), "UNPAID")
+    if reversed_rows is not None:
+        status[reversed_rows] = "REVERSED"
+    
+    ws.write_column(1, 0, ssns.tolist(), fmt_text)
+    ws.write_column(1, 1, amounts.tolist(), fmt_currency)
+    ws.write_column(1, 2, status.tolist())
+
+# ==============================================================================
+# 1D. BOOK-OF-BUSINESS ATTRIBUTION - WHICH AGENT WROTE WHICH EMPLOYEE
+# ==============================================================================
+
+def load_agent_assignments(path):
+    """
+    Read an agent assignment table (CSV or Excel)
+    
+    Columns: Agent plus SSN and/or Company Code; a row may assign one SSN or a
+    whole payroll company code to the agent.
+    
+    Returns: DataFrame with columns agent, ssn, company_code ('' where not given)
+    """
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, dtype=str)
+    else:
+        df = pd.read_excel(path, dtype=str)
+    
+    df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
+    agent_col = next((c for c in df.columns if 'agent' in c), None)
+    if agent_col is None:
+        raise ValueError(f"{path}: no Agent column found")
+    
+    ssn_col = next((c for c in df.columns if 'ssn' in c), None)
+    company_col = next((c for c in df.columns if 'company' in c), None)
+    
+    assignments = pd.DataFrame({
+        'agent': df[agent_col],
+        'ssn': df[ssn_col] if ssn_col else '',
+        'company_code': df[company_col] if company_col else ''
+    }).fillna('')
+    assignments = assignments.apply(lambda col: col.astype(str).str.strip())
+    assignments['ssn'] = canonicalize_ssns(assignments['ssn'])
+    return assignments[assignments['agent'] != '']
+
+def attribute_employees(matrix, assignments):
+    """
+    Join the assignment table onto the payment matrix
+    
+    SSN assignments win over company-code assignments.
+    
+    Returns: {
+        'agents': array of agent names,
+        'employee_agent': agent index per matrix SSN (-1 when unassigned)
+    }
+    """
+    agents = pd.Index(assignments['agent'].unique())
+    employee_agent = np.full(len(matrix['ssns']), -1, dtype=int)
+    
+    by_company = assignments[assignments['company_code'] != ''].drop_duplicates('company_code')
+    if len(by_company):
+        company_index = pd.Index(by_company['company_code'])
+        rows = company_index.get_indexer(matrix['companies'].astype(str))
+        matched = rows >= 0
+        employee_agent[matched] = agents.get_indexer(by_company['agent'].to_numpy()[rows[matched]])
+    
+    by_ssn = assignments[assignments['ssn'] != ''].drop_duplicates('ssn', keep='last')
+    if len(by_ssn):
+        rows = pd.Index(matrix['ssns']).get_indexer(by_ssn['ssn'])
+        found = rows >= 0
+        employee_agent[rows[found]] = agents.get_indexer(by_ssn['agent'].to_numpy()[found])
+    
+    return {
+        'agents': agents.to_numpy(),
+        'employee_agent': employee_agent
+    }
+
+def attributed_downline_counts(matrix, attribution, weights):
+    """
+    Per-agent downline plan counts, each employee counted by its weight
+    (the perfect mask, or commission_weights when prorating)
+    
+    Returns: {agent: (plan_1000_count, other_plans_count)} for every assigned agent
+    """
+    plan_levels = plan_levels_from_values(matrix['plan_values'], matrix['freq_names'])
+    has_1000, other_only = plan_group_flags(plan_levels, matrix['paid'])
+    
+    weights = np.asarray(weights, dtype=float)
+    owner = attribution['employee_agent']
+    counted = (weights > 0) & (owner >= 0)
+    num_agents = len(attribution['agents'])
+    
+    plan_1000_counts = np.bincount(owner[counted & has_1000], weights=weights[counted & has_1000], minlength=num_agents)
+    other_plans_counts = np.bincount(owner[counted & other_only], weights=weights[counted & other_only], minlength=num_agents)
+    
+    return {
+        agent: (float(plan_1000), float(other))
+        for agent, plan_1000, other in zip(attribution['agents'], plan_1000_counts, other_plans_counts)
+    }
+
+def tier_owner_index(tree, attribution):
+    """
+    Flattened-tree index of the agent whose book each employee is in
+    (the main agent for employees assigned outside the tree or not at all)
+    """
+    tree_index = pd.Index(tree['names']).get_indexer(attribution['agents'])
+    tree_index[tree_index < 0] = 0
+    owner = attribution['employee_agent']
+    return np.where(owner >= 0, tree_index[np.maximum(owner, 0)], 0)
+
+def attributed_tier_books(tree, attribution, employee_plans, weights):
+    """
+    Per-agent plan counts (agents x PPC1600/1400/1200/1000) aligned with a flattened tier tree
+    
+    Each employee counts by its weight (the perfect mask, or commission_weights when
+    prorating). Employees assigned to an agent outside the tree, or not assigned at
+    all, are credited to the main agent's own book.
+    """
+    plans = ['PPC1600', 'PPC1400', 'PPC1200', 'PPC1000']
+    owner_in_tree = tier_owner_index(tree, attribution)
+    plan_index = pd.Index(plans).get_indexer(employee_plans.astype(str))
+    weights = np.asarray(weights, dtype=float)
+    counted = (weights > 0) & (plan_index >= 0)
+    
+    num_agents = len(tree['names'])
+    books = np.bincount(owner_in_tree[counted] * len(plans) + plan_index[counted], weights=weights[counted],
+                        minlength=num_agents * len(plans))
+    return books.reshape(num_agents, len(plans))
+
+def write_downline_counts(ws, row, col, agent_book, plan_count_start_row, plan_count_col, fmt, prorated=False):
+    """
+    Write a downline row's Plan 1000 / Other Plans counts
+    
+    Agents with an attributed book get their own counts; everyone else keeps
+    referencing the group-wide PLAN COUNTING cells (plus the prorated Unpaid
+    counts written below them when prorated).
+    
+    Returns: (plan_1000_count_cell, other_plans_count_cell) for the commission formula
+    """
+    if agent_book is not None:
+        ws.write_number(row, col + 1, agent_book[0], fmt)
+        ws.write_number(row, col + 2, agent_book[1], fmt)
+        return xl_rowcol_to_cell(row, col + 1), xl_rowcol_to_cell(row, col + 2)
+    
+    plan_1000_count_cell = xl_rowcol_to_cell(plan_count_start_row + 2, plan_count_col + 1)
+    other_plans_count_cell = xl_rowcol_to_cell(plan_count_start_row + 3, plan_count_col + 1)
+    if prorated:
+        ws.write_formula(row, col + 1, f'={plan_1000_count_cell}+{xl_rowcol_to_cell(plan_count_start_row + 4, plan_count_col + 1)}', fmt)
+        ws.write_formula(row, col + 2, f'={other_plans_count_cell}+{xl_rowcol_to_cell(plan_count_start_row + 5, plan_count_col + 1)}', fmt)
+        return xl_rowcol_to_cell(row, col + 1), xl_rowcol_to_cell(row, col + 2)
+    
+    ws.write_formula(row, col + 1, f'={plan_1000_count_cell}', fmt)
+    ws.write_formula(row, col + 2, f'={other_plans_count_cell}', fmt)
+    return plan_1000_count_cell, other_plans_count_cell
+
+def write_prorated_counts(ws, plan_count_start_row, plan_count_col, counts, fmt_label, fmt_value):
+    """Prorated Unpaid plan counts in the two rows under PLAN COUNTING (see write_downline_counts)"""
+    ws.write(plan_count_start_row + 4, plan_count_col, "Prorated 1000 (Unpaid):", fmt_label)
+    ws.write(plan_count_start_row + 5, plan_count_col, "Prorated Other (Unpaid):", fmt_label)
+    ws.write_number(plan_count_start_row + 4, plan_count_col + 1, counts[0], fmt_value)
+    ws.write_number(plan_count_start_row + 5, plan_count_col + 1, counts[1], fmt_value)
+
+# ==============================================================================
+# 1E. ENROLLMENT CHANGES - NEW, TERMINATED AND RETURNING EMPLOYEES
+# ==============================================================================
+
+# Change from one period to the next (week to week, month to month):
+#   new        - first deduction of the whole run
+#   returning  - deducted again after a period without
+#   lapsed     - still on the payroll report, deduction stopped
+#   terminated - deduction stopped and no longer on the payroll report
+#   continuing - deducted in both periods
+ENROLLMENT_CHANGES = ['new', 'returning', 'lapsed', 'terminated', 'continuing']
+
+# Where each employee stands at the end of the run, in the order they are listed
+ENROLLMENT_STATUSES = ['new', 'returning', 'lapsed', 'terminated', 'not paying', 'active']
+
+def enrollment_transitions(paid, present):
+    """
+    Status changes between consecutive periods (columns) of employees x periods masks
+
+    Returns: {change: bool matrix (employees x periods - 1)} for every ENROLLMENT_CHANGES entry
+    """
+    paid = np.asarray(paid, dtype=bool)
+    present = np.asarray(present, dtype=bool)
+    prev_paid, cur_paid = paid[:, :-1], paid[:, 1:]
+    paid_before = np.logical_or.accumulate(paid, axis=1)[:, :-1]
+    started = cur_paid & ~prev_paid
+    stopped = prev_paid & ~cur_paid
+    return {
+        'new': started & ~paid_before,
+        'returning': started & paid_before,
+        'lapsed': stopped & present[:, 1:],
+        'terminated': stopped & ~present[:, 1:],
+        'continuing': prev_paid & cur_paid
+    }
+
+def analyze_enrollment(matrix, dates):
+    """
+    Roster churn over the run, week to week and month to month
+
+    Months group consecutive pay dates by calendar month; an employee counts
+    as paid (or listed) in a month when any of its weeks was.
+    Returns: {
+        'employees': one row per SSN (status at the end of the run, first/last
+                     paid date, weeks paid and listed),
+        'periods': counts per ENROLLMENT_CHANGES entry for each consecutive week and month pair
+    }
+    """
+    paid, present = matrix['paid'], matrix['present']
+    num_weeks = paid.shape[1]
+    dates = pd.to_datetime(pd.Series(dates)).reset_index(drop=True)
+
+    ever_paid = paid.any(axis=1)
+    first = paid.argmax(axis=1)
+    last = num_weeks - 1 - paid[:, ::-1].argmax(axis=1)
+    weeks_paid = paid.sum(axis=1)
+    paid_now, listed_now = paid[:, -1], present[:, -1]
+    status = np.select(
+        [~ever_paid, ~paid_now & ~listed_now, ~paid_now, first > 0, weeks_paid < last - first + 1],
+        ['not paying', 'terminated', 'lapsed', 'new', 'returning'],
+        default='active'
+    )
+    employees = pd.DataFrame({
+        'ssn': matrix['ssns'],
+        'status': status,
+        'first_paid': dates.to_numpy()[first],
+        'last_paid': dates.to_numpy()[last],
+        'weeks_paid': weeks_paid,
+        'weeks_listed': present.sum(axis=1)
+    })
+    employees.loc[~ever_paid, ['first_paid', 'last_paid']] = pd.NaT
+
+    month_labels = dates.dt.strftime('%B %Y')
+    month_starts = np.flatnonzero(np.r_[True, month_labels.to_numpy()[1:] != month_labels.to_numpy()[:-1]])
+    levels = [
+        ('week', paid, present, dates.dt.strftime('%m/%d/%Y').to_numpy()),
+        ('month', np.logical_or.reduceat(paid, month_starts, axis=1),
+         np.logical_or.reduceat(present, month_starts, axis=1), month_labels.to_numpy()[month_starts])
+    ]
+    frames = []
+    for level, level_paid, level_present, labels in levels:
+        if len(labels) < 2:
+            continue
+        changes = enrollment_transitions(level_paid, level_present)
+        frame = pd.DataFrame({'level': level, 'from': labels[:-1], 'to': labels[1:]})
+        for change in ENROLLMENT_CHANGES:
+            frame[change] = changes[change].sum(axis=0)
+        frames.append(frame)
+    periods = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['level', 'from', 'to'] + ENROLLMENT_CHANGES)
+
+    return {'employees': employees, 'periods': periods}
+
+def write_enrollment_sheet(workbook, packets, matrix):
+    """
+    'Enrollment Changes' sheet: change counts per week/month pair, then every
+    employee who is not 'active' (paid every week), grouped by status
+    
+    Returns: {status: number of employees} for ENROLLMENT_STATUSES
+    """
+    enrollment = analyze_enrollment(matrix, [p['date'] for p in packets])
+    periods = enrollment['periods']
+    employees = enrollment['employees']
+    changed = employees[employees['status'] != 'active']
+    changed = changed.iloc[np.lexsort((changed['ssn'].to_numpy(),
+                                       changed['status'].map(ENROLLMENT_STATUSES.index).to_numpy()))]
+
+    ws = workbook.add_worksheet('Enrollment Changes')
+    fmt_header = get_format(workbook, 'header')
+    fmt_text = get_format(workbook, 'text')
+    fmt_date = get_format(workbook, 'date')
+    ws.set_column(0, 0, 15)
+    ws.set_column(1, 2, 16)
+    ws.set_column(3, 7, 12)
+
+    ws.write_row(0, 0, ['Level', 'From', 'To'] + [change.title() for change in ENROLLMENT_CHANGES], fmt_header)
+    for row, record in enumerate(periods.itertuples(index=False), 1):
+        ws.write_row(row, 0, [record[0].title(), record[1], record[2]] + [int(v) for v in record[3:]])
+
+    row = len(periods) + 3
+    ws.write_row(row, 0, ['SSN', 'Status', 'First Paid', 'Last Paid', 'Weeks Paid', 'Weeks Listed'], fmt_header)
+    for row, record in enumerate(changed.itertuples(index=False), row + 1):
+        ws.write_string(row, 0, record.ssn, fmt_text)
+        ws.write_string(row, 1, record.status.title())
+        for col, value in ((2, record.first_paid), (3, record.last_paid)):
+            if not pd.isna(value):
+                ws.write_datetime(row, col, value.to_pydatetime(), fmt_date)
+        ws.write_number(row, 4, record.weeks_paid)
+        ws.write_number(row, 5, record.weeks_listed)
+    ws.freeze_panes(1, 0)
+
+    counts = employees['status'].value_counts()
+    return {status: int(counts.get(status, 0)) for status in ENROLLMENT_STATUSES}
+
+def format_enrollment_counts(counts):
+    """'2 new, 1 terminated, 40 active' - statuses with at least one employee"""
+    return ', '.join(f"{count} {status}" for status, count in counts.items() if count) or "no employees"
+
+# ==============================================================================
+# 1F. PRORATION - PARTIAL COMMISSION FOR EMPLOYEES WHO MISSED WEEKS
+# ==============================================================================
+
+# How employees who missed a payroll week (the Unpaid tab) are commissioned:
+#   all_or_nothing - only employees paid every week earn; the Unpaid tab is for information
+#   prorated       - main agents earn on every week an unpaid employee did pay, and
+#                    downline/tier plan counts include them by the share of weeks paid
+PRORATION_POLICIES = ['all_or_nothing', 'prorated']
+
+def proration_policy(config):
+    """The run's proration policy: config['proration'], all-or-nothing by default"""
+    policy = (config or {}).get('proration') or PRORATION_POLICIES[0]
+    if policy not in PRORATION_POLICIES:
+        raise ValueError(f"unknown proration policy '{policy}' (choose from {', '.join(PRORATION_POLICIES)})")
+    return policy
+
+def commission_weights(matrix, classification, policy):
+    """
+    Share of a full commission each employee earns under a proration policy
+
+    Returns: float array over matrix['ssns'] - 1 for perfect employees, the share of
+    weeks paid for imperfect ones when prorated, 0 for everyone else
+    """
+    weights = classification['perfect'].astype(float)
+    if policy == 'prorated':
+        imperfect = classification['imperfect']
+        weights[imperfect] = matrix['paid'][imperfect].mean(axis=1)
+    return weights
+
+def weighted_plan_groups(plan_levels, paid, weights):
+    """
+    Downline plan counting with every employee counted by its weight
+
+    Weeks without a payment are skipped, so a prorated employee on 1200/1400/1600
+    in each week they paid counts toward Other Plans.
+
+    Returns: (plan_1000_count, other_plans_count)
+    """
+    has_1000, other_only = plan_group_flags(plan_levels, paid)
+    return float(weights[has_1000].sum()), float(weights[other_only].sum())
+
+def weighted_plan_counts(employee_plans, weights):
+    """
+    Tier plan counts (PPC1600/1400/1200/1000) with every employee counted by its weight
+
+    Returns: {'PPC1600': 25.0, 'PPC1400': 18.5, 'PPC1200': 12.0, 'PPC1000': 8.0}
+    """
+    plans = ['PPC1600', 'PPC1400', 'PPC1200', 'PPC1000']
+    plan_index = pd.Index(plans).get_indexer(np.asarray(employee_plans).astype(str))
+    counted = plan_index >= 0
+    counts = np.bincount(plan_index[counted], weights=weights[counted], minlength=len(plans))
+    return dict(zip(plans, counts.tolist()))
+
+def prorated_agent_totals(plan_levels, freqs, agent_rates, mask):
+    """
+    Each main agent's commission over the masked employees' paid weeks
+    (weeks without a payment have no plan and earn nothing)
+
+    Returns: {agent: total}
+    """
+    levels = plan_levels[mask]
+    return {agent: float(agent_commission_matrix(levels, freqs, rates).sum()) for agent, rates in agent_rates.items()}
 
 # ==============================================================================
 # 2. TIER-BASED COMMISSION CALCULATIONS (System 2)
@@ -374,366 +1488,403 @@ def calculate_override_commission(plan_counts, client_tier, agent_tier):
     
     return override
 
-# ==============================================================================
-# 3. HARRY'S GROUP REPORT BUILDER (System 1)
-# ==============================================================================
-
-def build_harry_group_report(packets, selected_client=None, group_type=GROUP_TYPE_HARRY):
-    """Build Excel report for Harry's Group or Adam's Group with client-based rates, plan counting, and downline commissions"""
-    if not packets: 
-        print("❌ No valid data found.")
-        return
-
-    report_date = packets[0]['date']
-    freq_name = packets[0]['freq_name']
-    freq_val = packets[0]['freq'] if packets[0]['freq'] else 52
-    
-    # Include client name in filename if specified
-    client_suffix = f"_{selected_client}" if selected_client else ""
-    filename = f"Commission_Report_Harry{client_suffix}_{report_date.strftime('%B_%Y')}.xlsx"
-    out_path = os.path.join(OUTPUT_FOLDER, filename)
+def flatten_agent_tree(main_agent, sub_agents):
+    """
+    Flatten an agent hierarchy of any depth into parallel arrays (parents before children)
     
-    workbook = xlsxwriter.Workbook(out_path, {'nan_inf_to_errors': True})
+    Every agent dict is {'name': ..., 'tier': ..., 'sub_agents': [...]} where the
+    nested 'sub_agents' list is optional; a flat list is the classic two-level group.
     
-    # Formats
-    fmt_header = workbook.add_format({
-        'bold': True, 
-        'bg_color': '#D9E1F2', 
-        'border': 1, 
-        'align': 'center',
-        'valign': 'vcenter'
-    })
-    fmt_currency = workbook.add_format({'num_format': '$#,##0.00'})
-    fmt_text = workbook.add_format({'num_format': '@'})
-    fmt_date_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#4472C4',
-        'font_color': '#FFFFFF',
-        'border': 1,
-        'align': 'center'
-    })
+    Returns: {
+        'agents': agent dicts in depth-first order (main agent first),
+        'names': array of names,
+        'tiers': array of tier strings,
+        'parents': index of each agent's parent (-1 for the main agent),
+        'depths': 0 for the main agent, 1 for its sub-agents, ...
+    }
+    """
+    agents, parents, depths = [], [], []
+    stack = [(main_agent, -1, 0)]
+    
+    while stack:
+        agent, parent, depth = stack.pop()
+        index = len(agents)
+        agents.append(agent)
+        parents.append(parent)
+        depths.append(depth)
+        
+        children = sub_agents if parent == -1 else agent.get('sub_agents', [])
+        for child in reversed(children):
+            stack.append((child, index, depth + 1))
     
-    # Color formats for commission columns
-    fmt_charles = workbook.add_format({'num_format': '$#,##0.00', 'bg_color': '#D9E1F2'})
-    fmt_harry = workbook.add_format({'num_format': '$#,##0.00', 'bg_color': '#E2EFDA'})
-    fmt_lighthouse = workbook.add_format({'num_format': '$#,##0.00', 'bg_color': '#FCE4D6'})
-    
-    # Grand totals
-    fmt_total_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#000000',
-        'font_color': '#FFFFFF',
-        'align': 'center',
-        'border': 1
-    })
-    fmt_total_value = workbook.add_format({
-        'num_format': '$#,##0.00',
-        'bold': True,
-        'bg_color': '#FFFF00',
-        'border': 1,
-        'align': 'center',
-        'font_size': 12
-    })
+    return {
+        'agents': agents,
+        'names': np.array([a.get('name', 'Main Agent' if d == 0 else 'Sub Agent') for a, d in zip(agents, depths)], dtype=object),
+        'tiers': np.array([str(a.get('tier', '35' if d == 0 else '25')) for a, d in zip(agents, depths)], dtype=object),
+        'parents': np.array(parents, dtype=int),
+        'depths': np.array(depths, dtype=int)
+    }
 
-    master_ssn = set()
-    employee_payments = {}
+def calculate_hierarchy_earnings(tree, plan_counts, books=None):
+    """
+    Own-tier commission and overrides for every agent of a flattened tree at once
     
-    # Step 1: Create date-named tabs
-    for i, p in enumerate(packets):
-        tab_date = f"{p['date'].month}.{p['date'].day}"
-        tab_name = tab_date[:31]
-        
-        ws = workbook.add_worksheet(tab_name)
-        
-        df = p['df']
-        ded_col = p['ded_col']
-        id_col = p['id_col']
-        
-        paid = df[df[ded_col] != 0].copy()
-        
-        all_ids = df[id_col].dropna().astype(str).str.strip().unique()
-        master_ssn.update(all_ids)
-        
-        paid_ssns = set(paid[id_col].dropna().astype(str).str.strip())
-        
-        for ssn in all_ids:
-            if ssn not in employee_payments:
-                employee_payments[ssn] = []
-            
-            if ssn in paid_ssns:
-                amount = paid[paid[id_col].astype(str).str.strip() == ssn][ded_col].iloc[0]
-                employee_payments[ssn].append(amount)
-            else:
-                employee_payments[ssn].append(0)
-        
-        # Write headers
-        ws.write(0, 0, "SSN", fmt_header)
-        ws.write(0, 1, "PPC125", fmt_header)
-        ws.write(0, 2, p['date'].strftime('%m/%d/%Y'), fmt_header)
-        
-        ws.set_column(0, 0, 15)
-        ws.set_column(1, 2, 12)
-        
-        all_ssns_in_file = df[id_col].dropna().astype(str).str.strip().unique()
-        
-        row_idx = 1
-        for ssn in sorted(all_ssns_in_file):
-            ws.write_string(row_idx, 0, ssn, fmt_text)
-            
-            employee_row = paid[paid[id_col].astype(str).str.strip() == ssn]
-            
-            if not employee_row.empty:
-                val = -abs(employee_row[ded_col].iloc[0])
-                ws.write_number(row_idx, 1, val, fmt_currency)
-            else:
-                ws.write_string(row_idx, 1, "", fmt_text)
-            
-            row_idx += 1
+    Each agent earns its tier rate on the plan counts; each parent also earns
+    (parent tier rate - child tier rate) on the counts for every direct child.
+    Unknown tiers earn nothing and generate no override, like the scalar helpers.
+    
+    books: optional agents x plans counts (see attributed_tier_books). Agents then
+    earn on their own book, and overrides apply to each child's whole downline book.
+    
+    Returns: {'own': array, 'override': array, 'total': array} aligned with tree['names']
+    """
+    plans = list(plan_counts.keys())
+    
+    rate_table = pd.DataFrame.from_dict(TIER_RATES, orient='index').reindex(columns=plans)
+    rates = rate_table.reindex(tree['tiers']).fillna(0).to_numpy(dtype=float)
+    known = np.isin(tree['tiers'], list(TIER_RATES))
+    
+    children = np.flatnonzero(tree['parents'] >= 0)
+    parents = tree['parents'][children]
+    
+    if books is None:
+        counts = np.array([plan_counts[plan] for plan in plans], dtype=float)
+        own = rates @ counts
+        child_override = (rates[parents] - rates[children]) @ counts
+    else:
+        books = np.asarray(books, dtype=float)
+        own = (rates * books).sum(axis=1)
         
-        # Add total row
-        ws.write_string(row_idx, 0, "", fmt_text)
-        ws.write_formula(row_idx, 1, f'=SUM(B2:B{row_idx})', fmt_currency)
+        # Roll each book up to its ancestors, deepest level first
+        downline = books.copy()
+        for depth in range(tree['depths'].max(), 0, -1):
+            level = np.flatnonzero(tree['depths'] == depth)
+            np.add.at(downline, tree['parents'][level], downline[level])
+        child_override = ((rates[parents] - rates[children]) * downline[children]).sum(axis=1)
+    child_override[~(known[parents] & known[children])] = 0
+    override = np.bincount(parents, weights=child_override, minlength=len(own))
+    
+    return {
+        'own': own,
+        'override': override,
+        'total': own + override
+    }
+
+# ==============================================================================
+# 3. HARRY'S GROUP REPORT BUILDER (System 1)
+# ==============================================================================
+
+def write_harry_sheets(workbook, packets, matrix, selected_client=None, group_type=GROUP_TYPE_HARRY,
+                       attribution=None, sheet_prefix="", sheets=None, proration=None, shared_date_tabs=False):
+    """
+    Write the Unpaid and Commissions sheets of a Harry's/Adam's Group report
+    
+    The date tabs the VLOOKUPs read from must already exist in the workbook.
+    sheet_prefix keeps the sheet names unique when several clients share one workbook;
+    shared_date_tabs looks deductions up by SSN and selected_client on those clients' common tabs.
+    sheets limits which SHEET_SECTIONS are materialized (default: all). Without the
+    date tabs the PPC125 cells hold the deduction itself instead of a VLOOKUP, and
+    without the employee grid the totals and plan counts are written as values.
+    proration: PRORATION_POLICIES entry; 'prorated' rolls the Unpaid tab's weekly
+    commissions into the grand totals and its plan counts into the downline.
+    
+    Returns: {
+        'commissions_sheet': name of the Commissions sheet (None if not written),
+        'grand_total_cells': {'Charles': 'X3', 'Harry': ..., 'LightHouse': ...},
+        'downline_cells': commission cell of every downline row,
+        'num_weeks', 'total_employees', 'perfect', 'imperfect': counts for the summary
+    }
+    """
+    freq_name = packets[0]['freq_name']
+    
+    fmt_header = get_format(workbook, 'header')
+    fmt_currency = get_format(workbook, 'currency')
+    fmt_text = get_format(workbook, 'text')
+    fmt_date_header = get_format(workbook, 'date_header')
+    fmt_charles = get_format(workbook, 'charles')
+    fmt_harry = get_format(workbook, 'harry')
+    fmt_lighthouse = get_format(workbook, 'lighthouse')
+    fmt_total_header = get_format(workbook, 'total_header')
+    fmt_total_value = get_format(workbook, 'total_value')
+    
+    sheets = set(sheets or SHEET_SECTIONS)
+    master_ssn = matrix['ssns']
+    week_freqs = matrix['freqs']
     
     # Identify perfect vs imperfect employees
-    perfect_employees = []
-    imperfect_employees = []
     num_weeks = len(packets)
-    employee_plan_levels = {}
-    
-    for ssn, payments in employee_payments.items():
-        if len(payments) == num_weeks and all(amount != 0 for amount in payments):
-            perfect_employees.append(ssn)
-            
-            # Determine plan level from first non-zero payment
-            first_payment = abs(payments[0])
-            if freq_name == "Weekly":
-                if first_payment >= 360: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 315: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 270: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 220: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-            elif freq_name == "BiWeekly":
-                if first_payment >= 720: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 630: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 540: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 450: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-            elif freq_name == "SemiMonthly":
-                if first_payment >= 780: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 680: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 580: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 480: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-            else:  # Monthly
-                if first_payment >= 1550: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 1350: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 1150: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 950: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-        else:
-            missed_weeks = []
-            for i, amount in enumerate(payments):
-                if amount == 0:
-                    missed_weeks.append(packets[i]['date'].strftime('%m/%d/%Y'))
-            
-            reason = f"Missing payment in week(s): {', '.join(missed_weeks)}" if missed_weeks else "Incomplete data"
-            imperfect_employees.append([ssn, 0, reason])
+    classification = classify_employees(matrix)
+    perfect_mask = classification['perfect']
+    imperfect_mask = classification['imperfect']
+    perfect_employees = master_ssn[perfect_mask]
+    imperfect_employees = master_ssn[imperfect_mask]
+    missed_bitmaps = classification['missed_bitmap'][imperfect_mask]
+    
+    # Weeks whose date tab holds reversals; their lookups leave the refunds out
+    week_reversals = matrix['reversed'].any(axis=0)
+    lookup_client = selected_client if shared_date_tabs else None
+    
+    # Determine plan level from first week's payment
+    perfect_plan_levels = plan_levels_from_values(matrix['plan_values'][perfect_mask, 0], matrix['freq_names'][:1])
+    
+    # Share of a full commission per employee; unpaid employees only earn when prorating
+    policy = proration or PRORATION_POLICIES[0]
+    prorated = policy == 'prorated' and len(imperfect_employees) > 0
+    weights = commission_weights(matrix, classification, policy)
+    unpaid_totals = {}
+    if prorated:
+        plan_levels = plan_levels_from_values(matrix['plan_values'], matrix['freq_names'])
+        unpaid_totals = prorated_agent_totals(plan_levels, week_freqs, HARRY_MAIN_AGENT_RATES, imperfect_mask)
+        prorated_counts = weighted_plan_groups(plan_levels[imperfect_mask], matrix['paid'][imperfect_mask],
+                                               weights[imperfect_mask])
+    
+    # Downline agents with assigned employees are credited with their own book
+    agent_books = {}
+    if attribution and 'downline' in sheets:
+        agent_books = attributed_downline_counts(matrix, attribution, weights)
     
     # Step 2: Create Unpaid tab
-    ws_unpaid = workbook.add_worksheet("Unpaid")
-    ws_unpaid.write(0, 0, "SSN", fmt_header)
-    ws_unpaid.set_column(0, 0, 15)
+    if 'unpaid' in sheets:
+        ws_unpaid = workbook.add_worksheet(f"{sheet_prefix}Unpaid")
+        ws_unpaid.write(0, 0, "SSN", fmt_header)
+        ws_unpaid.set_column(0, 0, 15)
+    
+        current_col = 1
+        unpaid_ppc_cols = []
+        unpaid_plan_cols = []
+        unpaid_charles_cols = []
+        unpaid_harry_cols = []
+        unpaid_lighthouse_cols = []
     
-    current_col = 1
-    unpaid_ppc_cols = []
-    unpaid_plan_cols = []
-    unpaid_charles_cols = []
-    unpaid_harry_cols = []
-    unpaid_lighthouse_cols = []
-    
-    for i, p in enumerate(packets):
-        date_display = p['date'].strftime('%m/%d/%Y')
+        for i, p in enumerate(packets):
+            date_display = p['date'].strftime('%m/%d/%Y')
         
-        ws_unpaid.merge_range(0, current_col, 0, current_col + 4, date_display, fmt_date_header)
+            ws_unpaid.merge_range(0, current_col, 0, current_col + 4, date_display, fmt_date_header)
         
-        ws_unpaid.write(1, current_col, "PPC125", fmt_header)
-        ws_unpaid.write(1, current_col + 1, "Plan", fmt_header)
-        ws_unpaid.write(1, current_col + 2, "Charles", fmt_header)
-        ws_unpaid.write(1, current_col + 3, "Harry", fmt_header)
-        ws_unpaid.write(1, current_col + 4, "LightHouse", fmt_header)
+            ws_unpaid.write(1, current_col, "PPC125", fmt_header)
+            ws_unpaid.write(1, current_col + 1, "Plan", fmt_header)
+            ws_unpaid.write(1, current_col + 2, "Charles", fmt_header)
+            ws_unpaid.write(1, current_col + 3, "Harry", fmt_header)
+            ws_unpaid.write(1, current_col + 4, "LightHouse", fmt_header)
         
-        ws_unpaid.set_column(current_col, current_col, 12)
-        ws_unpaid.set_column(current_col + 1, current_col + 1, 12)
-        ws_unpaid.set_column(current_col + 2, current_col + 4, 11)
+            ws_unpaid.set_column(current_col, current_col, 12)
+            ws_unpaid.set_column(current_col + 1, current_col + 1, 12)
+            ws_unpaid.set_column(current_col + 2, current_col + 4, 11)
         
-        unpaid_ppc_cols.append(current_col)
-        unpaid_plan_cols.append(current_col + 1)
-        unpaid_charles_cols.append(current_col + 2)
-        unpaid_harry_cols.append(current_col + 3)
-        unpaid_lighthouse_cols.append(current_col + 4)
+            unpaid_ppc_cols.append(current_col)
+            unpaid_plan_cols.append(current_col + 1)
+            unpaid_charles_cols.append(current_col + 2)
+            unpaid_harry_cols.append(current_col + 3)
+            unpaid_lighthouse_cols.append(current_col + 4)
         
-        current_col += 5
+            current_col += 5
     
-    sorted_imperfect = sorted([emp[0] for emp in imperfect_employees])
+        reason_col = current_col
+        ws_unpaid.write(1, reason_col, "Reason", fmt_header)
+        ws_unpaid.set_column(reason_col, reason_col, 45)
     
-    for row_num, ssn in enumerate(sorted_imperfect):
-        excel_row = row_num + 2
-        ws_unpaid.write_string(row_num + 2, 0, ssn, fmt_text)
+        # master_ssn is already sorted, so the masked SSNs/bitmaps stay aligned
+        sorted_imperfect = imperfect_employees
+        imperfect_amounts = matrix['amounts'][imperfect_mask]
+    
+        for row_num, ssn in enumerate(sorted_imperfect):
+            excel_row = row_num + 2
+            ws_unpaid.write_string(row_num + 2, 0, ssn, fmt_text)
+            ws_unpaid.write_string(row_num + 2, reason_col, format_missed_weeks(missed_bitmaps[row_num], packets))
         
-        for i, p in enumerate(packets):
-            tab_date = f"{p['date'].month}.{p['date'].day}"
+            for i, p in enumerate(packets):
+                tab_date = f"{p['date'].month}.{p['date'].day}"
             
-            vlookup = f'=IFERROR(VLOOKUP($A{excel_row+1},\'{tab_date}\'!A:B,2,FALSE),0)'
-            ws_unpaid.write_formula(row_num + 2, unpaid_ppc_cols[i], vlookup, fmt_currency)
+                if 'dates' in sheets:
+                    vlookup = ppc_lookup_formula(f"$A{excel_row+1}", tab_date, week_reversals[i], lookup_client)
+                    ws_unpaid.write_formula(row_num + 2, unpaid_ppc_cols[i], vlookup, fmt_currency)
+                else:
+                    ws_unpaid.write_number(row_num + 2, unpaid_ppc_cols[i], -abs(imperfect_amounts[row_num, i]), fmt_currency)
             
-            ppc_cell = xl_rowcol_to_cell(row_num + 2, unpaid_ppc_cols[i])
+                ppc_cell = xl_rowcol_to_cell(row_num + 2, unpaid_ppc_cols[i])
             
-            if freq_name == "Weekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=360,"Plan 1600",IF(ABS({ppc_cell})>=315,"Plan 1400",IF(ABS({ppc_cell})>=270,"Plan 1200",IF(ABS({ppc_cell})>=220,"Plan 1000",""))))'
-            elif freq_name == "BiWeekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=720,"Plan 1600",IF(ABS({ppc_cell})>=630,"Plan 1400",IF(ABS({ppc_cell})>=540,"Plan 1200",IF(ABS({ppc_cell})>=450,"Plan 1000",""))))'
-            elif freq_name == "SemiMonthly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=780,"Plan 1600",IF(ABS({ppc_cell})>=680,"Plan 1400",IF(ABS({ppc_cell})>=580,"Plan 1200",IF(ABS({ppc_cell})>=480,"Plan 1000",""))))'
-            else:  # Monthly
-                plan_formula = f'=IF(ABS({ppc_cell})>=1550,"Plan 1600",IF(ABS({ppc_cell})>=1350,"Plan 1400",IF(ABS({ppc_cell})>=1150,"Plan 1200",IF(ABS({ppc_cell})>=950,"Plan 1000",""))))'
+                plan_formula = plan_level_formula(ppc_cell, p['freq_name'])
             
-            ws_unpaid.write_formula(row_num + 2, unpaid_plan_cols[i], plan_formula)
+                ws_unpaid.write_formula(row_num + 2, unpaid_plan_cols[i], plan_formula)
             
-            plan_cell = xl_rowcol_to_cell(row_num + 2, unpaid_plan_cols[i])
+                plan_cell = xl_rowcol_to_cell(row_num + 2, unpaid_plan_cols[i])
             
-            charles_formula = f'=IF({plan_cell}="Plan 1600",15*12/{freq_val},IF({plan_cell}="Plan 1400",10*12/{freq_val},IF({plan_cell}="Plan 1200",5*12/{freq_val},IF({plan_cell}="Plan 1000",1.5*12/{freq_val},0))))'
-            harry_formula = f'=IF({plan_cell}="Plan 1600",97*12/{freq_val},IF({plan_cell}="Plan 1400",78*12/{freq_val},IF({plan_cell}="Plan 1200",60*12/{freq_val},IF({plan_cell}="Plan 1000",25*12/{freq_val},0))))'
-            lighthouse_formula = f'=IF({plan_cell}="Plan 1600",25*12/{freq_val},IF({plan_cell}="Plan 1400",20*12/{freq_val},IF({plan_cell}="Plan 1200",15*12/{freq_val},IF({plan_cell}="Plan 1000",2*12/{freq_val},0))))'
+                charles_formula = plan_rate_formula(plan_cell, HARRY_MAIN_AGENT_RATES['Charles'], week_freqs[i])
+                harry_formula = plan_rate_formula(plan_cell, HARRY_MAIN_AGENT_RATES['Harry'], week_freqs[i])
+                lighthouse_formula = plan_rate_formula(plan_cell, HARRY_MAIN_AGENT_RATES['LightHouse'], week_freqs[i])
             
-            ws_unpaid.write_formula(row_num + 2, unpaid_charles_cols[i], charles_formula, fmt_charles)
-            ws_unpaid.write_formula(row_num + 2, unpaid_harry_cols[i], harry_formula, fmt_harry)
-            ws_unpaid.write_formula(row_num + 2, unpaid_lighthouse_cols[i], lighthouse_formula, fmt_lighthouse)
+                ws_unpaid.write_formula(row_num + 2, unpaid_charles_cols[i], charles_formula, fmt_charles)
+                ws_unpaid.write_formula(row_num + 2, unpaid_harry_cols[i], harry_formula, fmt_harry)
+                ws_unpaid.write_formula(row_num + 2, unpaid_lighthouse_cols[i], lighthouse_formula, fmt_lighthouse)
+    
+        unpaid_agent_cols = dict(zip(HARRY_MAIN_AGENT_RATES, (unpaid_charles_cols, unpaid_harry_cols, unpaid_lighthouse_cols)))
+        unpaid_last_row = len(sorted_imperfect) + 2
+    
+        # Prorated: what the unpaid employees' paid weeks add to each agent's grand total
+        if prorated:
+            ws_unpaid.write(unpaid_last_row + 2, 0, "Weekly Totals", fmt_total_header)
+            fmt_weekly_total = get_format(workbook, 'weekly_total')
+            for cols in unpaid_agent_cols.values():
+                for col in cols:
+                    ws_unpaid.write_formula(unpaid_last_row + 2, col,
+                        f'=SUM({xl_col_to_name(col)}3:{xl_col_to_name(col)}{unpaid_last_row})', fmt_weekly_total)
+    
+    summary = {
+        'commissions_sheet': None,
+        'grand_total_cells': {},
+        'downline_cells': [],
+        'num_weeks': num_weeks,
+        'total_employees': len(master_ssn),
+        'perfect': len(perfect_employees),
+        'imperfect': len(imperfect_employees),
+        'proration': policy
+    }
+    if not sheets & {'commissions', 'totals', 'downline'}:
+        return summary
     
     # Step 3: Create Commissions Dashboard
-    ws_comm = workbook.add_worksheet("Commissions")
+    ws_comm = workbook.add_worksheet(f"{sheet_prefix}Commissions")
+    summary['commissions_sheet'] = ws_comm.get_name()
     workbook.worksheets_objs.insert(0, workbook.worksheets_objs.pop())
-    workbook.worksheets_objs.insert(1, workbook.worksheets_objs.pop(-1))
-    
-    ws_comm.freeze_panes(1, 1)
-    ws_comm.write(0, 0, "SSN", fmt_header)
-    ws_comm.set_column(0, 0, 15)
-    
-    # Build column structure
-    current_col = 1
-    ppc_cols = []
-    plan_cols = []
-    charles_cols = []
-    harry_cols = []
-    lighthouse_cols = []
+    if 'unpaid' in sheets:
+        workbook.worksheets_objs.insert(1, workbook.worksheets_objs.pop(-1))
+    
+    # Plan levels / commissions in Python, for the sections written as values
+    if 'commissions' not in sheets:
+        perfect_levels = plan_levels_from_values(matrix['plan_values'][perfect_mask], matrix['freq_names'])
+    
+    # Employee grid: PPC125 / Plan / per-agent commission for every week
+    if 'commissions' in sheets:
+        ws_comm.freeze_panes(1, 1)
+        ws_comm.write(0, 0, "SSN", fmt_header)
+        ws_comm.set_column(0, 0, 15)
+    
+        # Build column structure
+        current_col = 1
+        ppc_cols = []
+        plan_cols = []
+        charles_cols = []
+        harry_cols = []
+        lighthouse_cols = []
     
-    for i, p in enumerate(packets):
-        tab_date = f"{p['date'].month}.{p['date'].day}"
-        date_display = p['date'].strftime('%m/%d/%Y')
+        for i, p in enumerate(packets):
+            tab_date = f"{p['date'].month}.{p['date'].day}"
+            date_display = p['date'].strftime('%m/%d/%Y')
         
-        ws_comm.merge_range(0, current_col, 0, current_col + 4, date_display, fmt_date_header)
+            ws_comm.merge_range(0, current_col, 0, current_col + 4, date_display, fmt_date_header)
         
-        ws_comm.write(1, current_col, "PPC125", fmt_header)
-        ws_comm.write(1, current_col + 1, "Plan", fmt_header)
-        ws_comm.write(1, current_col + 2, "Charles", fmt_header)
-        ws_comm.write(1, current_col + 3, "Harry", fmt_header)
-        ws_comm.write(1, current_col + 4, "LightHouse", fmt_header)
+            ws_comm.write(1, current_col, "PPC125", fmt_header)
+            ws_comm.write(1, current_col + 1, "Plan", fmt_header)
+            ws_comm.write(1, current_col + 2, "Charles", fmt_header)
+            ws_comm.write(1, current_col + 3, "Harry", fmt_header)
+            ws_comm.write(1, current_col + 4, "LightHouse", fmt_header)
         
-        ws_comm.set_column(current_col, current_col, 12)
-        ws_comm.set_column(current_col + 1, current_col + 1, 12)
-        ws_comm.set_column(current_col + 2, current_col + 4, 11)
+            ws_comm.set_column(current_col, current_col, 12)
+            ws_comm.set_column(current_col + 1, current_col + 1, 12)
+            ws_comm.set_column(current_col + 2, current_col + 4, 11)
         
-        ppc_cols.append(current_col)
-        plan_cols.append(current_col + 1)
-        charles_cols.append(current_col + 2)
-        harry_cols.append(current_col + 3)
-        lighthouse_cols.append(current_col + 4)
+            ppc_cols.append(current_col)
+            plan_cols.append(current_col + 1)
+            charles_cols.append(current_col + 2)
+            harry_cols.append(current_col + 3)
+            lighthouse_cols.append(current_col + 4)
         
-        current_col += 5
+            current_col += 5
     
-    # Write perfect employees
-    sorted_ssns = sorted(perfect_employees, key=lambda ssn: (-employee_plan_levels.get(ssn, 0), ssn))
+        # Write perfect employees
+        perfect_order = np.lexsort((perfect_employees, -perfect_plan_levels))
+        sorted_ssns = perfect_employees[perfect_order]
+        sorted_amounts = matrix['amounts'][perfect_mask][perfect_order]
     
-    for row_num, ssn in enumerate(sorted_ssns):
-        excel_row = row_num + 2
-        ws_comm.write_string(row_num + 2, 0, ssn, fmt_text)
+        for row_num, ssn in enumerate(sorted_ssns):
+            excel_row = row_num + 2
+            ws_comm.write_string(row_num + 2, 0, ssn, fmt_text)
         
-        for i, p in enumerate(packets):
-            tab_date = f"{p['date'].month}.{p['date'].day}"
+            for i, p in enumerate(packets):
+                tab_date = f"{p['date'].month}.{p['date'].day}"
             
-            vlookup = f'=IFERROR(VLOOKUP($A{excel_row+1},\'{tab_date}\'!A:B,2,FALSE),0)'
-            ws_comm.write_formula(row_num + 2, ppc_cols[i], vlookup, fmt_currency)
+                if 'dates' in sheets:
+                    vlookup = ppc_lookup_formula(f"$A{excel_row+1}", tab_date, week_reversals[i], lookup_client)
+                    ws_comm.write_formula(row_num + 2, ppc_cols[i], vlookup, fmt_currency)
+                else:
+                    ws_comm.write_number(row_num + 2, ppc_cols[i], -abs(sorted_amounts[row_num, i]), fmt_currency)
             
-            ppc_cell = xl_rowcol_to_cell(row_num + 2, ppc_cols[i])
+                ppc_cell = xl_rowcol_to_cell(row_num + 2, ppc_cols[i])
             
-            if freq_name == "Weekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=360,"Plan 1600",IF(ABS({ppc_cell})>=315,"Plan 1400",IF(ABS({ppc_cell})>=270,"Plan 1200",IF(ABS({ppc_cell})>=220,"Plan 1000",""))))'
-            elif freq_name == "BiWeekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=720,"Plan 1600",IF(ABS({ppc_cell})>=630,"Plan 1400",IF(ABS({ppc_cell})>=540,"Plan 1200",IF(ABS({ppc_cell})>=450,"Plan 1000",""))))'
-            elif freq_name == "SemiMonthly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=780,"Plan 1600",IF(ABS({ppc_cell})>=680,"Plan 1400",IF(ABS({ppc_cell})>=580,"Plan 1200",IF(ABS({ppc_cell})>=480,"Plan 1000",""))))'
-            else:  # Monthly
-                plan_formula = f'=IF(ABS({ppc_cell})>=1550,"Plan 1600",IF(ABS({ppc_cell})>=1350,"Plan 1400",IF(ABS({ppc_cell})>=1150,"Plan 1200",IF(ABS({ppc_cell})>=950,"Plan 1000",""))))'
+                plan_formula = plan_level_formula(ppc_cell, p['freq_name'])
             
-            ws_comm.write_formula(row_num + 2, plan_cols[i], plan_formula)
+                ws_comm.write_formula(row_num + 2, plan_cols[i], plan_formula)
             
-            plan_cell = xl_rowcol_to_cell(row_num + 2, plan_cols[i])
+                plan_cell = xl_rowcol_to_cell(row_num + 2, plan_cols[i])
             
-            charles_formula = f'=IF({plan_cell}="Plan 1600",15*12/{freq_val},IF({plan_cell}="Plan 1400",10*12/{freq_val},IF({plan_cell}="Plan 1200",5*12/{freq_val},IF({plan_cell}="Plan 1000",1.5*12/{freq_val},0))))'
-            harry_formula = f'=IF({plan_cell}="Plan 1600",97*12/{freq_val},IF({plan_cell}="Plan 1400",78*12/{freq_val},IF({plan_cell}="Plan 1200",60*12/{freq_val},IF({plan_cell}="Plan 1000",25*12/{freq_val},0))))'
-            lighthouse_formula = f'=IF({plan_cell}="Plan 1600",25*12/{freq_val},IF({plan_cell}="Plan 1400",20*12/{freq_val},IF({plan_cell}="Plan 1200",15*12/{freq_val},IF({plan_cell}="Plan 1000",2*12/{freq_val},0))))'
+                charles_formula = plan_rate_formula(plan_cell, HARRY_MAIN_AGENT_RATES['Charles'], week_freqs[i])
+                harry_formula = plan_rate_formula(plan_cell, HARRY_MAIN_AGENT_RATES['Harry'], week_freqs[i])
+                lighthouse_formula = plan_rate_formula(plan_cell, HARRY_MAIN_AGENT_RATES['LightHouse'], week_freqs[i])
             
-            ws_comm.write_formula(row_num + 2, charles_cols[i], charles_formula, fmt_charles)
-            ws_comm.write_formula(row_num + 2, harry_cols[i], harry_formula, fmt_harry)
-            ws_comm.write_formula(row_num + 2, lighthouse_cols[i], lighthouse_formula, fmt_lighthouse)
+                ws_comm.write_formula(row_num + 2, charles_cols[i], charles_formula, fmt_charles)
+                ws_comm.write_formula(row_num + 2, harry_cols[i], harry_formula, fmt_harry)
+                ws_comm.write_formula(row_num + 2, lighthouse_cols[i], lighthouse_formula, fmt_lighthouse)
     
-    last_data_row = len(sorted_ssns) + 2
-    subtotal_row = last_data_row + 2
+        last_data_row = len(sorted_ssns) + 2
+        subtotal_row = last_data_row + 2
     
-    ws_comm.write(subtotal_row, 0, "Weekly Totals", fmt_total_header)
+        ws_comm.write(subtotal_row, 0, "Weekly Totals", fmt_total_header)
     
-    fmt_weekly_total = workbook.add_format({
-        'num_format': '$#,##0.00',
-        'bold': True,
-        'bg_color': '#FFE699',
-        'border': 1,
-        'top': 2
-    })
+        fmt_weekly_total = get_format(workbook, 'weekly_total')
     
-    for i in range(len(packets)):
-        charles_col = charles_cols[i]
-        harry_col = harry_cols[i]
-        lighthouse_col = lighthouse_cols[i]
-        
-        ws_comm.write_formula(subtotal_row, charles_col, 
-            f'=SUM({xl_col_to_name(charles_col)}3:{xl_col_to_name(charles_col)}{last_data_row})',
-            fmt_weekly_total)
-        ws_comm.write_formula(subtotal_row, harry_col,
-            f'=SUM({xl_col_to_name(harry_col)}3:{xl_col_to_name(harry_col)}{last_data_row})',
-            fmt_weekly_total)
-        ws_comm.write_formula(subtotal_row, lighthouse_col,
-            f'=SUM({xl_col_to_name(lighthouse_col)}3:{xl_col_to_name(lighthouse_col)}{last_data_row})',
-            fmt_weekly_total)
+        for i in range(len(packets)):
+            charles_col = charles_cols[i]
+            harry_col = harry_cols[i]
+            lighthouse_col = lighthouse_cols[i]
+        
+            ws_comm.write_formula(subtotal_row, charles_col, 
+                f'=SUM({xl_col_to_name(charles_col)}3:{xl_col_to_name(charles_col)}{last_data_row})',
+                fmt_weekly_total)
+            ws_comm.write_formula(subtotal_row, harry_col,
+                f'=SUM({xl_col_to_name(harry_col)}3:{xl_col_to_name(harry_col)}{last_data_row})',
+                fmt_weekly_total)
+            ws_comm.write_formula(subtotal_row, lighthouse_col,
+                f'=SUM({xl_col_to_name(lighthouse_col)}3:{xl_col_to_name(lighthouse_col)}{last_data_row})',
+                fmt_weekly_total)
+        
+        totals_col = current_col + 1
+    else:
+        totals_col = 0
     
     # Step 4: Grand Totals
-    totals_col = current_col + 1
-    
-    ws_comm.write(0, totals_col, "GRAND TOTALS", fmt_total_header)
-    ws_comm.write(1, totals_col, "Charles", fmt_total_header)
-    ws_comm.write(1, totals_col + 1, "Harry", fmt_total_header)
-    ws_comm.write(1, totals_col + 2, "LightHouse", fmt_total_header)
-    
-    def build_sum_formula(cols):
-        ranges = []
-        for c in cols:
-            col_letter = xl_col_to_name(c)
-            ranges.append(f"{col_letter}3:{col_letter}{last_data_row}")
-        return f"=SUM({','.join(ranges)})"
-    
-    ws_comm.write_formula(2, totals_col, build_sum_formula(charles_cols), fmt_total_value)
-    ws_comm.write_formula(2, totals_col + 1, build_sum_formula(harry_cols), fmt_total_value)
-    ws_comm.write_formula(2, totals_col + 2, build_sum_formula(lighthouse_cols), fmt_total_value)
+    if 'totals' in sheets:
+        ws_comm.write(0, totals_col, "GRAND TOTALS", fmt_total_header)
+        ws_comm.write(1, totals_col, "Charles", fmt_total_header)
+        ws_comm.write(1, totals_col + 1, "Harry", fmt_total_header)
+        ws_comm.write(1, totals_col + 2, "LightHouse", fmt_total_header)
+    
+        def build_sum_formula(cols, last_row=None, sheet=""):
+            ranges = []
+            for c in cols:
+                col_letter = xl_col_to_name(c)
+                ranges.append(f"{sheet}{col_letter}3:{col_letter}{last_row or last_data_row}")
+            return f"SUM({','.join(ranges)})"
+    
+        if 'commissions' in sheets:
+            agent_cols = (charles_cols, harry_cols, lighthouse_cols)
+            for offset, (agent, cols) in enumerate(zip(HARRY_MAIN_AGENT_RATES, agent_cols)):
+                formula = build_sum_formula(cols)
+                if prorated and 'unpaid' in sheets:
+                    unpaid_sheet = "'" + ws_unpaid.get_name().replace("'", "''") + "'!"
+                    formula += '+' + build_sum_formula(unpaid_agent_cols[agent], unpaid_last_row, unpaid_sheet)
+                elif prorated:
+                    formula += f'+{unpaid_totals[agent]}'
+                ws_comm.write_formula(2, totals_col + offset, '=' + formula, fmt_total_value)
+        else:
+            for offset, (agent, rates) in enumerate(HARRY_MAIN_AGENT_RATES.items()):
+                total = agent_commission_matrix(perfect_levels, week_freqs, rates).sum() + unpaid_totals.get(agent, 0)
+                ws_comm.write_number(2, totals_col + offset, total, fmt_total_value)
+        summary['grand_total_cells'] = {
+            agent: xl_rowcol_to_cell(2, totals_col + offset)
+            for offset, agent in enumerate(HARRY_MAIN_AGENT_RATES)
+        }
     
-    ws_comm.set_column(totals_col, totals_col + 2, 18)
+        ws_comm.set_column(totals_col, totals_col + 2, 18)
     
     # ==============================================================================
     # Step 5: PLAN COUNTING SECTION
@@ -742,190 +1893,172 @@ def build_harry_group_report(packets, selected_client=None, group_type=GROUP_TYP
     plan_count_start_row = 5
     plan_count_col = totals_col
     
-    fmt_plan_count_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#FFF2CC',
-        'border': 1,
-        'align': 'center',
-        'font_size': 11
-    })
-    fmt_plan_count_value = workbook.add_format({
-        'bold': True,
-        'bg_color': '#FFF2CC',
-        'border': 1,
-        'align': 'center',
-        'font_size': 11
-    })
+    fmt_plan_count_header = get_format(workbook, 'plan_count_header')
+    fmt_plan_count_value = get_format(workbook, 'plan_count_value')
     
     ws_comm.merge_range(plan_count_start_row, plan_count_col, plan_count_start_row, plan_count_col + 2, 
                         "PLAN COUNTING", fmt_plan_count_header)
     
-    # Build plan counting formulas based on number of weeks
-    if num_weeks == 2:
-        ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
-                           "BiWeekly - 2 Payroll Weeks", fmt_header)
-        ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
-        ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
-        
-        if len(plan_cols) >= 2:
-            col_C = xl_col_to_name(plan_cols[0])
-            col_I = xl_col_to_name(plan_cols[1])
-            
-            plan_1000_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_I}3:{col_I}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
-            
-            other_plans_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_I}3:{col_I}{last_data_row})))=0),--((ISNUMBER(SEARCH("Plan 1200",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_C}3:{col_C}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_I}3:{col_I}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
-    
-    elif num_weeks == 3:
-        ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
-                           "BiWeekly - 3 Payroll Weeks", fmt_header)
-        ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
-        ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
-        
-        if len(plan_cols) >= 3:
-            col_C = xl_col_to_name(plan_cols[0])
-            col_I = xl_col_to_name(plan_cols[1])
-            col_O = xl_col_to_name(plan_cols[2])
-            
-            plan_1000_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_O}3:{col_O}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
-            
-            other_plans_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_O}3:{col_O}{last_data_row})))=0),--((ISNUMBER(SEARCH("Plan 1200",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_C}3:{col_C}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_I}3:{col_I}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_O}3:{col_O}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_O}3:{col_O}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_O}3:{col_O}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
-    
-    elif num_weeks == 4:
-        ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
-                           "Weekly - 4 Payroll Weeks", fmt_header)
-        ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
-        ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
-        
-        if len(plan_cols) >= 4:
-            col_C = xl_col_to_name(plan_cols[0])
-            col_I = xl_col_to_name(plan_cols[1])
-            col_O = xl_col_to_name(plan_cols[2])
-            col_U = xl_col_to_name(plan_cols[3])
-            
-            plan_1000_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_O}3:{col_O}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_U}3:{col_U}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
-            
-            other_plans_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_O}3:{col_O}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_U}3:{col_U}{last_data_row})))=0),--((ISNUMBER(SEARCH("Plan 1200",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_C}3:{col_C}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_C}3:{col_C}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_I}3:{col_I}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_I}3:{col_I}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_O}3:{col_O}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_O}3:{col_O}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_O}3:{col_O}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_U}3:{col_U}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_U}3:{col_U}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_U}3:{col_U}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
+    # Build plan counting formulas for however many weeks the period has
+    ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
+                       f"{PLAN_COUNT_LABELS.get(num_weeks, freq_name)} - {num_weeks} Payroll Weeks", fmt_header)
+    ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
+    ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
+    
+    if 'commissions' in sheets:
+        plan_1000_formula, other_plans_formula = plan_counting_formulas(plan_cols, last_data_row)
+        ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
+        ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
+    else:
+        plan_1000_count, other_plans_count = count_plan_groups(perfect_levels)
+        ws_comm.write_number(plan_count_start_row + 2, plan_count_col + 1, plan_1000_count, fmt_plan_count_value)
+        ws_comm.write_number(plan_count_start_row + 3, plan_count_col + 1, other_plans_count, fmt_plan_count_value)
+    if prorated:
+        write_prorated_counts(ws_comm, plan_count_start_row, plan_count_col, prorated_counts,
+                              fmt_plan_count_header, fmt_plan_count_value)
     
     # ==============================================================================
     # Step 6: HARRY'S DOWNLINE SECTION
     # ==============================================================================
     
-    downline_start_row = plan_count_start_row + 6
-    downline_col = totals_col
-    
-    fmt_downline_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#C6E0B4',
-        'border': 1,
-        'align': 'center',
-        'font_size': 12
-    })
-    fmt_downline_client = workbook.add_format({
-        'bold': True,
-        'bg_color': '#E2EFDA',
-        'border': 1,
-        'align': 'left'
-    })
-    fmt_downline_agent = workbook.add_format({
-        'bg_color': '#F4F7F0',
-        'border': 1,
-        'align': 'left',
-        'indent': 1
-    })
-    fmt_downline_commission = workbook.add_format({
-        'num_format': '$#,##0.00',
-        'bg_color': '#E2EFDA',
-        'border': 1
-    })
+    if 'downline' in sheets:
+        downline_start_row = plan_count_start_row + 6
+        downline_col = totals_col
     
-    # Determine which rates to use based on group type and write header
-    if group_type == GROUP_TYPE_ADAM:
-        group_rates = ADAMS_GROUP_AGENTS
-        group_name = "Adam's Group Brokers"
-        ws_comm.merge_range(downline_start_row, downline_col, downline_start_row, downline_col + 3, 
-                            "ADAM'S GROUP COMMISSIONS", fmt_downline_header)
-    else:
-        group_rates = HARRY_DOWNLINE_RATES
-        group_name = "Harry's Downline"
-        ws_comm.merge_range(downline_start_row, downline_col, downline_start_row, downline_col + 3, 
-                            "HARRY'S DOWNLINE COMMISSIONS", fmt_downline_header)
+        fmt_downline_header = get_format(workbook, 'downline_header')
+        fmt_downline_client = get_format(workbook, 'downline_client')
+        fmt_downline_agent = get_format(workbook, 'downline_agent')
+        fmt_downline_commission = get_format(workbook, 'downline_commission')
+    
+        # Determine which rates to use based on group type and write header
+        if group_type == GROUP_TYPE_ADAM:
+            group_rates = ADAMS_GROUP_AGENTS
+            group_name = "Adam's Group Brokers"
+            ws_comm.merge_range(downline_start_row, downline_col, downline_start_row, downline_col + 3, 
+                                "ADAM'S GROUP COMMISSIONS", fmt_downline_header)
+        else:
+            group_rates = HARRY_DOWNLINE_RATES
+            group_name = "Harry's Downline"
+            ws_comm.merge_range(downline_start_row, downline_col, downline_start_row, downline_col + 3, 
+                                "HARRY'S DOWNLINE COMMISSIONS", fmt_downline_header)
     
-    current_downline_row = downline_start_row + 2
+        current_downline_row = downline_start_row + 2
     
-    ws_comm.write(current_downline_row, downline_col, "Client/Agent", fmt_header)
-    ws_comm.write(current_downline_row, downline_col + 1, "Plan 1000 Count", fmt_header)
-    ws_comm.write(current_downline_row, downline_col + 2, "Other Plans Count", fmt_header)
-    ws_comm.write(current_downline_row, downline_col + 3, "Commission", fmt_header)
+        ws_comm.write(current_downline_row, downline_col, "Client/Agent", fmt_header)
+        ws_comm.write(current_downline_row, downline_col + 1, "Plan 1000 Count", fmt_header)
+        ws_comm.write(current_downline_row, downline_col + 2, "Other Plans Count", fmt_header)
+        ws_comm.write(current_downline_row, downline_col + 3, "Commission", fmt_header)
     
-    ws_comm.set_column(downline_col, downline_col, 25)
-    ws_comm.set_column(downline_col + 1, downline_col + 2, 18)
-    ws_comm.set_column(downline_col + 3, downline_col + 3, 15)
+        ws_comm.set_column(downline_col, downline_col, 25)
+        ws_comm.set_column(downline_col + 1, downline_col + 2, 18)
+        ws_comm.set_column(downline_col + 3, downline_col + 3, 15)
     
-    current_downline_row += 1
+        current_downline_row += 1
     
-    # Process each client in Harry's downline OR agent in Adam's group
-    if group_type == GROUP_TYPE_ADAM:
-        # For Adam's Group: No client layer, just agents
-        for agent_name, rates in group_rates.items():
-            ws_comm.write(current_downline_row, downline_col, agent_name, fmt_downline_agent)
+        # Process each client in Harry's downline OR agent in Adam's group
+        if group_type == GROUP_TYPE_ADAM:
+            # For Adam's Group: No client layer, just agents
+            for agent_name, rates in group_rates.items():
+                ws_comm.write(current_downline_row, downline_col, agent_name, fmt_downline_agent)
             
-            # Reference to plan count cells
-            plan_1000_count_cell = xl_rowcol_to_cell(plan_count_start_row + 2, plan_count_col + 1)
-            other_plans_count_cell = xl_rowcol_to_cell(plan_count_start_row + 3, plan_count_col + 1)
+                # Agent's own book when attributed, otherwise the group-wide plan count cells
+                plan_1000_count_cell, other_plans_count_cell = write_downline_counts(
+                    ws_comm, current_downline_row, downline_col, agent_books.get(agent_name),
+                    plan_count_start_row, plan_count_col, fmt_plan_count_value, prorated)
             
-            # Show counts
-            ws_comm.write_formula(current_downline_row, downline_col + 1, f'={plan_1000_count_cell}', fmt_plan_count_value)
-            ws_comm.write_formula(current_downline_row, downline_col + 2, f'={other_plans_count_cell}', fmt_plan_count_value)
+                # Calculate commission using individual plan rates
+                rate_1000 = get_rate_for_plan(rates, '1000')
+                rate_1600 = get_rate_for_plan(rates, '1600')
             
-            # Calculate commission using individual plan rates
-            rate_1000 = get_rate_for_plan(rates, '1000')
-            rate_1600 = get_rate_for_plan(rates, '1600')
-            
-            commission_formula = f'=({plan_1000_count_cell}*{rate_1000})+({other_plans_count_cell}*{rate_1600})'
-            ws_comm.write_formula(current_downline_row, downline_col + 3, commission_formula, fmt_downline_commission)
+                commission_formula = f'=({plan_1000_count_cell}*{rate_1000})+({other_plans_count_cell}*{rate_1600})'
+                ws_comm.write_formula(current_downline_row, downline_col + 3, commission_formula, fmt_downline_commission)
+                summary['downline_cells'].append(xl_rowcol_to_cell(current_downline_row, downline_col + 3))
             
-            current_downline_row += 1
-    else:
-        # For Harry's Group: Iterate clients and their agents
-        clients_to_process = group_rates.items()
-        if selected_client and selected_client in group_rates:
-            clients_to_process = [(selected_client, group_rates[selected_client])]
+                current_downline_row += 1
+        else:
+            # For Harry's Group: Iterate clients and their agents
+            clients_to_process = group_rates.items()
+            if selected_client and selected_client in group_rates:
+                clients_to_process = [(selected_client, group_rates[selected_client])]
         
-        for client_name, agents in clients_to_process:
-            ws_comm.write(current_downline_row, downline_col, client_name, fmt_downline_client)
-            current_downline_row += 1
+            for client_name, agents in clients_to_process:
+                ws_comm.write(current_downline_row, downline_col, client_name, fmt_downline_client)
+                current_downline_row += 1
             
-            for agent_name, rates in agents.items():
-                ws_comm.write(current_downline_row, downline_col, f"  {agent_name}", fmt_downline_agent)
+                for agent_name, rates in agents.items():
+                    ws_comm.write(current_downline_row, downline_col, f"  {agent_name}", fmt_downline_agent)
                 
-                # Reference to plan count cells
-                plan_1000_count_cell = xl_rowcol_to_cell(plan_count_start_row + 2, plan_count_col + 1)
-                other_plans_count_cell = xl_rowcol_to_cell(plan_count_start_row + 3, plan_count_col + 1)
+                    # Agent's own book when attributed, otherwise the group-wide plan count cells
+                    plan_1000_count_cell, other_plans_count_cell = write_downline_counts(
+                        ws_comm, current_downline_row, downline_col, agent_books.get(agent_name),
+                        plan_count_start_row, plan_count_col, fmt_plan_count_value, prorated)
                 
-                # Show counts
-                ws_comm.write_formula(current_downline_row, downline_col + 1, f'={plan_1000_count_cell}', fmt_plan_count_value)
-                ws_comm.write_formula(current_downline_row, downline_col + 2, f'={other_plans_count_cell}', fmt_plan_count_value)
+                    # Calculate commission with CONFIDENCE multipliers
+                    if client_name == 'CONFIDENCE' and num_weeks in CONFIDENCE_MULTIPLIERS:
+                        rate_1000 = CONFIDENCE_MULTIPLIERS[num_weeks]['1000']
+                        rate_other = CONFIDENCE_MULTIPLIERS[num_weeks]['other']
+                    else:
+                        rate_1000 = get_rate_for_plan(rates, '1000')
+                        rate_other = get_rate_for_plan(rates, '1600')
                 
-                # Calculate commission with CONFIDENCE multipliers
-                if client_name == 'CONFIDENCE' and num_weeks in CONFIDENCE_MULTIPLIERS:
-                    rate_1000 = CONFIDENCE_MULTIPLIERS[num_weeks]['1000']
-                    rate_other = CONFIDENCE_MULTIPLIERS[num_weeks]['other']
-                else:
-                    rate_1000 = get_rate_for_plan(rates, '1000')
-                    rate_other = get_rate_for_plan(rates, '1600')
+                    commission_formula = f'=({plan_1000_count_cell}*{rate_1000})+({other_plans_count_cell}*{rate_other})'
+                    ws_comm.write_formula(current_downline_row, downline_col + 3, commission_formula, fmt_downline_commission)
+                    summary['downline_cells'].append(xl_rowcol_to_cell(current_downline_row, downline_col + 3))
                 
-                commission_formula = f'=({plan_1000_count_cell}*{rate_1000})+({other_plans_count_cell}*{rate_other})'
-                ws_comm.write_formula(current_downline_row, downline_col + 3, commission_formula, fmt_downline_commission)
-                
-                current_downline_row += 1
+                    current_downline_row += 1
+    
+    
+    return summary
+
+def build_harry_group_report(packets, selected_client=None, group_type=GROUP_TYPE_HARRY, matrix=None, attribution=None,
+                             sheets=None, naming=None, deduction_codes=None, proration=None, history=None):
+    """
+    Build Excel report for Harry's Group or Adam's Group with client-based rates, plan counting, and downline commissions
+    
+    sheets: optional subset of SHEET_SECTIONS to write (e.g. ['totals', 'downline'] for a quick check)
+    naming: OUTPUT_NAMING_MODES entry used when the report file already exists
+    deduction_codes: extra DEDUCTION_CODES to commission on a 'Deduction Codes' sheet
+    proration: PRORATION_POLICIES entry for employees who missed a week (default all-or-nothing)
+    history: apply_commission_history() result for a 'Clawbacks' sheet
+    """
+    if not packets: 
+        print("❌ No valid data found.")
+        return
+    
+    # Include client name in filename if specified
+    filename = f"{get_report_basename(packets, group_type, {'selected_client': selected_client})}.xlsx"
+    output = start_output(filename, naming)
+    
+    workbook = xlsxwriter.Workbook(output['temp'], {'nan_inf_to_errors': True})
+    
+    if matrix is None:
+        matrix = build_payment_matrix(packets)
+
+    sheets = [section for section in SHEET_SECTIONS if section in (sheets or SHEET_SECTIONS)]
+    
+    # Step 1: Create date-named tabs
+    if 'dates' in sheets:
+        for i, p in enumerate(packets):
+            tab_date = f"{p['date'].month}.{p['date'].day}"
+            tab_name = tab_date[:31]
+            
+            ws = workbook.add_worksheet(tab_name)
+            ssns, amounts, reversed_rows = week_column(matrix, i)
+            write_date_tab(ws, p, ssns, amounts, workbook, reversed_rows)
+    
+    # Step 2-6: Unpaid tab, Commissions dashboard, plan counting and downline
+    summary = write_harry_sheets(workbook, packets, matrix, selected_client, group_type, attribution, sheets=sheets,
+                                 proration=proration)
+    
+    if 'codes' in sheets:
+        codes_config = {'selected_client': selected_client, 'deduction_codes': deduction_codes, 'proration': proration}
+        write_deduction_codes_sheet(workbook, packets, group_type, codes_config, matrix, attribution)
+    enrollment = write_enrollment_sheet(workbook, packets, matrix) if 'enrollment' in sheets else None
+    if history is not None and 'clawbacks' in sheets:
+        write_clawbacks_sheet(workbook, history)
     
     workbook.close()
+    filename = os.path.basename(finish_output(output))
     
     # Generate appropriate success message based on group type
     if group_type == GROUP_TYPE_ADAM:
@@ -938,27 +2071,209 @@ def build_harry_group_report(packets, selected_client=None, group_type=GROUP_TYP
         print(f"📊 Client{client_info}")
         num_agents = 1 if selected_client else len(HARRY_DOWNLINE_RATES)
     
-    print(f"📊 Frequency: {freq_name} (÷{freq_val})")
+    print(f"📊 Frequency: {frequency_label(packets)}")
     print(f"📅 Date Range: {packets[0]['date'].strftime('%m/%d/%Y')} - {packets[-1]['date'].strftime('%m/%d/%Y')}")
-    print(f"👥 Total Employees: {len(master_ssn)}")
-    print(f"✅ Perfect Employees: {len(perfect_employees)}")
-    print(f"❌ Imperfect Employees: {len(imperfect_employees)}")
+    print(f"👥 Total Employees: {summary['total_employees']}")
+    print(f"✅ Perfect Employees: {summary['perfect']}")
+    print(f"❌ Imperfect Employees: {summary['imperfect']}")
+    if enrollment:
+        print(f"🔄 Enrollment: {format_enrollment_counts(enrollment)}")
+    if len(sheets) < len(SHEET_SECTIONS):
+        print(f"🗂️ Sections written: {', '.join(sheets)}")
     print(f"📋 Features:")
-    print(f"   ✓ Plan Counting ({num_weeks} weeks)")
+    print(f"   ✓ Plan Counting ({summary['num_weeks']} weeks)")
     
     if group_type == GROUP_TYPE_ADAM:
         print(f"   ✓ Adam's Brokers Commissions ({num_agents} brokers)")
     else:
         print(f"   ✓ Harry's Downline Commissions ({num_agents} client{'s' if num_agents > 1 else ''})")
     
-    if selected_client == 'CONFIDENCE' and num_weeks in CONFIDENCE_MULTIPLIERS:
-        print(f"   ✓ CONFIDENCE multipliers applied for {num_weeks} weeks")
+    if selected_client == 'CONFIDENCE' and summary['num_weeks'] in CONFIDENCE_MULTIPLIERS:
+        print(f"   ✓ CONFIDENCE multipliers applied for {summary['num_weeks']} weeks")
+
+def find_client_folders(input_folder=None):
+    """
+    Client sub-folders of Input_Raw for the consolidated Harry's Group workbook
+    
+    Folder names are matched to HARRY_DOWNLINE_RATES case-insensitively
+    ('/' in a client name may be written as '-' or '_').
+    
+    Returns: {client_name: folder_path}
+    """
+    input_folder = input_folder or INPUT_FOLDER
+    known = {re.sub(r'[\s/_-]+', ' ', client).upper(): client for client in HARRY_DOWNLINE_RATES}
+    folders = {}
+    
+    for entry in sorted(os.listdir(input_folder)):
+        path = os.path.join(input_folder, entry)
+        if not os.path.isdir(path):
+            continue
+        client = known.get(re.sub(r'[\s/_-]+', ' ', entry).upper())
+        if client:
+            folders[client] = path
+        else:
+            print(f"⚠️ Skipping folder '{entry}': not a client in HARRY_DOWNLINE_RATES")
+    
+    return folders
+
+def load_client_partition(folder):
+    """Ingest one client's folder and build its payment matrix (runs in a worker process)"""
+    packets = process_raw_files(folder)
+    return packets, build_payment_matrix(packets) if packets else None
+
+def client_sheet_prefix(client, used):
+    """Short, sheet-name-safe prefix for a client ('Commissions' must still fit in 31 chars)"""
+    base = re.sub(r"[\[\]:*?/\\']", ' ', client)[:18].strip()
+    prefix = f"{base} "
+    n = 2
+    while prefix in used:
+        prefix = f"{base[:15]} {n} "
+        n += 1
+    used.add(prefix)
+    return prefix
+
+def build_consolidated_harry_report(config=None, input_folder=None):
+    """
+    One Harry's Group workbook for every client in Input_Raw/<client>/ sub-folders
+    
+    Each client's files are ingested and turned into its own payment matrix
+    in parallel; the workbook then gets shared date tabs (one row per client and
+    SSN for a pay date), a Commissions + Unpaid sheet pair per client with only
+    that client's downline (plus a Codes sheet when config['deduction_codes']
+    adds codes), and a ROLL-UP sheet summing every client.
+    
+    config['workers'] caps the number of loader processes (default: one per CPU).
+    Returns: {client: (packets, matrix)} of the clients that had data, or None
+    """
+    config = config or {}
+    client_folders = find_client_folders(input_folder)
+    if not client_folders:
+        print("❌ No client folders found (expected Input_Raw/<CLIENT NAME>/ with payroll files)")
+        return None
+    
+    print(f"\n📂 Loading {len(client_folders)} client(s) in parallel: {', '.join(client_folders)}")
+    from concurrent.futures import ProcessPoolExecutor
+    max_workers = min(len(client_folders), config.get('workers') or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        loaded = dict(zip(client_folders, pool.map(load_client_partition, client_folders.values())))
+    
+    partitions = {client: part for client, part in loaded.items() if part[0]}
+    for client in loaded.keys() - partitions.keys():
+        print(f"⚠️ {client}: no valid payroll files, left out of the workbook")
+    if not partitions:
+        print("❌ No valid data found.")
+        return None
+    
+    assignments_path = config.get('assignments')
+    if not assignments_path and os.path.exists(ASSIGNMENTS_FILE):
+        assignments_path = ASSIGNMENTS_FILE
+    assignments = load_agent_assignments(assignments_path) if assignments_path else None
+    
+    if config.get('history'):
+        print("ℹ️ Commission history and clawbacks are tracked per client report; the consolidated workbook skips them")
+    
+    all_packets = sorted((p for packets, _ in partitions.values() for p in packets), key=lambda p: p['date'])
+    report_date = all_packets[0]['date']
+    filename = f"Commission_Report_Harry_All_Clients_{report_date.strftime('%B_%Y')}.xlsx"
+    output = start_output(filename, config.get('naming'))
+    
+    workbook = xlsxwriter.Workbook(output['temp'], {'nan_inf_to_errors': True})
+    
+    # Shared date tabs: every client's deductions for a pay date on one tab
+    date_tabs = []
+    weeks_by_tab = {}
+    for client, (packets, matrix) in partitions.items():
+        for i, p in enumerate(packets):
+            tab_date = f"{p['date'].month}.{p['date'].day}"
+            ssns, amounts, reversed_rows = week_column(matrix, i)
+            weeks_by_tab.setdefault(tab_date, (p, []))[1].append(
+                pd.DataFrame({'ssn': ssns, 'amount': amounts, 'reversed': reversed_rows, 'client': client}))
+    
+    # One row per client and SSN: the client sheets look up on both, so an employee
+    # on two clients' payrolls keeps each client's own deduction
+    for tab_date, (packet, frames) in sorted(weeks_by_tab.items(), key=lambda item: item[1][0]['date']):
+        week = pd.concat(frames, ignore_index=True).sort_values(['ssn', 'client'], kind='stable')
+        shared = week.loc[week['ssn'].duplicated(keep=False), 'ssn'].nunique()
+        if shared:
+            print(f"⚠️ {tab_date}: {shared} SSN(s) are on more than one client's payroll; each client uses its own row")
+        ws = workbook.add_worksheet(tab_date[:31])
+        write_date_tab(ws, packet, week['ssn'].to_numpy(), week['amount'].to_numpy(), workbook,
+                       week['reversed'].to_numpy(), clients=week['client'].to_numpy())
+        date_tabs.append(ws)
+    
+    # Per-client Unpaid + Commissions (+ Codes when extra deduction codes are commissioned) sheets
+    used_prefixes = set()
+    summaries = {}
+    for client, (packets, matrix) in partitions.items():
+        attribution = attribute_employees(matrix, assignments) if assignments is not None else None
+        sheet_prefix = client_sheet_prefix(client, used_prefixes)
+        summaries[client] = write_harry_sheets(workbook, packets, matrix, client, GROUP_TYPE_HARRY, attribution,
+                                               sheet_prefix=sheet_prefix, proration=proration_policy(config),
+                                               shared_date_tabs=True)
+        write_deduction_codes_sheet(workbook, packets, GROUP_TYPE_HARRY, dict(config, selected_client=client),
+                                    matrix, attribution, sheet_name=f"{sheet_prefix}Codes")
+    
+    # ROLL-UP: one row per client, linked to each client's grand totals and downline
+    ws_roll = workbook.add_worksheet("ROLL-UP")
+    fmt_header = get_format(workbook, 'header')
+    fmt_total_header = get_format(workbook, 'total_header')
+    fmt_total_value = get_format(workbook, 'total_value')
+    fmt_currency = get_format(workbook, 'currency')
+    
+    roll_headers = ["Client", "Employees", "Perfect", "Unpaid"] + list(HARRY_MAIN_AGENT_RATES) + ["Downline"]
+    ws_roll.write_row(0, 0, roll_headers, fmt_header)
+    ws_roll.set_column(0, 0, 30)
+    ws_roll.set_column(1, len(roll_headers) - 1, 14)
+    
+    for row, (client, summary) in enumerate(summaries.items(), 1):
+        sheet = summary['commissions_sheet'].replace("'", "''")
+        ws_roll.write(row, 0, client)
+        ws_roll.write_row(row, 1, [summary['total_employees'], summary['perfect'], summary['imperfect']])
+        for col, agent in enumerate(HARRY_MAIN_AGENT_RATES, 4):
+            ws_roll.write_formula(row, col, f"='{sheet}'!{summary['grand_total_cells'][agent]}", fmt_currency)
+        downline = '+'.join(f"'{sheet}'!{cell}" for cell in summary['downline_cells']) or '0'
+        ws_roll.write_formula(row, len(roll_headers) - 1, f"={downline}", fmt_currency)
+    
+    total_row = len(summaries) + 1
+    ws_roll.write(total_row, 0, "ALL CLIENTS", fmt_total_header)
+    for col in range(1, len(roll_headers)):
+        col_name = xl_col_to_name(col)
+        ws_roll.write_formula(total_row, col, f"=SUM({col_name}2:{col_name}{total_row})",
+                              fmt_total_value if col >= 4 else fmt_total_header)
+    
+    # Sheet order: ROLL-UP, each client's Commissions/Unpaid, then the shared date tabs
+    client_sheets = [ws for ws in workbook.worksheets_objs if ws not in date_tabs and ws is not ws_roll]
+    client_sheets.sort(key=lambda ws: (ws.get_name().rsplit(' ', 1)[0], ws.get_name().endswith('Unpaid')))
+    workbook.worksheets_objs[:] = [ws_roll] + client_sheets + date_tabs
+    workbook.close()
+    filename = os.path.basename(finish_output(output))
+    
+    print(f"\n✅ CONSOLIDATED HARRY'S GROUP REPORT GENERATED: {filename}")
+    print(f"📅 Date Range: {all_packets[0]['date'].strftime('%m/%d/%Y')} - {all_packets[-1]['date'].strftime('%m/%d/%Y')}")
+    for client, summary in summaries.items():
+        print(f"   • {client}: {summary['perfect']} perfect / {summary['imperfect']} unpaid "
+              f"({frequency_label(partitions[client][0])})")
+    
+    exports = config.get('exports')
+    if exports:
+        written = []
+        for client, (packets, matrix) in partitions.items():
+            attribution = attribute_employees(matrix, assignments) if assignments is not None else None
+            model = build_commission_model(packets, GROUP_TYPE_HARRY, dict(config, selected_client=client),
+                                           matrix=matrix, attribution=attribution)
+            written += export_commission_model(model, exports)
+        if written:
+            print(f"\n📤 Data extracts written: {len(written)} file(s)")
+    if config.get('statements'):
+        print("ℹ️ Agent statements are written per client report (run without --all-clients); skipping")
+    
+    return partitions
 
 # ==============================================================================
 # 4. DYNAMIC GROUP REPORT BUILDER
 # ==============================================================================
 
-def build_dynamic_group_report(packets, group_config):
+def build_dynamic_group_report(packets, group_config, matrix=None, attribution=None, history=None):
     """Build Excel report for dynamic groups - EXACTLY like Harry's Group with custom agents"""
     if not packets: 
         print("❌ No valid data found.")
@@ -971,128 +2286,65 @@ def build_dynamic_group_report(packets, group_config):
     
     report_date = packets[0]['date']
     freq_name = packets[0]['freq_name']
-    freq_val = packets[0]['freq'] if packets[0]['freq'] else 52
     
     filename = f"Commission_Report_{group_name}_{report_date.strftime('%B_%Y')}.xlsx"
-    out_path = os.path.join(OUTPUT_FOLDER, filename)
+    output = start_output(filename, group_config.get('naming'))
     
-    workbook = xlsxwriter.Workbook(out_path, {'nan_inf_to_errors': True})
+    workbook = xlsxwriter.Workbook(output['temp'], {'nan_inf_to_errors': True})
     
     # FORMATS (SAME as Harry's)
-    fmt_header = workbook.add_format({
-        'bold': True, 'bg_color': '#D9E1F2', 'border': 1, 'align': 'center', 'valign': 'vcenter'
-    })
-    fmt_currency = workbook.add_format({'num_format': '$#,##0.00'})
-    fmt_text = workbook.add_format({'num_format': '@'})
-    fmt_date_header = workbook.add_format({
-        'bold': True, 'bg_color': '#4472C4', 'font_color': '#FFFFFF', 'border': 1, 'align': 'center'
-    })
+    fmt_header = get_format(workbook, 'header')
+    fmt_currency = get_format(workbook, 'currency')
+    fmt_text = get_format(workbook, 'text')
+    fmt_date_header = get_format(workbook, 'date_header')
     
     # Color formats for each main agent (cycle through colors)
-    colors = ['#D9E1F2', '#E2EFDA', '#FCE4D6', '#F4B084', '#C5E0B4', '#FFE699']
     agent_formats_map = {}
     for i, agent_name in enumerate(main_agents.keys()):
-        agent_formats_map[agent_name] = workbook.add_format({
+        agent_formats_map[agent_name] = get_format(workbook, {
             'num_format': '$#,##0.00',
-            'bg_color': colors[i % len(colors)]
+            'bg_color': AGENT_COLORS[i % len(AGENT_COLORS)]
         })
     
-    fmt_total_header = workbook.add_format({
-        'bold': True, 'bg_color': '#000000', 'font_color': '#FFFFFF', 'align': 'center', 'border': 1
-    })
-    fmt_total_value = workbook.add_format({
-        'num_format': '$#,##0.00', 'bold': True, 'bg_color': '#FFFF00', 'border': 1, 'align': 'center', 'font_size': 12
-    })
+    fmt_total_header = get_format(workbook, 'total_header')
+    fmt_total_value = get_format(workbook, 'total_value')
     
-    master_ssn = set()
-    employee_payments = {}
+    if matrix is None:
+        matrix = build_payment_matrix(packets)
+    master_ssn = matrix['ssns']
+    week_freqs = matrix['freqs']
     
     # STEP 1: Create date-named tabs (SAME as Harry's Group)
     for i, p in enumerate(packets):
         tab_date = f"{p['date'].month}.{p['date'].day}"
         tab_name = tab_date[:31]
         ws = workbook.add_worksheet(tab_name)
-        
-        df = p['df']
-        ded_col = p['ded_col']
-        id_col = p['id_col']
-        
-        paid = df[df[ded_col] != 0].copy()
-        all_ids = df[id_col].dropna().astype(str).str.strip().unique()
-        master_ssn.update(all_ids)
-        
-        paid_ssns = set(paid[id_col].dropna().astype(str).str.strip())
-        
-        for ssn in all_ids:
-            if ssn not in employee_payments:
-                employee_payments[ssn] = []
-            if ssn in paid_ssns:
-                amount = paid[paid[id_col].astype(str).str.strip() == ssn][ded_col].iloc[0]
-                employee_payments[ssn].append(amount)
-            else:
-                employee_payments[ssn].append(0)
-        
-        # Write tab data
-        ws.write(0, 0, "SSN", fmt_header)
-        ws.write(0, 1, "PPC125", fmt_header)
-        ws.write(0, 2, p['date'].strftime('%m/%d/%Y'), fmt_header)
-        ws.set_column(0, 0, 15)
-        ws.set_column(1, 2, 12)
-        
-        all_ssns_in_file = df[id_col].dropna().astype(str).str.strip().unique()
-        
-        row_idx = 1
-        for ssn in sorted(all_ssns_in_file):
-            ws.write_string(row_idx, 0, ssn, fmt_text)
-            employee_row = paid[paid[id_col].astype(str).str.strip() == ssn]
-            if not employee_row.empty:
-                val = -abs(employee_row[ded_col].iloc[0])
-                ws.write_number(row_idx, 1, val, fmt_currency)
-            else:
-                ws.write_string(row_idx, 1, "", fmt_text)
-            row_idx += 1
-        
-        ws.write_string(row_idx, 0, "")
-        ws.write_formula(row_idx, 1, f'=SUM(B2:B{row_idx})', fmt_currency)
+        ssns, amounts, reversed_rows = week_column(matrix, i)
+        write_date_tab(ws, p, ssns, amounts, workbook, reversed_rows)
     
     # Identify perfect vs imperfect employees
-    perfect_employees = []
-    imperfect_employees = []
     num_weeks = len(packets)
-    employee_plan_levels = {}
-    
-    for ssn, payments in employee_payments.items():
-        if len(payments) == num_weeks and all(amount != 0 for amount in payments):
-            perfect_employees.append(ssn)
-            first_payment = abs(payments[0])
-            
-            # Determine plan from payment amount
-            if freq_name == "Weekly":
-                if first_payment >= 360: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 315: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 270: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 220: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-            elif freq_name == "BiWeekly":
-                if first_payment >= 720: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 630: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 540: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 450: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-            elif freq_name == "SemiMonthly":
-                if first_payment >= 780: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 680: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 580: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 480: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-            else:  # Monthly
-                if first_payment >= 1550: employee_plan_levels[ssn] = 1600
-                elif first_payment >= 1350: employee_plan_levels[ssn] = 1400
-                elif first_payment >= 1150: employee_plan_levels[ssn] = 1200
-                elif first_payment >= 950: employee_plan_levels[ssn] = 1000
-                else: employee_plan_levels[ssn] = 0
-        else:
-            imperfect_employees.append(ssn)
+    classification = classify_employees(matrix)
+    week_reversals = matrix['reversed'].any(axis=0)
+    perfect_mask = classification['perfect']
+    imperfect_mask = classification['imperfect']
+    perfect_employees = master_ssn[perfect_mask]
+    imperfect_employees = master_ssn[imperfect_mask]
+    
+    # Determine plan from first week's payment amount
+    perfect_plan_levels = plan_levels_from_values(matrix['plan_values'][perfect_mask, 0], matrix['freq_names'][:1])
+    
+    # Share of a full commission per employee; unpaid employees only earn when prorating
+    policy = proration_policy(group_config)
+    prorated = policy == 'prorated' and len(imperfect_employees) > 0
+    weights = commission_weights(matrix, classification, policy)
+    if prorated:
+        plan_levels = plan_levels_from_values(matrix['plan_values'], matrix['freq_names'])
+        prorated_counts = weighted_plan_groups(plan_levels[imperfect_mask], matrix['paid'][imperfect_mask],
+                                               weights[imperfect_mask])
+    
+    # Downline agents with assigned employees are credited with their own book
+    agent_books = attributed_downline_counts(matrix, attribution, weights) if attribution else {}
     
     # STEP 2: Create Unpaid tab (SAME as Harry's Group with agent columns)
     ws_unpaid = workbook.add_worksheet("Unpaid")
@@ -1132,7 +2384,7 @@ def build_dynamic_group_report(packets, group_config):
             unpaid_agent_cols[agent_name].append(current_col)
             current_col += 1
     
-    sorted_imperfect = sorted(imperfect_employees)
+    sorted_imperfect = imperfect_employees
     
     for row_num, ssn in enumerate(sorted_imperfect):
         excel_row = row_num + 2
@@ -1142,20 +2394,13 @@ def build_dynamic_group_report(packets, group_config):
             tab_date = f"{p['date'].month}.{p['date'].day}"
             
             # VLOOKUP PPC from date tab
-            vlookup = f'=IFERROR(VLOOKUP($A{excel_row+1},\'{tab_date}\'!A:B,2,FALSE),0)'
+            vlookup = ppc_lookup_formula(f"$A{excel_row+1}", tab_date, week_reversals[i])
             ws_unpaid.write_formula(row_num + 2, unpaid_ppc_cols[i], vlookup, fmt_currency)
             
             ppc_cell = xl_rowcol_to_cell(row_num + 2, unpaid_ppc_cols[i])
             
             # Plan detection formula
-            if freq_name == "Weekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=360,"Plan 1600",IF(ABS({ppc_cell})>=315,"Plan 1400",IF(ABS({ppc_cell})>=270,"Plan 1200",IF(ABS({ppc_cell})>=220,"Plan 1000",""))))'
-            elif freq_name == "BiWeekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=720,"Plan 1600",IF(ABS({ppc_cell})>=630,"Plan 1400",IF(ABS({ppc_cell})>=540,"Plan 1200",IF(ABS({ppc_cell})>=450,"Plan 1000",""))))'
-            elif freq_name == "SemiMonthly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=780,"Plan 1600",IF(ABS({ppc_cell})>=680,"Plan 1400",IF(ABS({ppc_cell})>=580,"Plan 1200",IF(ABS({ppc_cell})>=480,"Plan 1000",""))))'
-            else:  # Monthly
-                plan_formula = f'=IF(ABS({ppc_cell})>=1550,"Plan 1600",IF(ABS({ppc_cell})>=1350,"Plan 1400",IF(ABS({ppc_cell})>=1150,"Plan 1200",IF(ABS({ppc_cell})>=950,"Plan 1000",""))))'
+            plan_formula = plan_level_formula(ppc_cell, p['freq_name'])
             
             ws_unpaid.write_formula(row_num + 2, unpaid_plan_cols[i], plan_formula)
             
@@ -1163,11 +2408,22 @@ def build_dynamic_group_report(packets, group_config):
             
             # FOR EACH AGENT: Calculate commission based on Plan and Agent's percentage
             for agent_name, agent_pct in main_agents.items():
-                commission_formula = f'=IF({plan_cell}="Plan 1600",(1600*{agent_pct}/100*12/{freq_val}),IF({plan_cell}="Plan 1400",(1400*{agent_pct}/100*12/{freq_val}),IF({plan_cell}="Plan 1200",(1200*{agent_pct}/100*12/{freq_val}),IF({plan_cell}="Plan 1000",(1000*{agent_pct}/100*12/{freq_val}),0))))'
+                commission_formula = f'=IF({plan_cell}="Plan 1600",(1600*{agent_pct}/100*12/{week_freqs[i]}),IF({plan_cell}="Plan 1400",(1400*{agent_pct}/100*12/{week_freqs[i]}),IF({plan_cell}="Plan 1200",(1200*{agent_pct}/100*12/{week_freqs[i]}),IF({plan_cell}="Plan 1000",(1000*{agent_pct}/100*12/{week_freqs[i]}),0))))'
                 
                 agent_col = unpaid_agent_cols[agent_name][i]
                 ws_unpaid.write_formula(row_num + 2, agent_col, commission_formula, agent_formats_map[agent_name])
     
+    # Prorated: what the unpaid employees' paid weeks add to each agent's grand total
+    unpaid_last_row = len(sorted_imperfect) + 2
+    if prorated:
+        ws_unpaid.write(unpaid_last_row + 2, 0, "Weekly Totals", fmt_total_header)
+        fmt_unpaid_total = get_format(workbook, 'agent_weekly_total')
+        for agent_name in main_agents.keys():
+            for col in unpaid_agent_cols[agent_name]:
+                ws_unpaid.write_formula(unpaid_last_row + 2, col,
+                    f'=SUM({xl_col_to_name(col)}3:{xl_col_to_name(col)}{unpaid_last_row})',
+                    fmt_unpaid_total)
+    
     # STEP 3: Create Commissions tab (THE MAIN DIFFERENCE!)
     # THIS part MUST be like Harry's: PPC + Plan + Agent1 + Agent2 + Agent3... per WEEK
     ws_comm = workbook.add_worksheet("Commissions")
@@ -1219,7 +2475,7 @@ def build_dynamic_group_report(packets, group_config):
         ws_comm.set_column(plan_cols[-1], plan_cols[-1], 12)
     
     # Write perfect employees
-    sorted_ssns = sorted(perfect_employees, key=lambda ssn: (-employee_plan_levels.get(ssn, 0), ssn))
+    sorted_ssns = perfect_employees[np.lexsort((perfect_employees, -perfect_plan_levels))]
     
     for row_num, ssn in enumerate(sorted_ssns):
         excel_row = row_num + 2
@@ -1229,20 +2485,13 @@ def build_dynamic_group_report(packets, group_config):
             tab_date = f"{p['date'].month}.{p['date'].day}"
             
             # VLOOKUP PPC from date tab
-            vlookup = f'=IFERROR(VLOOKUP($A{excel_row+1},\'{tab_date}\'!A:B,2,FALSE),0)'
+            vlookup = ppc_lookup_formula(f"$A{excel_row+1}", tab_date, week_reversals[i])
             ws_comm.write_formula(row_num + 2, ppc_cols[i], vlookup, fmt_currency)
             
             ppc_cell = xl_rowcol_to_cell(row_num + 2, ppc_cols[i])
             
             # Plan detection formula
-            if freq_name == "Weekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=360,"Plan 1600",IF(ABS({ppc_cell})>=315,"Plan 1400",IF(ABS({ppc_cell})>=270,"Plan 1200",IF(ABS({ppc_cell})>=220,"Plan 1000",""))))'
-            elif freq_name == "BiWeekly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=720,"Plan 1600",IF(ABS({ppc_cell})>=630,"Plan 1400",IF(ABS({ppc_cell})>=540,"Plan 1200",IF(ABS({ppc_cell})>=450,"Plan 1000",""))))'
-            elif freq_name == "SemiMonthly":
-                plan_formula = f'=IF(ABS({ppc_cell})>=780,"Plan 1600",IF(ABS({ppc_cell})>=680,"Plan 1400",IF(ABS({ppc_cell})>=580,"Plan 1200",IF(ABS({ppc_cell})>=480,"Plan 1000",""))))'
-            else:  # Monthly
-                plan_formula = f'=IF(ABS({ppc_cell})>=1550,"Plan 1600",IF(ABS({ppc_cell})>=1350,"Plan 1400",IF(ABS({ppc_cell})>=1150,"Plan 1200",IF(ABS({ppc_cell})>=950,"Plan 1000",""))))'
+            plan_formula = plan_level_formula(ppc_cell, p['freq_name'])
             
             ws_comm.write_formula(row_num + 2, plan_cols[i], plan_formula)
             
@@ -1252,8 +2501,8 @@ def build_dynamic_group_report(packets, group_config):
             # Commission formula: IF Plan=1600 then (monthly_1600 * pct / 100 * 12 / freq), etc.
             for agent_name, agent_pct in main_agents.items():
                 # Use PLAN_MAP to get monthly amounts
-                # Commission = (monthly_for_plan * percentage / 100) * 12 / freq_val
-                commission_formula = f'=IF({plan_cell}="Plan 1600",(1600*{agent_pct}/100*12/{freq_val}),IF({plan_cell}="Plan 1400",(1400*{agent_pct}/100*12/{freq_val}),IF({plan_cell}="Plan 1200",(1200*{agent_pct}/100*12/{freq_val}),IF({plan_cell}="Plan 1000",(1000*{agent_pct}/100*12/{freq_val}),0))))'
+                # Commission = (monthly_for_plan * percentage / 100) * 12 / that week's frequency
+                commission_formula = f'=IF({plan_cell}="Plan 1600",(1600*{agent_pct}/100*12/{week_freqs[i]}),IF({plan_cell}="Plan 1400",(1400*{agent_pct}/100*12/{week_freqs[i]}),IF({plan_cell}="Plan 1200",(1200*{agent_pct}/100*12/{week_freqs[i]}),IF({plan_cell}="Plan 1000",(1000*{agent_pct}/100*12/{week_freqs[i]}),0))))'
                 
                 agent_col = agent_cols[agent_name][i]
                 ws_comm.write_formula(row_num + 2, agent_col, commission_formula, agent_formats_map[agent_name])
@@ -1264,11 +2513,13 @@ def build_dynamic_group_report(packets, group_config):
     
     ws_comm.write(subtotal_row, 0, "Weekly Totals", fmt_total_header)
     
+    fmt_weekly_total = get_format(workbook, 'agent_weekly_total')
+    
     for agent_name in main_agents.keys():
         for i, col in enumerate(agent_cols[agent_name]):
             ws_comm.write_formula(subtotal_row, col,
                 f'=SUM({xl_col_to_name(col)}3:{xl_col_to_name(col)}{last_data_row})',
-                workbook.add_format({'bold': True, 'bg_color': '#FFE699', 'border': 1}))
+                fmt_weekly_total)
     
     # STEP 5: Grand Totals
     totals_col = current_col + 1
@@ -1287,6 +2538,10 @@ def build_dynamic_group_report(packets, group_config):
         cols_for_agent = agent_cols[agent_name]
         ranges = [f"{xl_col_to_name(c)}3:{xl_col_to_name(c)}{last_data_row}" for c in cols_for_agent]
         grand_total_formula = f"=SUM({','.join(ranges)})"
+        if prorated:
+            unpaid_ranges = [f"'Unpaid'!{xl_col_to_name(c)}3:{xl_col_to_name(c)}{unpaid_last_row}"
+                             for c in unpaid_agent_cols[agent_name]]
+            grand_total_formula += f"+SUM({','.join(unpaid_ranges)})"
         ws_comm.write_formula(2, totals_col + col_offset, grand_total_formula, fmt_total_value)
         col_offset += 1
     
@@ -1301,75 +2556,24 @@ def build_dynamic_group_report(packets, group_config):
     plan_count_start_row = 5
     plan_count_col = totals_col
     
-    fmt_plan_count_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#FFF2CC',
-        'border': 1,
-        'align': 'center',
-        'font_size': 11
-    })
-    fmt_plan_count_value = workbook.add_format({
-        'bold': True,
-        'bg_color': '#FFF2CC',
-        'border': 1,
-        'align': 'center',
-        'font_size': 11
-    })
+    fmt_plan_count_header = get_format(workbook, 'plan_count_header')
+    fmt_plan_count_value = get_format(workbook, 'plan_count_value')
     
     ws_comm.merge_range(plan_count_start_row, plan_count_col, plan_count_start_row, plan_count_col + 2, 
                         "PLAN COUNTING", fmt_plan_count_header)
     
-    # Build plan counting formulas based on number of weeks
-    if num_weeks == 2:
-        ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
-                           "BiWeekly - 2 Payroll Weeks", fmt_header)
-        ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
-        ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
-        
-        if len(plan_cols) >= 2:
-            col_1 = xl_col_to_name(plan_cols[0])
-            col_2 = xl_col_to_name(plan_cols[1])
-            
-            plan_1000_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_2}3:{col_2}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
-            
-            other_plans_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_2}3:{col_2}{last_data_row})))=0),--((ISNUMBER(SEARCH("Plan 1200",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_1}3:{col_1}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_2}3:{col_2}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
-    
-    elif num_weeks == 3:
-        ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
-                           "BiWeekly - 3 Payroll Weeks", fmt_header)
-        ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
-        ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
-        
-        if len(plan_cols) >= 3:
-            col_1 = xl_col_to_name(plan_cols[0])
-            col_2 = xl_col_to_name(plan_cols[1])
-            col_3 = xl_col_to_name(plan_cols[2])
-            
-            plan_1000_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_3}3:{col_3}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
-            
-            other_plans_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_3}3:{col_3}{last_data_row})))=0),--((ISNUMBER(SEARCH("Plan 1200",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_1}3:{col_1}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_2}3:{col_2}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_3}3:{col_3}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_3}3:{col_3}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_3}3:{col_3}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
-    
-    elif num_weeks == 4:
-        ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
-                           "Weekly - 4 Payroll Weeks", fmt_header)
-        ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
-        ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
-        
-        if len(plan_cols) >= 4:
-            col_1 = xl_col_to_name(plan_cols[0])
-            col_2 = xl_col_to_name(plan_cols[1])
-            col_3 = xl_col_to_name(plan_cols[2])
-            col_4 = xl_col_to_name(plan_cols[3])
-            
-            plan_1000_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_3}3:{col_3}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_4}3:{col_4}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
-            
-            other_plans_formula = f'=SUMPRODUCT(--((ISNUMBER(SEARCH("Plan 1000",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_3}3:{col_3}{last_data_row}))+ISNUMBER(SEARCH("Plan 1000",{col_4}3:{col_4}{last_data_row})))=0),--((ISNUMBER(SEARCH("Plan 1200",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_1}3:{col_1}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_1}3:{col_1}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_2}3:{col_2}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_2}3:{col_2}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_3}3:{col_3}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_3}3:{col_3}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_3}3:{col_3}{last_data_row})))>0),--((ISNUMBER(SEARCH("Plan 1200",{col_4}3:{col_4}{last_data_row}))+ISNUMBER(SEARCH("Plan 1400",{col_4}3:{col_4}{last_data_row}))+ISNUMBER(SEARCH("Plan 1600",{col_4}3:{col_4}{last_data_row})))>0))'
-            ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
+    # Build plan counting formulas for however many weeks the period has
+    ws_comm.merge_range(plan_count_start_row + 1, plan_count_col, plan_count_start_row + 1, plan_count_col + 2,
+                       f"{PLAN_COUNT_LABELS.get(num_weeks, freq_name)} - {num_weeks} Payroll Weeks", fmt_header)
+    ws_comm.write(plan_count_start_row + 2, plan_count_col, "Plan 1000 Count:", fmt_plan_count_header)
+    ws_comm.write(plan_count_start_row + 3, plan_count_col, "Other Plans Count:", fmt_plan_count_header)
+    
+    plan_1000_formula, other_plans_formula = plan_counting_formulas(plan_cols, last_data_row)
+    ws_comm.write_formula(plan_count_start_row + 2, plan_count_col + 1, plan_1000_formula, fmt_plan_count_value)
+    ws_comm.write_formula(plan_count_start_row + 3, plan_count_col + 1, other_plans_formula, fmt_plan_count_value)
+    if prorated:
+        write_prorated_counts(ws_comm, plan_count_start_row, plan_count_col, prorated_counts,
+                              fmt_plan_count_header, fmt_plan_count_value)
     
     # ==============================================================================
     # STEP 7: SUB-AGENTS DOWNLINE SECTION (IF sub_agents EXIST)
@@ -1379,24 +2583,9 @@ def build_dynamic_group_report(packets, group_config):
         downline_start_row = plan_count_start_row + 6
         downline_col = totals_col
         
-        fmt_downline_header = workbook.add_format({
-            'bold': True,
-            'bg_color': '#C6E0B4',
-            'border': 1,
-            'align': 'center',
-            'font_size': 12
-        })
-        fmt_downline_agent = workbook.add_format({
-            'bg_color': '#F4F7F0',
-            'border': 1,
-            'align': 'left',
-            'indent': 1
-        })
-        fmt_downline_commission = workbook.add_format({
-            'num_format': '$#,##0.00',
-            'bg_color': '#E2EFDA',
-            'border': 1
-        })
+        fmt_downline_header = get_format(workbook, 'downline_header')
+        fmt_downline_agent = get_format(workbook, 'downline_agent')
+        fmt_downline_commission = get_format(workbook, 'downline_commission')
         
         ws_comm.merge_range(downline_start_row, downline_col, downline_start_row, downline_col + 3, 
                             f"{group_name.upper()} - SUB-AGENTS COMMISSIONS", fmt_downline_header)
@@ -1418,13 +2607,10 @@ def build_dynamic_group_report(packets, group_config):
         for agent_name, rates in sub_agents.items():
             ws_comm.write(current_downline_row, downline_col, agent_name, fmt_downline_agent)
             
-            # Reference to plan count cells
-            plan_1000_count_cell = xl_rowcol_to_cell(plan_count_start_row + 2, plan_count_col + 1)
-            other_plans_count_cell = xl_rowcol_to_cell(plan_count_start_row + 3, plan_count_col + 1)
-            
-            # Show counts
-            ws_comm.write_formula(current_downline_row, downline_col + 1, f'={plan_1000_count_cell}', fmt_plan_count_value)
-            ws_comm.write_formula(current_downline_row, downline_col + 2, f'={other_plans_count_cell}', fmt_plan_count_value)
+            # Agent's own book when attributed, otherwise the group-wide plan count cells
+            plan_1000_count_cell, other_plans_count_cell = write_downline_counts(
+                ws_comm, current_downline_row, downline_col, agent_books.get(agent_name),
+                plan_count_start_row, plan_count_col, fmt_plan_count_value, prorated)
             
             # Calculate commission using individual plan rates
             rate_1000 = get_rate_for_plan(rates, '1000')
@@ -1435,18 +2621,25 @@ def build_dynamic_group_report(packets, group_config):
             
             current_downline_row += 1
     
+    write_deduction_codes_sheet(workbook, packets, GROUP_TYPE_DYNAMIC, group_config, matrix, attribution)
+    enrollment = write_enrollment_sheet(workbook, packets, matrix)
+    if history is not None:
+        write_clawbacks_sheet(workbook, history)
+    
     workbook.close()
+    out_path = finish_output(output)
     
-    print(f"\n✅ DYNAMIC GROUP REPORT GENERATED: {out_path}")
+    print(f"\n✅ DYNAMIC GROUP REPORT GENERATED: {os.path.basename(out_path)}")
     print(f"📁 Group: {group_name}")
     print(f"📊 Main Agents: {', '.join(main_agents.keys())}")
     if sub_agents:
         print(f"📊 Sub-Agents: {', '.join(sub_agents.keys())}")
-    print(f"📊 Frequency: {freq_name} (÷{freq_val})")
+    print(f"📊 Frequency: {frequency_label(packets)}")
     print(f"📅 Date Range: {packets[0]['date'].strftime('%m/%d/%Y')} - {packets[-1]['date'].strftime('%m/%d/%Y')}")
     print(f"👥 Total Employees: {len(master_ssn)}")
     print(f"✅ Perfect Employees: {len(perfect_employees)}")
     print(f"❌ Imperfect Employees: {len(imperfect_employees)}")
+    print(f"🔄 Enrollment: {format_enrollment_counts(enrollment)}")
     print(f"📋 Features:")
     print(f"   ✓ Plan Counting ({num_weeks} weeks)")
     if sub_agents:
@@ -1456,7 +2649,7 @@ def build_dynamic_group_report(packets, group_config):
 # 4. TIER-BASED GROUP REPORT BUILDER (System 2)
 # ==============================================================================
 
-def build_tier_group_report(packets, group_config):
+def build_tier_group_report(packets, group_config, matrix=None, attribution=None, history=None):
     """
     Build Excel report for tier-based groups with hierarchical structure
     
@@ -1478,71 +2671,28 @@ def build_tier_group_report(packets, group_config):
     sub_agents = group_config.get('sub_agents', [])
     
     report_date = packets[0]['date']
-    freq_name = packets[0]['freq_name']
-    freq_val = packets[0]['freq'] if packets[0]['freq'] else 52
     
     filename = f"Commission_Report_{group_name}_{report_date.strftime('%B_%Y')}.xlsx"
-    out_path = os.path.join(OUTPUT_FOLDER, filename)
+    output = start_output(filename, group_config.get('naming'))
     
-    workbook = xlsxwriter.Workbook(out_path, {'nan_inf_to_errors': True})
+    workbook = xlsxwriter.Workbook(output['temp'], {'nan_inf_to_errors': True})
     
     # Formats
-    fmt_header = workbook.add_format({
-        'bold': True, 
-        'bg_color': '#D9E1F2', 
-        'border': 1, 
-        'align': 'center',
-        'valign': 'vcenter'
-    })
-    fmt_currency = workbook.add_format({'num_format': '$#,##0.00'})
-    fmt_text = workbook.add_format({'num_format': '@'})
-    fmt_date_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#4472C4',
-        'font_color': '#FFFFFF',
-        'border': 1,
-        'align': 'center'
-    })
+    fmt_header = get_format(workbook, 'header')
+    fmt_currency = get_format(workbook, 'currency')
+    fmt_text = get_format(workbook, 'text')
+    fmt_date_header = get_format(workbook, 'date_header')
     
-    fmt_total_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#000000',
-        'font_color': '#FFFFFF',
-        'align': 'center',
-        'border': 1
-    })
-    fmt_total_value = workbook.add_format({
-        'num_format': '$#,##0.00',
-        'bold': True,
-        'bg_color': '#FFFF00',
-        'border': 1,
-        'align': 'center',
-        'font_size': 12
-    })
-    
-    fmt_agent_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#C6E0B4',
-        'border': 1,
-        'align': 'center',
-        'font_size': 11
-    })
+    fmt_total_header = get_format(workbook, 'total_header')
+    fmt_total_value = get_format(workbook, 'total_value')
     
-    fmt_client_header = workbook.add_format({
-        'bold': True,
-        'bg_color': '#FFD966',
-        'border': 1,
-        'align': 'center',
-        'font_size': 11
-    })
-    
-    fmt_downline_agent = workbook.add_format({
-        'indent': 1,
-        'border': 1
-    })
+    fmt_agent_header = get_format(workbook, 'agent_header')
+    fmt_client_header = get_format(workbook, 'client_header')
+    fmt_downline_agent = get_format(workbook, 'breakdown_row')
 
-    master_ssn = set()
-    employee_payments = {}
+    if matrix is None:
+        matrix = build_payment_matrix(packets)
+    master_ssn = matrix['ssns']
     
     # Step 1: Create date-named tabs
     for i, p in enumerate(packets):
@@ -1550,76 +2700,28 @@ def build_tier_group_report(packets, group_config):
         tab_name = tab_date[:31]
         
         ws = workbook.add_worksheet(tab_name)
-        
-        df = p['df']
-        ded_col = p['ded_col']
-        id_col = p['id_col']
-        
-        all_ids = df[id_col].dropna().astype(str).str.strip().unique()
-        master_ssn.update(all_ids)
-        
-        paid = df[df[ded_col] != 0].copy()
-        paid_ssns = set(paid[id_col].dropna().astype(str).str.strip())
-        
-        for ssn in all_ids:
-            if ssn not in employee_payments:
-                employee_payments[ssn] = []
-            
-            if ssn in paid_ssns:
-                amount = paid[paid[id_col].astype(str).str.strip() == ssn][ded_col].iloc[0]
-                employee_payments[ssn].append(amount)
-            else:
-                employee_payments[ssn].append(0)
-        
-        ws.write(0, 0, "SSN", fmt_header)
-        ws.write(0, 1, "PPC125", fmt_header)
-        ws.write(0, 2, p['date'].strftime('%m/%d/%Y'), fmt_header)
-        ws.set_column(0, 0, 15)
-        ws.set_column(1, 2, 12)
-        
-        row_idx = 1
-        for ssn in sorted(all_ids):
-            ws.write(row_idx, 0, ssn, fmt_text)
-            
-            if ssn in paid_ssns:
-                amount = paid[paid[id_col].astype(str).str.strip() == ssn][ded_col].iloc[0]
-                ws.write(row_idx, 1, amount, fmt_currency)
-                ws.write(row_idx, 2, p['date'].strftime('%m/%d/%Y'))
-            else:
-                ws.write(row_idx, 1, 0, fmt_currency)
-                ws.write(row_idx, 2, "UNPAID")
-            
-            row_idx += 1
+        ssns, amounts, reversed_rows = week_column(matrix, i)
+        write_tier_date_tab(ws, p, ssns, amounts, workbook, reversed_rows)
     
-    # Identify perfect vs imperfect
-    perfect_employees = []
-    imperfect_employees = []
+    # Identify perfect vs imperfect (only employees listed in every week's file)
     num_weeks = len(packets)
-    employee_plan_levels = {}
-    
-    for ssn, payments in employee_payments.items():
-        if len(payments) != num_weeks:
-            continue
-        
-        all_paid = all(p != 0 for p in payments)
-        
-        first_payment = None
-        for p in payments:
-            if p != 0:
-                first_payment = p
-                break
-        
-        if first_payment and first_payment != 0:
-            plan = detect_plan_from_amount(first_payment, packets[0]['freq_name'])
-            employee_plan_levels[ssn] = plan
-            
-            if all_paid:
-                perfect_employees.append(ssn)
-            else:
-                imperfect_employees.append((ssn, payments))
-    
-    # Get plan counts
-    plan_counts = get_employee_plan_counts(packets, perfect_employees, employee_plan_levels)
+    amounts = matrix['amounts']
+    classification = classify_tier_employees(matrix)
+    perfect_mask = classification['perfect']
+    imperfect_mask = classification['imperfect']
+    plan_matrix = classification['plan_matrix']
+    employee_plans = classification['employee_plans']
+    
+    perfect_rows = np.flatnonzero(perfect_mask)
+    perfect_employees = master_ssn[perfect_mask]
+    perfect_plans = employee_plans[perfect_mask]
+    perfect_plan_levels = np.array([int(plan.replace('PPC', '')) for plan in perfect_plans], dtype=int)
+    imperfect_employees = master_ssn[imperfect_mask]
+    
+    # Get plan counts (unpaid employees count by their share of weeks paid when prorating)
+    policy = proration_policy(group_config)
+    weights = commission_weights(matrix, classification, policy)
+    plan_counts = weighted_plan_counts(employee_plans, weights)
     
     # Step 2: Create Unpaid tab
     ws_unpaid = workbook.add_worksheet("Unpaid")
@@ -1633,19 +2735,23 @@ def build_tier_group_report(packets, group_config):
         ws_unpaid.write(1, current_col + 1, "Plan", fmt_header)
         ws_unpaid.set_column(current_col, current_col + 1, 10)
         current_col += 2
+    if policy == 'prorated':
+        ws_unpaid.write(1, current_col, "Share Paid", fmt_header)
+        ws_unpaid.set_column(current_col, current_col, 11)
     
-    sorted_imperfect = sorted([emp[0] for emp in imperfect_employees])
+    sorted_imperfect = master_ssn[imperfect_mask]
     
-    for row_num, ssn in enumerate(sorted_imperfect):
+    for row_num, (ssn, emp_row) in enumerate(zip(sorted_imperfect, np.flatnonzero(imperfect_mask))):
         ws_unpaid.write(row_num + 2, 0, ssn, fmt_text)
         
-        payments = employee_payments.get(ssn, [])
         col = 1
-        for payment in payments:
-            ws_unpaid.write(row_num + 2, col, payment, fmt_currency)
-            plan = detect_plan_from_amount(payment, packets[0]['freq_name']) if payment != 0 else ""
-            ws_unpaid.write(row_num + 2, col + 1, plan)
+        for i in range(num_weeks):
+            plan = plan_matrix[emp_row, i]
+            ws_unpaid.write(row_num + 2, col, amounts[emp_row, i], fmt_currency)
+            ws_unpaid.write(row_num + 2, col + 1, plan if plan else "")
             col += 2
+        if policy == 'prorated':
+            ws_unpaid.write_number(row_num + 2, col, weights[emp_row])
     
     # Step 3: Create Commissions Dashboard
     ws_comm = workbook.add_worksheet("Commissions")
@@ -1675,18 +2781,16 @@ def build_tier_group_report(packets, group_config):
         current_col += 2
     
     # Write perfect employees
-    sorted_ssns = sorted(perfect_employees, key=lambda ssn: (-int(employee_plan_levels.get(ssn, 'PPC1000').replace('PPC', '')), ssn))
+    sorted_ssns = perfect_employees[np.lexsort((perfect_employees, -perfect_plan_levels))]
+    sorted_rows = perfect_rows[np.lexsort((perfect_employees, -perfect_plan_levels))]
     
-    for row_num, ssn in enumerate(sorted_ssns):
+    for row_num, (ssn, emp_row) in enumerate(zip(sorted_ssns, sorted_rows)):
         ws_comm.write(row_num + 2, 0, ssn, fmt_text)
         
-        payments = employee_payments.get(ssn, [])
-        for i, payment in enumerate(payments):
+        for i in range(num_weeks):
             col = ppc_cols[i]
-            ws_comm.write(row_num + 2, col, payment, fmt_currency)
-            
-            plan = detect_plan_from_amount(payment, packets[0]['freq_name'])
-            ws_comm.write(row_num + 2, col + 1, plan)
+            ws_comm.write(row_num + 2, col, amounts[emp_row, i], fmt_currency)
+            ws_comm.write(row_num + 2, col + 1, plan_matrix[emp_row, i])
     
     last_data_row = len(sorted_ssns) + 2
     
@@ -1706,104 +2810,965 @@ def build_tier_group_report(packets, group_config):
     ws_comm.write(header_row, 5, "PPC1000", fmt_header)
     ws_comm.write(header_row, 6, "Commission", fmt_header)
     
-    ws_comm.set_column(0, 0, 25)
-    ws_comm.set_column(1, 6, 12)
+    ws_comm.set_column(0, 0, 25)
+    ws_comm.set_column(1, 6, 12)
+    
+    # Earnings for the whole hierarchy (sub-agents may have their own sub-agents)
+    tree = flatten_agent_tree(main_agent, sub_agents)
+    books = attributed_tier_books(tree, attribution, employee_plans, weights) if attribution else None
+    earnings = calculate_hierarchy_earnings(tree, plan_counts, books)
+    
+    # Plan counts shown per agent: their own book when attributed, otherwise the group's
+    if books is None:
+        agent_counts = [list(plan_counts.values())] * len(tree['names'])
+    else:
+        agent_counts = books.tolist()
+    
+    # Calculate and display sub-agent commissions (nested agents indented under their parent)
+    data_row = header_row + 1
+    sub_agent_total = float(earnings['total'][1:].sum())
+    
+    for idx in range(1, len(tree['names'])):
+        agent_name = "  " * (tree['depths'][idx] - 1) + tree['names'][idx]
+        agent_tier = tree['tiers'][idx]
+        agent_commission = earnings['total'][idx]
+        
+        ws_comm.write(data_row, 0, agent_name)
+        ws_comm.write(data_row, 1, f"Tier {agent_tier}")
+        ws_comm.write_row(data_row, 2, agent_counts[idx])
+        ws_comm.write(data_row, 6, agent_commission, fmt_currency)
+        
+        data_row += 1
+    
+    # Main agent commission (their tier + override from sub-agents)
+    data_row += 1
+    main_agent_name = tree['names'][0]
+    main_agent_tier = tree['tiers'][0]
+    
+    ws_comm.write(data_row, 0, f"{main_agent_name} (Main Agent)", fmt_client_header)
+    ws_comm.write(data_row, 1, f"Tier {main_agent_tier}", fmt_client_header)
+    
+    # Main agent gets their own tier commission plus the override on each direct sub-agent
+    main_commission = earnings['own'][0]
+    main_override = earnings['override'][0]
+    total_main_commission = earnings['total'][0]
+    
+    ws_comm.write_row(data_row, 2, agent_counts[0])
+    ws_comm.write(data_row, 6, total_main_commission, fmt_total_value)
+    
+    # Show breakdown
+    data_row += 1
+    ws_comm.write(data_row, 0, f"  • Own Tier {main_agent_tier}", fmt_downline_agent)
+    ws_comm.write(data_row, 6, main_commission, fmt_currency)
+    data_row += 1
+    ws_comm.write(data_row, 0, f"  • Override from Sub-Agents", fmt_downline_agent)
+    ws_comm.write(data_row, 6, main_override, fmt_currency)
+    
+    # Grand total
+    data_row += 2
+    ws_comm.write(data_row, 5, "GRAND TOTAL:", fmt_total_header)
+    grand_total = sub_agent_total + total_main_commission
+    ws_comm.write(data_row, 6, grand_total, fmt_total_value)
+    
+    write_deduction_codes_sheet(workbook, packets, GROUP_TYPE_OTHER, group_config, matrix, attribution)
+    enrollment = write_enrollment_sheet(workbook, packets, matrix)
+    if history is not None:
+        write_clawbacks_sheet(workbook, history)
+    
+    workbook.close()
+    filename = os.path.basename(finish_output(output))
+    
+    print(f"\n✅ TIER GROUP REPORT GENERATED: {filename}")
+    print(f"\n📁 Group: {group_name}")
+    print(f"\n👤 Main Agent: {main_agent_name} (Tier {main_agent_tier})")
+    print(f"   • Own Commission: ${main_commission:,.2f}")
+    print(f"   • Override from Sub-Agents: ${main_override:,.2f}")
+    print(f"   • Total: ${total_main_commission:,.2f}")
+    
+    if sub_agents:
+        print(f"\n👥 Sub-Agents: {len(tree['names']) - 1}")
+        for idx in range(1, len(tree['names'])):
+            indent = "  " * (tree['depths'][idx] - 1)
+            override_note = f" (incl. ${earnings['override'][idx]:,.2f} override)" if earnings['override'][idx] else ""
+            print(f"   {indent}- {tree['names'][idx]} (Tier {tree['tiers'][idx]}): ${earnings['total'][idx]:,.2f}{override_note}")
+        print(f"\n💵 Sub-Agents Total: ${sub_agent_total:,.2f}")
+    else:
+        print(f"\n👥 Sub-Agents: None")
+    
+    print(f"\n💰 GRAND TOTAL: ${grand_total:,.2f}")
+    print(f"� Frequency: {frequency_label(packets)}")
+    print(f"📅 Date Range: {packets[0]['date'].strftime('%m/%d/%Y')} - {packets[-1]['date'].strftime('%m/%d/%Y')}")
+    print(f"✅ Perfect Employees: {len(perfect_employees)}")
+    if policy == 'prorated':
+        print(f"💸 Prorated Unpaid Employees: {len(imperfect_employees)} (counted by share of weeks paid)")
+    print(f"   - PPC1600: {plan_counts['PPC1600']:g}")
+    print(f"   - PPC1400: {plan_counts['PPC1400']:g}")
+    print(f"   - PPC1200: {plan_counts['PPC1200']:g}")
+    print(f"   - PPC1000: {plan_counts['PPC1000']:g}")
+    print(f"🔄 Enrollment: {format_enrollment_counts(enrollment)}")
+
+# ==============================================================================
+# 5. COMMISSION MODEL & DATA EXTRACTS
+# ==============================================================================
+
+# Machine-readable extract formats that can be written next to the xlsx report
+EXPORT_FORMATS = ['parquet', 'csv', 'json']
+
+def plan_group_flags(plan_levels, paid=None):
+    """
+    Per-employee downline groups from an employees x weeks matrix of plan levels
+
+    paid: optional employees x weeks mask; weeks outside it are skipped (proration)
+    Returns: (on Plan 1000 in any week, never on 1000 and on 1200/1400/1600 every week)
+    """
+    has_1000 = (plan_levels == 1000).any(axis=1)
+    is_other = np.isin(plan_levels, (1200, 1400, 1600))
+    if paid is None:
+        all_other = is_other.all(axis=1)
+    else:
+        all_other = (is_other | ~paid).all(axis=1) & paid.any(axis=1)
+    return has_1000, ~has_1000 & all_other
+
+def agent_commission_matrix(plan_levels, freqs, rates):
+    """Per employee x week commission for one agent: rates[plan] * 12 / that week's frequency"""
+    conditions = [plan_levels == plan for plan in rates]
+    choices = [np.broadcast_to(rate * 12 / np.asarray(freqs), plan_levels.shape) for rate in rates.values()]
+    return np.select(conditions, choices, default=0.0)
+
+def count_plan_groups(plan_levels):
+    """
+    Downline plan counting over an employees x weeks matrix of plan levels
+    
+    Plan 1000 count: employees on Plan 1000 in any week
+    Other plans count: employees never on Plan 1000 and on 1200/1400/1600 every week
+    
+    Returns: (plan_1000_count, other_plans_count)
+    """
+    has_1000, other_only = plan_group_flags(plan_levels)
+    return int(has_1000.sum()), int(other_only.sum())
+
+def get_downline_rows(group_type, config, num_weeks):
+    """
+    Downline agents of a report with their per-employee rates
+    
+    Returns: [(client, agent, rate_1000, rate_other), ...]
+    """
+    config = config or {}
+    rows = []
+    
+    if group_type == GROUP_TYPE_ADAM:
+        for agent_name, rates in ADAMS_GROUP_AGENTS.items():
+            rows.append(("", agent_name, get_rate_for_plan(rates, '1000'), get_rate_for_plan(rates, '1600')))
+    elif group_type == GROUP_TYPE_DYNAMIC:
+        for agent_name, rates in config.get('sub_agents', {}).items():
+            rows.append(("", agent_name, get_rate_for_plan(rates, '1000'), get_rate_for_plan(rates, '1600')))
+    elif group_type == GROUP_TYPE_HARRY:
+        selected_client = config.get('selected_client')
+        clients = HARRY_DOWNLINE_RATES.items()
+        if selected_client and selected_client in HARRY_DOWNLINE_RATES:
+            clients = [(selected_client, HARRY_DOWNLINE_RATES[selected_client])]
+        
+        for client_name, agents in clients:
+            for agent_name, rates in agents.items():
+                if client_name == 'CONFIDENCE' and num_weeks in CONFIDENCE_MULTIPLIERS:
+                    rate_1000 = CONFIDENCE_MULTIPLIERS[num_weeks]['1000']
+                    rate_other = CONFIDENCE_MULTIPLIERS[num_weeks]['other']
+                else:
+                    rate_1000 = get_rate_for_plan(rates, '1000')
+                    rate_other = get_rate_for_plan(rates, '1600')
+                rows.append((client_name, agent_name, rate_1000, rate_other))
+    
+    return rows
+
+def get_report_basename(packets, group_type, config=None):
+    """File name (without extension) used for a group's report and its extracts"""
+    config = config or {}
+    month_year = packets[0]['date'].strftime('%B_%Y')
+    
+    if group_type in (GROUP_TYPE_HARRY, GROUP_TYPE_ADAM):
+        selected_client = config.get('selected_client') if group_type == GROUP_TYPE_HARRY else None
+        # Client names such as 'MEDALLION HC/SPANISH LAKES' can't go into a path as-is
+        client_suffix = f"_{selected_client.replace('/', '-')}" if selected_client else ""
+        return f"Commission_Report_Harry{client_suffix}_{month_year}"
+    
+    default_name = 'Dynamic Group' if group_type == GROUP_TYPE_DYNAMIC else 'Group'
+    return f"Commission_Report_{config.get('group_name', default_name)}_{month_year}"
+
+def build_commission_model(packets, group_type, config=None, matrix=None, attribution=None):
+    """
+    Compute the report's numbers in memory (the values the workbook formulas show)
+    
+    Returns: {
+        'basename': report file name without extension,
+        'tables': {
+            'weekly': one row per employee x week (deduction, plan, per-agent commission),
+            'totals': grand total per main agent (Harry/Adam/Dynamic; when prorated,
+                      'prorated' is the part earned on unpaid employees' paid weeks),
+            'downline': plan counts and commission per downline agent (Harry/Adam/Dynamic),
+            'tier': tier summary per agent (Tier-based groups),
+            'codes': commission per agent for each deduction code and in total
+                     (only when config['deduction_codes'] adds codes the files carry),
+            'enrollment': status of every employee at the end of the run (see analyze_enrollment),
+            'enrollment_changes': new/returning/lapsed/terminated counts per week and month pair,
+            'ledger': commission per SSN and agent (only with config['history']; see apply_commission_history)
+        }
+    }
+    
+    The other tables describe the primary deduction code, like the workbook.
+    """
+    config = config or {}
+    if matrix is None:
+        matrix = build_payment_matrix(packets)
+    
+    codes = active_deduction_codes(config, matrix)
+    if len(codes) > 1:
+        # Same load, one pass per code, then per-code and total commission
+        single_code = dict(config, deduction_codes=None)
+        code_tables = {
+            code: build_commission_model(packets, group_type, single_code, deduction_code_matrix(matrix, code), attribution)['tables']
+            for code in codes
+        }
+        tables = dict(code_tables[PRIMARY_DEDUCTION_CODE], codes=deduction_code_summary(code_tables))
+        return {
+            'basename': get_report_basename(packets, group_type, config),
+            'tables': tables
+        }
+    
+    num_weeks = len(packets)
+    ssns = matrix['ssns']
+    amounts = matrix['amounts']
+    is_tier = group_type not in (GROUP_TYPE_HARRY, GROUP_TYPE_ADAM, GROUP_TYPE_DYNAMIC)
+    
+    if is_tier:
+        classification = classify_tier_employees(matrix)
+        plan_labels = classification['plan_matrix']
+    else:
+        classification = classify_employees(matrix)
+        plan_levels = plan_levels_from_values(matrix['plan_values'], matrix['freq_names'])
+        plan_labels = np.where(plan_levels > 0, np.char.add('Plan ', plan_levels.astype(str)), '')
+    
+    perfect = classification['perfect']
+    rows = np.flatnonzero(perfect | classification['imperfect'])
+    policy = proration_policy(config)
+    weights = commission_weights(matrix, classification, policy)
+    
+    weekly = pd.DataFrame({
+        'ssn': np.repeat(ssns[rows], num_weeks),
+        'status': np.repeat(np.where(perfect[rows], 'perfect', 'unpaid'), num_weeks),
+        'week': np.tile(np.arange(1, num_weeks + 1), len(rows)),
+        'pay_date': np.tile(np.array([p['date'] for p in packets], dtype='datetime64[ns]'), len(rows)),
+        'deduction': np.abs(amounts[rows]).ravel(),
+        'plan': plan_labels[rows].ravel()
+    })
+    tables = {'weekly': weekly}
+    
+    if is_tier:
+        plan_counts = weighted_plan_counts(classification['employee_plans'], weights)
+        main_agent = config.get('main_agent', {'name': 'Main Agent', 'tier': '35'})
+        sub_agents = config.get('sub_agents', [])
+        
+        tree = flatten_agent_tree(main_agent, sub_agents)
+        books = None
+        if attribution:
+            books = attributed_tier_books(tree, attribution, classification['employee_plans'], weights)
+        earnings = calculate_hierarchy_earnings(tree, plan_counts, books)
+        parent_names = np.where(tree['parents'] >= 0, tree['names'][np.maximum(tree['parents'], 0)], '')
+        
+        # Sub-agents first (depth-first order), main agent last, as in the workbook summary
+        order = np.r_[np.arange(1, len(tree['names'])), 0]
+        tier = pd.DataFrame({
+            'agent': tree['names'],
+            'role': np.where(tree['depths'] == 0, 'main_agent', 'sub_agent'),
+            'parent': parent_names,
+            'depth': tree['depths'],
+            'tier': tree['tiers'],
+            'own_commission': earnings['own'],
+            'override': earnings['override']
+        })
+        for plan_idx, (plan, count) in enumerate(plan_counts.items()):
+            tier[plan] = count if books is None else books[:, plan_idx]
+        tier = tier.iloc[order].reset_index(drop=True)
+        tier['commission'] = tier['own_commission'] + tier['override']
+        tables['tier'] = tier
+        
+        if config.get('history'):
+            # Every counted employee's share of each agent's own tier commission and overrides
+            plan_index = pd.Index(list(plan_counts)).get_indexer(classification['employee_plans'].astype(str))
+            counted = np.flatnonzero((weights > 0) & (plan_index >= 0))
+            if books is None:
+                owners = np.zeros(len(ssns), dtype=int)
+                contribution = tier_contribution_rates(tree)
+            else:
+                owners = tier_owner_index(tree, attribution)
+                contribution = tier_contribution_rates(tree, owners[counted])
+            per_employee = weights[counted, None] * contribution[owners[counted], plan_index[counted]]
+            tables['ledger'] = pd.concat([ledger_rows(ssns[counted], 'tier', '', name, per_employee[:, idx])
+                                          for idx, name in enumerate(tree['names'])], ignore_index=True)
+        
+    else:
+        # Per-week commission for every main agent, straight from the plan level
+        if group_type == GROUP_TYPE_DYNAMIC:
+            agent_rates = {name: {plan: plan * pct / 100 for plan in (1600, 1400, 1200, 1000)}
+                           for name, pct in config.get('main_agents', {}).items()}
+        else:
+            agent_rates = HARRY_MAIN_AGENT_RATES
+        
+        # Perfect employees earn every week; unpaid ones only on their paid weeks when prorating
+        earning_rows = np.repeat(weights[rows] > 0, num_weeks)
+        unpaid_rows = earning_rows & (weekly['status'].to_numpy() == 'unpaid')
+        totals = []
+        for agent_name, rates in agent_rates.items():
+            weekly[agent_name] = agent_commission_matrix(plan_levels[rows], matrix['freqs'], rates).ravel()
+            commission = weekly[agent_name].to_numpy()
+            totals.append({'agent': agent_name, 'total': float(commission[earning_rows].sum()),
+                           'prorated': float(commission[unpaid_rows].sum())})
+        columns = ['agent', 'total', 'prorated'] if policy == 'prorated' else ['agent', 'total']
+        tables['totals'] = pd.DataFrame(totals).reindex(columns=columns)
+        
+        plan_1000_count, other_plans_count = weighted_plan_groups(plan_levels, matrix['paid'], weights)
+        downline = pd.DataFrame(get_downline_rows(group_type, config, num_weeks),
+                                columns=['client', 'agent', 'rate_1000', 'rate_other'])
+        downline['plan_1000_count'] = plan_1000_count
+        downline['other_plans_count'] = other_plans_count
+        if attribution:
+            agent_books = attributed_downline_counts(matrix, attribution, weights)
+            attributed = downline['agent'].isin(list(agent_books))
+            books = downline.loc[attributed, 'agent'].map(agent_books)
+            downline.loc[attributed, 'plan_1000_count'] = books.str[0]
+            downline.loc[attributed, 'other_plans_count'] = books.str[1]
+        downline['commission'] = downline['plan_1000_count'] * downline['rate_1000'] + downline['other_plans_count'] * downline['rate_other']
+        tables['downline'] = downline
+        
+        if config.get('history'):
+            # Main agents: each employee's weekly commissions; downline: that employee's per-plan rate
+            earning = np.flatnonzero(weights > 0)
+            ledger = [ledger_rows(ssns[earning], 'main', '', agent_name,
+                                  agent_commission_matrix(plan_levels[earning], matrix['freqs'], rates).sum(axis=1))
+                      for agent_name, rates in agent_rates.items()]
+            has_1000, other_only = plan_group_flags(plan_levels, matrix['paid'])
+            for record in downline.itertuples(index=False):
+                per_employee = weights * np.where(has_1000, record.rate_1000, np.where(other_only, record.rate_other, 0))
+                if attribution and record.agent in agent_books:
+                    per_employee = per_employee * (attribution['employee_agent'] == list(attribution['agents']).index(record.agent))
+                ledger.append(ledger_rows(ssns, 'downline', record.client, record.agent, per_employee))
+            tables['ledger'] = pd.concat(ledger, ignore_index=True)
+    
+    enrollment = analyze_enrollment(matrix, [p['date'] for p in packets])
+    tables['enrollment'] = enrollment['employees']
+    tables['enrollment_changes'] = enrollment['periods']
+    
+    return {
+        'basename': get_report_basename(packets, group_type, config),
+        'tables': tables
+    }
+
+def deduction_code_summary(code_tables):
+    """
+    Long table of commission per agent for every deduction code plus a TOTAL code
+    
+    code_tables: {code: model tables computed on that code's payments}
+    Returns: DataFrame with code, section (main/downline/tier), client, agent, commission
+    """
+    frames = []
+    for code, tables in code_tables.items():
+        if 'totals' in tables:
+            frames.append(pd.DataFrame({'code': code, 'section': 'main', 'client': '',
+                                        'agent': tables['totals']['agent'], 'commission': tables['totals']['total']}))
+            downline = tables['downline']
+            frames.append(pd.DataFrame({'code': code, 'section': 'downline', 'client': downline['client'],
+                                        'agent': downline['agent'], 'commission': downline['commission']}))
+        if 'tier' in tables:
+            frames.append(pd.DataFrame({'code': code, 'section': 'tier', 'client': '',
+                                        'agent': tables['tier']['agent'], 'commission': tables['tier']['commission']}))
+    per_code = pd.concat(frames, ignore_index=True)
+    totals = per_code.groupby(['section', 'client', 'agent'], sort=False, as_index=False)['commission'].sum()
+    totals['code'] = 'TOTAL'
+    return pd.concat([per_code, totals[per_code.columns]], ignore_index=True)
+
+def write_deduction_codes_sheet(workbook, packets, group_type, config, matrix, attribution=None,
+                                sheet_name='Deduction Codes'):
+    """
+    'Deduction Codes' sheet: each agent's commission per deduction code and in total
     
-    # Calculate and display sub-agent commissions
-    data_row = header_row + 1
-    sub_agent_total = 0
+    Written only when the run commissions more than the primary code.
+    Returns: True when the sheet was written
+    """
+    if len(active_deduction_codes(config, matrix)) < 2:
+        return False
+    summary = build_commission_model(packets, group_type, config, matrix, attribution)['tables']['codes']
+    codes = list(summary['code'].unique())
+    pivot = summary.pivot_table(index=['section', 'client', 'agent'], columns='code', values='commission',
+                                aggfunc='sum', sort=False).reindex(columns=codes).fillna(0).reset_index()
+    
+    ws = workbook.add_worksheet(sheet_name)
+    ws.set_column(0, 0, 12)
+    ws.set_column(1, 2, 28)
+    ws.set_column(3, 2 + len(codes), 14)
+    ws.write_row(0, 0, ['Section', 'Client', 'Agent'] + codes, get_format(workbook, 'header'))
+    currency_fmt = get_format(workbook, 'currency')
+    total_fmt = get_format(workbook, 'weekly_total')
+    for row, record in enumerate(pivot.itertuples(index=False), 1):
+        ws.write_row(row, 0, record[:3])
+        ws.write_row(row, 3, record[3:-1], currency_fmt)
+        ws.write_number(row, 2 + len(codes), record[-1], total_fmt)
+    ws.freeze_panes(1, 3)
+    return True
+
+def export_commission_model(model, formats, output_folder=None):
+    """
+    Write every model table as Parquet, CSV and/or newline-delimited JSON
+    
+    Files are named {report basename}_{table}.{parquet|csv|jsonl} and each
+    one is written to a temp file and renamed into place.
+    Returns the list of written paths.
+    """
+    extensions = {'parquet': 'parquet', 'csv': 'csv', 'json': 'jsonl'}
+    written = []
     
-    for agent in sub_agents:
-        agent_name = agent.get('name', 'Sub Agent')
-        agent_tier = agent.get('tier', '25')
+    for fmt in formats:
+        if fmt not in extensions:
+            print(f"⚠️ Unknown export format '{fmt}' (choose from {', '.join(EXPORT_FORMATS)})")
+            continue
         
-        agent_commission = calculate_tier_commission(plan_counts, agent_tier)
-        sub_agent_total += agent_commission
+        for table_name, df in model['tables'].items():
+            output = start_output(f"{model['basename']}_{table_name}.{extensions[fmt]}", folder=output_folder)
+            try:
+                if fmt == 'parquet':
+                    df.to_parquet(output['temp'], index=False)
+                elif fmt == 'csv':
+                    df.to_csv(output['temp'], index=False)
+                else:
+                    df.to_json(output['temp'], orient='records', lines=True, date_format='iso')
+            except ImportError as e:
+                print(f"⚠️ Skipping {fmt} extracts: {e}")
+                break
+            written.append(finish_output(output))
+    
+    return written
+
+# ==============================================================================
+# 5B. RECONCILIATION AGAINST A REFERENCE WORKBOOK
+# ==============================================================================
+
+# Deductions and commissions closer than this are treated as equal
+RECONCILE_TOLERANCE = 0.01
+
+def load_reference_workbook(path):
+    """
+    Read a client's reference workbook (Commissions/Unpaid sheets with one
+    PPC125 | plan | agent... block per week) into one row per employee x week
+    
+    Cached cell values are used, so the workbook must have been saved by Excel.
+    Returns: DataFrame with ssn, week, status, deduction, plan and one column per agent
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        if 'Commissions' not in workbook.sheetnames:
+            raise ValueError(f"no 'Commissions' sheet in {os.path.basename(path)}")
+        commission_rows = list(workbook['Commissions'].iter_rows(values_only=True))
+        header = commission_rows[0] if commission_rows else ()
         
-        ws_comm.write(data_row, 0, agent_name)
-        ws_comm.write(data_row, 1, f"Tier {agent_tier}")
-        ws_comm.write(data_row, 2, plan_counts['PPC1600'])
-        ws_comm.write(data_row, 3, plan_counts['PPC1400'])
-        ws_comm.write(data_row, 4, plan_counts['PPC1200'])
-        ws_comm.write(data_row, 5, plan_counts['PPC1000'])
-        ws_comm.write(data_row, 6, agent_commission, fmt_currency)
+        # Week blocks start at each PPC column; agent names follow the plan column up to the gap
+        blocks = [col for col, name in enumerate(header) if isinstance(name, str) and name.strip().upper().startswith('PPC')]
+        if not blocks:
+            raise ValueError(f"no PPC columns in the Commissions header of {os.path.basename(path)}")
+        agent_cols = {}
+        col = blocks[0] + 2
+        while col < len(header) and isinstance(header[col], str) and header[col].strip():
+            agent_cols[header[col].strip()] = col - blocks[0]
+            col += 1
         
-        data_row += 1
+        frames = []
+        for sheet_name, status in (('Commissions', 'perfect'), ('Unpaid', 'unpaid')):
+            if sheet_name not in workbook.sheetnames:
+                continue
+            rows = commission_rows if sheet_name == 'Commissions' else list(workbook[sheet_name].iter_rows(values_only=True))
+            grid = pd.DataFrame(rows[1:]).reindex(columns=range(len(header)))
+            ssns = grid[0].astype('string').str.strip()
+            grid = grid[ssns.notna() & (ssns != '')]
+            ssns = canonicalize_ssns(ssns[grid.index])
+            
+            for week, start in enumerate(blocks, 1):
+                plans = grid[start + 1].astype('string').str.strip()
+                frame = pd.DataFrame({
+                    'ssn': ssns.to_numpy(dtype=object),
+                    'week': week,
+                    'status': status,
+                    'deduction': pd.to_numeric(grid[start], errors='coerce').abs().fillna(0).to_numpy(),
+                    # Error values (#N/A for unpaid weeks) count as no plan
+                    'plan': plans.where(plans.str.startswith('Plan ', na=False), '').to_numpy(dtype=object)
+                })
+                for agent_name, offset in agent_cols.items():
+                    frame[agent_name] = pd.to_numeric(grid[start + offset], errors='coerce').fillna(0).to_numpy()
+                frames.append(frame)
+    finally:
+        workbook.close()
+    
+    return pd.concat(frames, ignore_index=True)
+
+def reconcile_commission_model(model, reference, tolerance=RECONCILE_TOLERANCE):
+    """
+    Align the computed weekly table with a reference workbook on (SSN, week)
     
-    # Main agent commission (their tier + override from sub-agents)
-    data_row += 1
-    main_agent_name = main_agent.get('name', 'Main Agent')
-    main_agent_tier = main_agent.get('tier', '35')
+    Returns: {
+        'mismatches': one row per differing field (ssn, week, field, computed, reference),
+        'totals': computed vs reference grand total per agent (perfect employees only),
+        'summary': counts of rows compared, missing on either side and mismatched fields
+    }
+    """
+    weekly = model['tables']['weekly']
+    agents = [col for col in reference.columns
+              if col in weekly.columns and col not in ('ssn', 'week', 'status', 'deduction', 'plan')]
+    merged = weekly.merge(reference, on=['ssn', 'week'], how='outer', suffixes=('_computed', '_reference'),
+                          indicator=True)
+    both = (merged['_merge'] == 'both').to_numpy()
+    
+    def field_diffs(field, mask, computed, expected):
+        return pd.DataFrame({
+            'ssn': merged['ssn'].to_numpy()[mask],
+            'week': merged['week'].to_numpy()[mask],
+            'field': field,
+            'computed': np.asarray(computed, dtype=object)[mask],
+            'reference': np.asarray(expected, dtype=object)[mask]
+        })
     
-    ws_comm.write(data_row, 0, f"{main_agent_name} (Main Agent)", fmt_client_header)
-    ws_comm.write(data_row, 1, f"Tier {main_agent_tier}", fmt_client_header)
+    only_computed = (merged['_merge'] == 'left_only').to_numpy()
+    only_reference = (merged['_merge'] == 'right_only').to_numpy()
+    present, missing = np.full(len(merged), 'present'), np.full(len(merged), 'missing')
+    diffs = [
+        field_diffs('row', only_computed, present, missing),
+        field_diffs('row', only_reference, missing, present)
+    ]
+    for field in ['status', 'plan', 'deduction'] + agents:
+        computed = merged[f'{field}_computed'].to_numpy()
+        expected = merged[f'{field}_reference'].to_numpy()
+        if field in ('status', 'plan'):
+            differs = computed.astype(str) != expected.astype(str)
+        else:
+            differs = np.abs(computed.astype(float) - expected.astype(float)) > tolerance
+        diffs.append(field_diffs(field, both & differs, computed, expected))
+    
+    mismatches = pd.concat(diffs, ignore_index=True).sort_values(['ssn', 'week'], kind='stable', ignore_index=True)
+    
+    # Grand totals: the workbook sums the Commissions (perfect) sheet only
+    computed_totals = model['tables'].get('totals', pd.DataFrame(columns=['agent', 'total'])).set_index('agent')['total']
+    reference_perfect = reference[reference['status'] == 'perfect']
+    totals = pd.DataFrame({
+        'agent': agents,
+        'computed': [float(computed_totals.get(agent, 0.0)) for agent in agents],
+        'reference': [float(reference_perfect[agent].sum()) for agent in agents]
+    })
+    totals['difference'] = totals['computed'] - totals['reference']
     
-    # Main agent gets their own tier commission
-    main_commission = calculate_tier_commission(plan_counts, main_agent_tier)
+    return {
+        'mismatches': mismatches,
+        'totals': totals,
+        'summary': {
+            'rows_compared': int(both.sum()),
+            'missing_from_reference': int(only_computed.sum()),
+            'missing_from_report': int(only_reference.sum()),
+            'field_mismatches': int((mismatches['field'] != 'row').sum()),
+            'totals_mismatched': int((totals['difference'].abs() > tolerance).sum())
+        }
+    }
+
+def write_reconciliation_report(result, path):
+    """Write the reconciliation summary, per-agent totals and mismatch rows to an xlsx diff report"""
+    workbook = xlsxwriter.Workbook(path)
+    header_fmt = get_format(workbook, 'header')
+    currency_fmt = get_format(workbook, 'currency')
+    
+    ws = workbook.add_worksheet('Summary')
+    ws.set_column(0, 0, 28)
+    ws.set_column(1, 4, 16)
+    ws.write_row(0, 0, ['Check', 'Count'], header_fmt)
+    for row, (check, count) in enumerate(result['summary'].items(), 1):
+        ws.write(row, 0, check.replace('_', ' ').capitalize())
+        ws.write(row, 1, count)
+    
+    totals_row = len(result['summary']) + 2
+    ws.write_row(totals_row, 0, ['Agent', 'Computed', 'Reference', 'Difference'], header_fmt)
+    for row, record in enumerate(result['totals'].itertuples(index=False), totals_row + 1):
+        ws.write(row, 0, record.agent)
+        ws.write_row(row, 1, [record.computed, record.reference, record.difference], currency_fmt)
+    
+    ws = workbook.add_worksheet('Mismatches')
+    ws.set_column(0, 0, 15)
+    ws.set_column(2, 4, 14)
+    columns = list(result['mismatches'].columns)
+    ws.write_row(0, 0, columns, header_fmt)
+    for row, values in enumerate(result['mismatches'].itertuples(index=False), 1):
+        ws.write_row(row, 0, ['' if pd.isna(v) else v for v in values])
+    if len(result['mismatches']):
+        ws.autofilter(0, 0, len(result['mismatches']), len(columns) - 1)
+    ws.freeze_panes(1, 0)
     
-    # Plus override from all sub-agents
-    main_override = 0
-    for agent in sub_agents:
-        agent_tier = agent.get('tier', '25')
-        override = calculate_override_commission(plan_counts, main_agent_tier, agent_tier)
-        main_override += override
+    workbook.close()
+
+# ==============================================================================
+# 5C. COMMISSION HISTORY & CLAWBACKS
+# ==============================================================================
+
+# SQLite ledger of what every agent earned on every employee, per group and month
+COMMISSION_HISTORY_FILE = 'Commission_History.sqlite'
+
+# Shortfalls below half a cent are float noise, not clawbacks
+CLAWBACK_MIN_AMOUNT = 0.005
+
+def ledger_rows(ssns, section, client, agent, amounts):
+    """Ledger records (ssn, section, client, agent, commission) for one agent, zero amounts left out"""
+    amounts = np.asarray(amounts, dtype=float)
+    keep = amounts != 0
+    return pd.DataFrame({'ssn': ssns[keep], 'section': section, 'client': client, 'agent': agent,
+                         'commission': amounts[keep]})
+
+def tier_contribution_rates(tree, owners=None):
+    """
+    What one employee on each plan adds to every agent's tier earnings (own tier plus overrides)
     
-    total_main_commission = main_commission + main_override
+    owners: book owner indexes in use (see tier_owner_index); None for group-wide counts
+    Returns: array (owners x PPC1600/1400/1200/1000 x agents); a single owner row when group-wide
+    """
+    plans = ['PPC1600', 'PPC1400', 'PPC1200', 'PPC1000']
+    unit_counts = dict.fromkeys(plans, 0)
+    num_agents = len(tree['names'])
+    if owners is None:
+        return np.stack([calculate_hierarchy_earnings(tree, dict(unit_counts, **{plan: 1}))['total']
+                         for plan in plans])[None]
+    
+    # Earnings are linear in the books, so one unit book per (owner, plan) gives its share
+    rates = np.zeros((num_agents, len(plans), num_agents))
+    for owner in np.unique(owners):
+        for plan_idx in range(len(plans)):
+            books = np.zeros((num_agents, len(plans)))
+            books[owner, plan_idx] = 1
+            rates[owner, plan_idx] = calculate_hierarchy_earnings(tree, unit_counts, books)['total']
+    return rates
+
+def history_group_key(group_type, config=None):
+    """Key a group's commission history is stored under (group type plus client or group name)"""
+    config = config or {}
+    return f"{group_type}/{config.get('selected_client') or config.get('group_name') or ''}"
+
+def open_commission_history(path=None):
+    """Open (and create if needed) the commission history database"""
+    conn = sqlite3.connect(path or COMMISSION_HISTORY_FILE, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # Clustered on (group, period, ssn): a period's ledger and the latest earlier period are index range scans
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS commissions (
+            group_key TEXT NOT NULL,
+            period TEXT NOT NULL,
+            ssn TEXT NOT NULL,
+            section TEXT NOT NULL,
+            client TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            commission REAL NOT NULL,
+            PRIMARY KEY (group_key, period, ssn, section, client, agent)
+        ) WITHOUT ROWID""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS clawbacks (
+            group_key TEXT NOT NULL,
+            period TEXT NOT NULL,
+            source_period TEXT NOT NULL,
+            ssn TEXT NOT NULL,
+            section TEXT NOT NULL,
+            client TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            clawback REAL NOT NULL,
+            PRIMARY KEY (group_key, period, ssn, section, client, agent)
+        ) WITHOUT ROWID""")
+    conn.commit()
+    return conn
+
+def load_history_period(conn, group_key, period):
+    """Ledger DataFrame (ssn, section, client, agent, commission) recorded for one period"""
+    rows = conn.execute("SELECT ssn, section, client, agent, commission FROM commissions "
+                        "WHERE group_key = ? AND period = ?", (group_key, period)).fetchall()
+    return pd.DataFrame([tuple(row) for row in rows], columns=['ssn', 'section', 'client', 'agent', 'commission'])
+
+def compute_clawbacks(previous, ledger, reversed_ssns):
+    """
+    Commission paid last period that has to come back this period
     
-    ws_comm.write(data_row, 2, plan_counts['PPC1600'])
-    ws_comm.write(data_row, 3, plan_counts['PPC1400'])
-    ws_comm.write(data_row, 4, plan_counts['PPC1200'])
-    ws_comm.write(data_row, 5, plan_counts['PPC1000'])
-    ws_comm.write(data_row, 6, total_main_commission, fmt_total_value)
+    Per SSN and agent: a positive amount last period is clawed back in full when
+    the agent earns nothing on the employee this period (stopped paying, or
+    'reversal' when a deduction was reversed). When the employee was reversed
+    but the agent still earns on them, only the shortfall against last period
+    comes back, so a refund that already cut this period's pay isn't taken twice.
     
-    # Show breakdown
-    data_row += 1
-    ws_comm.write(data_row, 0, f"  • Own Tier {main_agent_tier}", fmt_downline_agent)
-    ws_comm.write(data_row, 6, main_commission, fmt_currency)
-    data_row += 1
-    ws_comm.write(data_row, 0, f"  • Override from Sub-Agents", fmt_downline_agent)
-    ws_comm.write(data_row, 6, main_override, fmt_currency)
+    Returns: DataFrame with ssn, section, client, agent, reason, clawback (negative)
+    """
+    keys = ['ssn', 'section', 'client', 'agent']
+    previous = previous[previous['commission'] > 0]
+    current = ledger.loc[ledger['commission'] > 0].set_index(keys)['commission']
+    earned_now = current.reindex(pd.MultiIndex.from_frame(previous[keys])).fillna(0).to_numpy()
+    paid_before = previous['commission'].to_numpy()
+    reversed_rows = previous['ssn'].isin(reversed_ssns).to_numpy()
+    
+    amount = np.where(earned_now > 0, np.where(reversed_rows, paid_before - earned_now, 0), paid_before)
+    due = amount >= CLAWBACK_MIN_AMOUNT
+    clawbacks = previous.loc[due, keys].reset_index(drop=True)
+    clawbacks['reason'] = np.where(reversed_rows[due], 'reversal', 'stopped paying')
+    clawbacks['clawback'] = -amount[due]
+    return clawbacks
+
+def apply_commission_history(packets, group_type, config, matrix, ledger, path=None):
+    """
+    Record this period's ledger and claw back what the previous period paid on
+    employees who were reversed or stopped paying
     
-    # Grand total
-    data_row += 2
-    ws_comm.write(data_row, 5, "GRAND TOTAL:", fmt_total_header)
-    grand_total = sub_agent_total + total_main_commission
-    ws_comm.write(data_row, 6, grand_total, fmt_total_value)
+    Rerunning a period replaces its ledger; clawbacks always compare against
+    the latest earlier period recorded for the group.
     
-    workbook.close()
+    Returns: {
+        'period', 'previous_period' (None on the first recorded month),
+        'clawbacks': per SSN and agent (see compute_clawbacks),
+        'agents': commission, clawback and net per agent this period
+    }
+    """
+    group_key = history_group_key(group_type, config)
+    period = packets[0]['date'].strftime('%Y-%m')
+    reversed_ssns = matrix['ssns'][matrix['reversed'].any(axis=1)]
+    
+    conn = open_commission_history(path)
+    try:
+        row = conn.execute("SELECT MAX(period) FROM commissions WHERE group_key = ? AND period < ?",
+                           (group_key, period)).fetchone()
+        previous_period = row[0]
+        previous = load_history_period(conn, group_key, previous_period)
+        clawbacks = compute_clawbacks(previous, ledger, reversed_ssns)
+        
+        with conn:
+            conn.execute("DELETE FROM commissions WHERE group_key = ? AND period = ?", (group_key, period))
+            conn.execute("DELETE FROM clawbacks WHERE group_key = ? AND period = ?", (group_key, period))
+            conn.executemany("INSERT INTO commissions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(group_key, period, *record) for record in ledger.itertuples(index=False)])
+            conn.executemany("INSERT INTO clawbacks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(group_key, period, previous_period, *record) for record in clawbacks.itertuples(index=False)])
+    finally:
+        conn.close()
+    
+    keys = ['section', 'client', 'agent']
+    agents = ledger.groupby(keys, sort=False)['commission'].sum().to_frame().join(
+        clawbacks.groupby(keys, sort=False)['clawback'].sum(), how='outer').fillna(0).reset_index()
+    agents['net'] = agents['commission'] + agents['clawback']
+    clawbacks.insert(0, 'source_period', previous_period)
     
-    print(f"\n✅ TIER GROUP REPORT GENERATED: {filename}")
-    print(f"\n📁 Group: {group_name}")
-    print(f"\n👤 Main Agent: {main_agent_name} (Tier {main_agent_tier})")
-    print(f"   • Own Commission: ${main_commission:,.2f}")
-    print(f"   • Override from Sub-Agents: ${main_override:,.2f}")
-    print(f"   • Total: ${total_main_commission:,.2f}")
+    return {
+        'period': period,
+        'previous_period': previous_period,
+        'clawbacks': clawbacks,
+        'agents': agents
+    }
+
+def write_clawbacks_sheet(workbook, history):
+    """'Clawbacks' sheet: commission, clawback and net per agent, then every clawed-back employee"""
+    ws = workbook.add_worksheet('Clawbacks')
+    fmt_header = get_format(workbook, 'header')
+    fmt_text = get_format(workbook, 'text')
+    fmt_currency = get_format(workbook, 'currency')
+    fmt_total = get_format(workbook, 'weekly_total')
+    ws.set_column(0, 0, 15)
+    ws.set_column(1, 3, 24)
+    ws.set_column(4, 6, 14)
+    
+    previous = history['previous_period'] or 'none recorded'
+    ws.write(0, 0, f"Period {history['period']} - clawbacks of commission paid in {previous}", fmt_header)
+    
+    ws.write_row(2, 0, ['Section', 'Client', 'Agent', 'Commission', 'Clawback', 'Net'], fmt_header)
+    agents = history['agents']
+    for row, record in enumerate(agents.itertuples(index=False), 3):
+        ws.write_row(row, 0, [record.section, record.client, record.agent])
+        ws.write_row(row, 3, [record.commission, record.clawback], fmt_currency)
+        ws.write_number(row, 5, record.net, fmt_total)
+    
+    row = len(agents) + 5
+    ws.write_row(row, 0, ['SSN', 'Section', 'Client', 'Agent', 'Reason', 'Clawback', 'Paid In'], fmt_header)
+    for row, record in enumerate(history['clawbacks'].itertuples(index=False), row + 1):
+        ws.write_string(row, 0, record.ssn, fmt_text)
+        ws.write_row(row, 1, [record.section, record.client, record.agent, record.reason])
+        ws.write_number(row, 5, record.clawback, fmt_currency)
+        ws.write(row, 6, record.source_period)
+    ws.freeze_panes(3, 0)
+
+# ==============================================================================
+# 5D. AGENT STATEMENTS (one file per agent, rendered in parallel)
+# ==============================================================================
+
+# Statement file formats; 'pdf' needs the fpdf package (as python script/main.py uses)
+STATEMENT_FORMATS = ['xlsx', 'pdf']
+
+# Below this many statements, rendering in-process beats starting worker processes
+STATEMENT_POOL_MIN = 20
+
+def build_agent_statements(model, group_label, period):
+    """
+    One statement per agent from the commission model: every line the agent
+    is paid on this period (weekly commission, downline counts x rates, tier
+    plans and overrides, clawbacks) and the total
     
-    if sub_agents:
-        print(f"\n👥 Sub-Agents: {len(sub_agents)}")
-        for agent in sub_agents:
-            agent_name = agent.get('name')
-            agent_tier = agent.get('tier')
-            comm = calculate_tier_commission(plan_counts, agent_tier)
-            print(f"   - {agent_name} (Tier {agent_tier}): ${comm:,.2f}")
-        print(f"\n💵 Sub-Agents Total: ${sub_agent_total:,.2f}")
+    Returns: [{'agent', 'group', 'period', 'lines': [(item, detail, amount), ...], 'total'}]
+    """
+    tables = model['tables']
+    lines = {}
+    
+    if 'totals' in tables:
+        # Same employees as the grand totals: perfect ones, plus unpaid ones when prorated
+        weekly = tables['weekly']
+        if 'prorated' not in tables['totals'].columns:
+            weekly = weekly[weekly['status'] == 'perfect']
+        for agent in tables['totals']['agent']:
+            amounts = weekly.groupby('pay_date')[agent].sum()
+            employees = weekly[agent].gt(0).groupby(weekly['pay_date']).sum()
+            lines[agent] = [(f"Week of {pay_date:%m/%d/%Y}", f"{count} employee(s)", amount)
+                            for pay_date, amount, count in zip(amounts.index, amounts.to_numpy(), employees.to_numpy())]
+        
+        for record in tables['downline'].itertuples(index=False):
+            client = f"{record.client} - " if record.client else ""
+            lines.setdefault(record.agent, []).extend([
+                (f"{client}Plan 1000", f"{record.plan_1000_count:g} x ${record.rate_1000:,.2f}",
+                 record.plan_1000_count * record.rate_1000),
+                (f"{client}Other plans", f"{record.other_plans_count:g} x ${record.rate_other:,.2f}",
+                 record.other_plans_count * record.rate_other)
+            ])
+    
+    if 'tier' in tables:
+        for record in tables['tier'].to_dict('records'):
+            rates = TIER_RATES.get(record['tier'], {})
+            agent_lines = lines.setdefault(record['agent'], [])
+            for plan in ('PPC1600', 'PPC1400', 'PPC1200', 'PPC1000'):
+                rate = rates.get(plan, 0)
+                agent_lines.append((f"Tier {record['tier']} - {plan}", f"{record[plan]:g} x ${rate:,.2f}", record[plan] * rate))
+            agent_lines.append(("Override on sub-agents", "", record['override']))
+    
+    if 'clawbacks' in tables:
+        for agent, rows in tables['clawbacks'].groupby('agent', sort=False):
+            lines.setdefault(agent, []).append((f"Clawbacks (paid in {rows['source_period'].iloc[0]})",
+                                                f"{rows['ssn'].nunique()} employee(s)", rows['clawback'].sum()))
+    
+    statements = []
+    for agent, agent_lines in lines.items():
+        agent_lines = [(item, detail, float(amount)) for item, detail, amount in agent_lines if amount]
+        statements.append({
+            'agent': str(agent),
+            'group': group_label,
+            'period': period,
+            'lines': agent_lines,
+            'total': sum(amount for _, _, amount in agent_lines)
+        })
+    return statements
+
+def write_statement_xlsx(statement, path):
+    """Single-sheet statement workbook"""
+    workbook = xlsxwriter.Workbook(path)
+    ws = workbook.add_worksheet('Statement')
+    fmt_header = get_format(workbook, 'header')
+    fmt_currency = get_format(workbook, 'currency')
+    fmt_total_header = get_format(workbook, 'total_header')
+    fmt_total_value = get_format(workbook, 'total_value')
+    ws.set_column(0, 0, 36)
+    ws.set_column(1, 1, 22)
+    ws.set_column(2, 2, 16)
+    
+    ws.merge_range(0, 0, 0, 2, f"Commission Statement - {statement['agent']}", fmt_total_header)
+    ws.write(1, 0, statement['group'])
+    ws.write(2, 0, f"Period: {statement['period']}")
+    
+    ws.write_row(4, 0, ['Item', 'Detail', 'Amount'], fmt_header)
+    for row, (item, detail, amount) in enumerate(statement['lines'], 5):
+        ws.write(row, 0, item)
+        ws.write(row, 1, detail)
+        ws.write_number(row, 2, amount, fmt_currency)
+    
+    total_row = len(statement['lines']) + 6
+    ws.write(total_row, 1, "TOTAL", fmt_total_header)
+    ws.write_number(total_row, 2, statement['total'], fmt_total_value)
+    workbook.close()
+
+def write_statement_pdf(statement, path):
+    """One-page PDF statement (fpdf core fonts, so text is limited to Latin-1)"""
+    from fpdf import FPDF
+    
+    def text(value):
+        return str(value).encode('latin-1', 'replace').decode('latin-1')
+    
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font('Arial', 'B', 16)
+    pdf.cell(0, 10, text(f"Commission Statement - {statement['agent']}"), 0, 1, 'C')
+    pdf.set_font('Arial', '', 11)
+    pdf.cell(0, 6, text(statement['group']), 0, 1)
+    pdf.cell(0, 6, text(f"Period: {statement['period']}"), 0, 1)
+    pdf.ln(4)
+    
+    widths = (95, 55, 40)
+    pdf.set_font('Arial', 'B', 11)
+    pdf.set_fill_color(230, 230, 230)
+    for label, width in zip(('Item', 'Detail', 'Amount'), widths):
+        pdf.cell(width, 8, label, 1, 0, 'L', 1)
+    pdf.ln()
+    
+    pdf.set_font('Arial', '', 10)
+    for item, detail, amount in statement['lines']:
+        pdf.cell(widths[0], 7, text(item), 1)
+        pdf.cell(widths[1], 7, text(detail), 1)
+        pdf.cell(widths[2], 7, f"${amount:,.2f}", 1, 1, 'R')
+    
+    pdf.set_font('Arial', 'B', 11)
+    pdf.cell(widths[0] + widths[1], 8, "TOTAL", 1, 0, 'R', 1)
+    pdf.cell(widths[2], 8, f"${statement['total']:,.2f}", 1, 1, 'R', 1)
+    pdf.output(path)
+
+def statement_filename(basename, agent, fmt):
+    """{report basename}_Statement_{agent}.{fmt}, with characters paths can't hold replaced"""
+    safe_agent = re.sub(r'[^\w .-]', '-', agent).strip() or 'Agent'
+    return f"{basename}_Statement_{safe_agent}.{fmt}"
+
+def render_agent_statement(job):
+    """Write one statement; job = (statement, format, filename, folder). Runs in a worker process."""
+    statement, fmt, filename, folder = job
+    output = start_output(filename, folder=folder)
+    if fmt == 'pdf':
+        write_statement_pdf(statement, output['temp'])
     else:
-        print(f"\n👥 Sub-Agents: None")
+        write_statement_xlsx(statement, output['temp'])
+    return finish_output(output)
+
+def write_agent_statements(statements, basename, formats, output_folder=None, workers=None):
+    """
+    Render every statement in every requested format, across a process pool
+    once there are enough of them to pay for starting the workers
     
-    print(f"\n💰 GRAND TOTAL: ${grand_total:,.2f}")
-    print(f"� Frequency: {freq_name} (÷{freq_val})")
-    print(f"📅 Date Range: {packets[0]['date'].strftime('%m/%d/%Y')} - {packets[-1]['date'].strftime('%m/%d/%Y')}")
-    print(f"✅ Perfect Employees: {len(perfect_employees)}")
-    print(f"   - PPC1600: {plan_counts['PPC1600']}")
-    print(f"   - PPC1400: {plan_counts['PPC1400']}")
-    print(f"   - PPC1200: {plan_counts['PPC1200']}")
-    print(f"   - PPC1000: {plan_counts['PPC1000']}")
+    Returns the list of written paths.
+    """
+    formats = list(formats)
+    if 'pdf' in formats and importlib.util.find_spec('fpdf') is None:
+        print("⚠️ PDF statements need the fpdf package (pip install fpdf); writing xlsx statements instead")
+        formats = list(dict.fromkeys(['xlsx' if fmt == 'pdf' else fmt for fmt in formats]))
+    
+    folder = output_folder or OUTPUT_FOLDER
+    jobs = [(statement, fmt, statement_filename(basename, statement['agent'], fmt), folder)
+            for statement in statements for fmt in formats]
+    max_workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if max_workers <= 1 or len(jobs) < STATEMENT_POOL_MIN:
+        return [render_agent_statement(job) for job in jobs]
+    
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(render_agent_statement, jobs, chunksize=max(1, len(jobs) // (max_workers * 4))))
 
 # ==============================================================================
-# 5. MAIN REPORT BUILDER (Router)
+# 6. MAIN REPORT BUILDER (Router)
 # ==============================================================================
 
-def build_full_report(packets, group_type=GROUP_TYPE_HARRY, config=None):
+def prepare_folders():
+    """Create the input/output folders on run (importing this module touches no files)"""
+    os.makedirs(INPUT_FOLDER, exist_ok=True)
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+def build_full_report(packets, group_type=GROUP_TYPE_HARRY, config=None, matrix=None):
     """
     Main report builder - routes to appropriate sub-builder
     
@@ -1811,26 +3776,594 @@ def build_full_report(packets, group_type=GROUP_TYPE_HARRY, config=None):
         packets: Processed employee data
         group_type: "Harry's Group", "Adam's Group", "Tier-based", or "Dynamic Group"
         config: Configuration dict containing group-specific settings
+                (optional 'exports': list of EXPORT_FORMATS to write alongside the xlsx,
+                 optional 'assignments': agent assignment table, defaults to ASSIGNMENTS_FILE if present,
+                 optional 'sheets': subset of SHEET_SECTIONS to write for Harry's/Adam's Group,
+                 optional 'reference': client reference workbook to reconcile the report against,
+                 optional 'naming': OUTPUT_NAMING_MODES entry for an existing report file,
+                 optional 'deduction_codes': DEDUCTION_CODES to commission next to the primary code,
+                 optional 'proration': PRORATION_POLICIES entry for employees who missed a week,
+                 optional 'history': commission history database to record the period in and claw back from,
+                 optional 'statements': STATEMENT_FORMATS to write one statement per agent in)
+        matrix: payment matrix of the packets, built here when not given
+    
+    Returns: the commission model when exports, reconciliation, statements or the history needed one, else None
     """
+    if group_type not in (GROUP_TYPE_HARRY, GROUP_TYPE_ADAM) and not config:
+        mode = "Dynamic Group" if group_type == GROUP_TYPE_DYNAMIC else "Tier-based Groups"
+        print(f"❌ Group configuration required for {mode} mode!")
+        return
+    
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    
+    # One payment matrix feeds the workbook and any data extracts
+    if matrix is None and packets:
+        matrix = build_payment_matrix(packets)
+    
+    # Credit agents with their own book when an assignment table is available
+    attribution = None
+    assignments_path = (config or {}).get('assignments')
+    if not assignments_path and os.path.exists(ASSIGNMENTS_FILE):
+        assignments_path = ASSIGNMENTS_FILE
+    if matrix is not None and assignments_path:
+        try:
+            attribution = attribute_employees(matrix, load_agent_assignments(assignments_path))
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Ignoring agent assignments ({assignments_path}): {e}")
+        else:
+            num_assigned = int((attribution['employee_agent'] >= 0).sum())
+            print(f"🧾 Agent assignments: {num_assigned} of {len(matrix['ssns'])} employees "
+                  f"attributed to {len(attribution['agents'])} agent(s)")
+    
+    sheets = config.get('sheets') if config else None
+    naming = config.get('naming') if config else None
+    deduction_codes = config.get('deduction_codes') if config else None
+    proration = proration_policy(config)
+    unknown_sheets = set(sheets or []) - set(SHEET_SECTIONS)
+    if unknown_sheets:
+        print(f"⚠️ Unknown sheet section(s) {', '.join(sorted(unknown_sheets))} (choose from {', '.join(SHEET_SECTIONS)})")
+    if sheets and group_type not in (GROUP_TYPE_HARRY, GROUP_TYPE_ADAM):
+        print("ℹ️ Sheet selection applies to Harry's/Adam's Group reports; writing the full workbook")
+    if proration == 'prorated':
+        print("💸 Proration: unpaid employees earn on the weeks they paid")
+    
+    # Month-to-month history: record this period's ledger, claw back what the last one paid
+    model = None
+    history = None
+    history_path = config.get('history') if config else None
+    if packets and history_path:
+        model = build_commission_model(packets, group_type, config, matrix=matrix, attribution=attribution)
+        history = apply_commission_history(packets, group_type, config, matrix, model['tables']['ledger'],
+                                           history_path if isinstance(history_path, str) else None)
+        model['tables']['clawbacks'] = history['clawbacks']
+        model['tables']['clawback_agents'] = history['agents']
+        if history['previous_period'] is None:
+            print(f"📒 Commission history: {history['period']} is the first period recorded for this group")
+        else:
+            print(f"📒 Commission history: {len(history['clawbacks'])} clawback(s) of commission paid in "
+                  f"{history['previous_period']} (${-history['clawbacks']['clawback'].sum():,.2f})")
+    
     if group_type == GROUP_TYPE_HARRY:
         selected_client = config.get('selected_client') if config else None
-        build_harry_group_report(packets, selected_client, group_type=GROUP_TYPE_HARRY)
+        build_harry_group_report(packets, selected_client, group_type=GROUP_TYPE_HARRY, matrix=matrix,
+                                 attribution=attribution, sheets=sheets, naming=naming, deduction_codes=deduction_codes,
+                                 proration=proration, history=history)
     elif group_type == GROUP_TYPE_ADAM:
-        build_harry_group_report(packets, selected_client=None, group_type=GROUP_TYPE_ADAM)
+        build_harry_group_report(packets, selected_client=None, group_type=GROUP_TYPE_ADAM, matrix=matrix,
+                                 attribution=attribution, sheets=sheets, naming=naming, deduction_codes=deduction_codes,
+                                 proration=proration, history=history)
     elif group_type == GROUP_TYPE_DYNAMIC:
-        if not config:
-            print("❌ Group configuration required for Dynamic Group mode!")
-            return
-        build_dynamic_group_report(packets, config)
+        build_dynamic_group_report(packets, config, matrix=matrix, attribution=attribution, history=history)
     else:
         # Other Groups (Tier-based)
-        if not config:
-            print("❌ Group configuration required for Tier-based Groups mode!")
-            return
-        build_tier_group_report(packets, config)
+        build_tier_group_report(packets, config, matrix=matrix, attribution=attribution, history=history)
+    
+    exports = config.get('exports') if config else None
+    reference_path = config.get('reference') if config else None
+    statement_formats = config.get('statements') if config else None
+    if model is None and packets and (exports or reference_path or statement_formats):
+        model = build_commission_model(packets, group_type, config, matrix=matrix, attribution=attribution)
+    
+    if model is not None and exports:
+        written = export_commission_model(model, exports)
+        if written:
+            print(f"\n📤 Data extracts written: {len(written)} file(s)")
+            for path in written:
+                print(f"   • {os.path.basename(path)}")
+    
+    if model is not None and statement_formats:
+        group_label = config.get('group_name') or config.get('selected_client') or group_type
+        period = f"{packets[0]['date']:%m/%d/%Y} - {packets[-1]['date']:%m/%d/%Y}"
+        statements = build_agent_statements(model, group_label, period)
+        written = write_agent_statements(statements, model['basename'], statement_formats, workers=config.get('workers'))
+        print(f"\n🧾 Agent statements written: {len(written)} file(s) for {len(statements)} agent(s)")
+    
+    if model is not None and reference_path:
+        if 'totals' not in model['tables']:
+            print("ℹ️ Reconciliation compares Harry's/Adam's/Dynamic Group reports; skipping")
+            return model
+        try:
+            reference = load_reference_workbook(reference_path)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not read reference workbook ({reference_path}): {e}")
+            return model
+        result = reconcile_commission_model(model, reference)
+        output = start_output(f"{model['basename']}_reconciliation.xlsx")
+        write_reconciliation_report(result, output['temp'])
+        report_path = finish_output(output)
+        
+        summary = result['summary']
+        print(f"\n🔍 Reconciled against {os.path.basename(reference_path)}: {os.path.basename(report_path)}")
+        print(f"   • Rows compared: {summary['rows_compared']}")
+        print(f"   • Missing from reference: {summary['missing_from_reference']}, missing from report: {summary['missing_from_report']}")
+        print(f"   • Field mismatches: {summary['field_mismatches']}, agent totals off: {summary['totals_mismatched']}")
+    
+    return model
+
+# ==============================================================================
+# 6B. REPORT JOB QUEUE (resumable batch runs)
+# ==============================================================================
+
+# SQLite file holding one row per report job and the stage it reached
+JOB_QUEUE_FILE = 'Report_Jobs.sqlite'
+
+# Checkpoints in order; a job resumes after the last one it reached
+JOB_STAGES = ['queued', 'ingested', 'classified', 'rendered', 'written']
+
+# Retries back off exponentially: base * 2^(attempt - 1) seconds
+JOB_MAX_ATTEMPTS = 4
+JOB_RETRY_BASE_SECONDS = 30
+
+# A 'running' job not updated for this long is treated as crashed and reclaimed
+JOB_STALE_SECONDS = 3600
+
+def open_job_queue(path=None):
+    """Open (and create if needed) the job queue database"""
+    conn = sqlite3.connect(path or JOB_QUEUE_FILE, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            job_key TEXT UNIQUE NOT NULL,
+            group_type TEXT NOT NULL,
+            config TEXT NOT NULL,
+            input_folder TEXT NOT NULL,
+            output_folder TEXT NOT NULL,
+            stage TEXT NOT NULL DEFAULT 'queued',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            outputs TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""")
+    conn.commit()
+    return conn
+
+def input_fingerprint(input_folder):
+    """Name, size and mtime of every payroll file, so new or edited inputs make a new job"""
+    entries = []
+    for root, _, files in os.walk(input_folder):
+        for name in sorted(files):
+            if name.endswith(('.csv', '.xlsx', '.xls')):
+                stat = os.stat(os.path.join(root, name))
+                entries.append([os.path.relpath(os.path.join(root, name), input_folder), stat.st_size, stat.st_mtime_ns])
+    return sorted(entries)
+
+def enqueue_report_job(conn, group_type, config, input_folder=None, output_folder=None):
+    """
+    Add a report job (or find the existing one for the same group, config and inputs)
+    
+    Returns: job id
+    """
+    input_folder = os.path.abspath(input_folder or INPUT_FOLDER)
+    output_folder = os.path.abspath(output_folder or OUTPUT_FOLDER)
+    config_json = json.dumps(config or {}, sort_keys=True, default=str)
+    job_key = hashlib.sha256(json.dumps(
+        [group_type, config_json, input_folder, output_folder, input_fingerprint(input_folder)]).encode()).hexdigest()
+    
+    now = time.time()
+    # Asking again for a job that gave up starts its retries over
+    conn.execute("UPDATE jobs SET status = 'pending', attempts = 0, next_attempt_at = 0 WHERE job_key = ? AND status = 'failed'",
+                 (job_key,))
+    conn.execute(
+        "INSERT OR IGNORE INTO jobs (job_key, group_type, config, input_folder, output_folder, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (job_key, group_type, config_json, input_folder, output_folder, now, now))
+    conn.commit()
+    return conn.execute("SELECT id FROM jobs WHERE job_key = ?", (job_key,)).fetchone()['id']
+
+def job_staging_folder(job):
+    """Per-job folder next to the outputs (same filesystem, so the final move is an atomic rename)"""
+    return os.path.join(job['output_folder'], '.jobs', str(job['id']))
+
+def claim_job(conn, job_id):
+    """Mark a job as running unless another process holds it; True when claimed"""
+    now = time.time()
+    cursor = conn.execute(
+        "UPDATE jobs SET status = 'running', updated_at = ? "
+        "WHERE id = ? AND (status = 'pending' OR (status = 'running' AND updated_at < ?))",
+        (now, job_id, now - JOB_STALE_SECONDS))
+    conn.commit()
+    return cursor.rowcount == 1
+
+def run_report_job(conn, job_id):
+    """
+    Run a claimed job from its last checkpoint to 'written'
+    
+    Stages: ingested (packets pickled), classified (payment matrix pickled),
+    rendered (workbook + extracts in the job's staging folder), written
+    (files renamed into the output folder). A failure records the error and
+    schedules a retry with exponential back-off; after JOB_MAX_ATTEMPTS the
+    job is marked failed.
+    
+    Returns: True when the job reached 'written'
+    """
+    global OUTPUT_FOLDER
+    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    config = json.loads(job['config'])
+    staging = job_staging_folder(job)
+    os.makedirs(staging, exist_ok=True)
+    packets_path = os.path.join(staging, 'packets.pkl')
+    matrix_path = os.path.join(staging, 'matrix.pkl')
+    rendered_folder = os.path.join(staging, 'rendered')
+    consolidated = bool(config.get('consolidated'))
+    
+    def checkpoint(stage, **fields):
+        assignments = ''.join(f", {name} = ?" for name in fields)
+        conn.execute(f"UPDATE jobs SET stage = ?, updated_at = ?{assignments} WHERE id = ?",
+                     (stage, time.time(), *fields.values(), job_id))
+        conn.commit()
+        print(f"   ✓ Job {job_id}: {stage}")
+    
+    def load_pickle(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    
+    def save_pickle(obj, path):
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    
+    # Step back past any checkpoint whose files are gone (e.g. a cleaned-up staging folder)
+    stage = job['stage']
+    if stage == 'rendered' and not os.path.isdir(rendered_folder):
+        stage = 'classified'
+    if stage == 'classified' and not consolidated and not os.path.exists(matrix_path):
+        stage = 'ingested'
+    if stage == 'ingested' and not consolidated and not os.path.exists(packets_path):
+        stage = 'queued'
+    
+    try:
+        packets = matrix = None
+        if JOB_STAGES.index(stage) < JOB_STAGES.index('ingested'):
+            # The consolidated report ingests each client folder itself while rendering
+            if not consolidated:
+                packets = process_raw_files(job['input_folder'])
+                if not packets:
+                    raise ValueError(f"no valid payroll files in {job['input_folder']}")
+                save_pickle(packets, packets_path)
+            stage = 'ingested'
+            checkpoint(stage)
+        
+        if JOB_STAGES.index(stage) < JOB_STAGES.index('classified'):
+            if not consolidated:
+                packets = load_pickle(packets_path)
+                matrix = build_payment_matrix(packets)
+                save_pickle(matrix, matrix_path)
+            stage = 'classified'
+            checkpoint(stage)
+        
+        if JOB_STAGES.index(stage) < JOB_STAGES.index('rendered'):
+            shutil.rmtree(rendered_folder, ignore_errors=True)
+            output_folder, OUTPUT_FOLDER = OUTPUT_FOLDER, rendered_folder
+            try:
+                if consolidated:
+                    built = build_consolidated_harry_report(config, job['input_folder']) is not None
+                else:
+                    if packets is None:
+                        packets = load_pickle(packets_path)
+                    if matrix is None:
+                        matrix = load_pickle(matrix_path)
+                    build_full_report(packets, job['group_type'], config, matrix=matrix)
+                    built = True
+            finally:
+                OUTPUT_FOLDER = output_folder
+            outputs = sorted(os.listdir(rendered_folder)) if os.path.isdir(rendered_folder) else []
+            if not built or not outputs:
+                raise ValueError("the report builder wrote no files")
+            stage = 'rendered'
+            checkpoint(stage, outputs=json.dumps(outputs))
+        
+        # Check every target first so a locked workbook doesn't leave a half-moved set
+        outputs = json.loads(conn.execute("SELECT outputs FROM jobs WHERE id = ?", (job_id,)).fetchone()['outputs'])
+        os.makedirs(job['output_folder'], exist_ok=True)
+        # Hashed names were already given while rendering
+        naming = config.get('naming') or 'overwrite'
+        if naming == 'hashed':
+            naming = 'overwrite'
+        pending = [name for name in outputs if os.path.exists(os.path.join(rendered_folder, name))]
+        locked = [lock for name in pending for lock in output_lock_files(os.path.join(job['output_folder'], name))]
+        if locked and naming != 'versioned':
+            raise OutputLockedError(f"close the open workbook(s) first: {', '.join(os.path.basename(l) for l in locked)}")
+        for name in pending:
+            place_output_file(os.path.join(rendered_folder, name), os.path.join(job['output_folder'], name), naming)
+        checkpoint('written', status='done', last_error=None)
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(staging))
+        except OSError:
+            pass  # other jobs still staged
+        return True
+    
+    except Exception as e:
+        attempts = job['attempts'] + 1
+        status = 'failed' if attempts >= JOB_MAX_ATTEMPTS else 'pending'
+        delay = JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+        conn.execute(
+            "UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (status, attempts, time.time() + delay, f"{type(e).__name__}: {e}", time.time(), job_id))
+        conn.commit()
+        retry = f"retry in {delay}s" if status == 'pending' else f"giving up after {attempts} attempts"
+        print(f"   ❌ Job {job_id} failed after '{stage}' ({type(e).__name__}: {e}); {retry}")
+        return False
+
+def run_job_queue(conn, job_ids=None, wait=True):
+    """
+    Run pending jobs (all, or just job_ids) until each is written or failed
+    
+    Jobs waiting on a back-off are retried when it expires if wait is True;
+    otherwise they are left for the next run.
+    Returns: {job id: final status}
+    """
+    while True:
+        query = "SELECT id, status, next_attempt_at FROM jobs WHERE status IN ('pending', 'running')"
+        rows = conn.execute(query).fetchall()
+        if job_ids is not None:
+            rows = [row for row in rows if row['id'] in job_ids]
+        now = time.time()
+        ready = [row['id'] for row in rows if row['next_attempt_at'] <= now]
+        
+        ran = False
+        for job_id in ready:
+            if claim_job(conn, job_id):
+                print(f"\n🧾 Running report job {job_id}")
+                run_report_job(conn, job_id)
+                ran = True
+        
+        waiting = [row['next_attempt_at'] for row in rows if row['status'] == 'pending' and row['next_attempt_at'] > now]
+        if not ran and not (wait and waiting):
+            break
+        if not ran:
+            time.sleep(max(0.0, min(waiting) - time.time()))
+    
+    rows = conn.execute("SELECT id, status FROM jobs").fetchall()
+    return {row['id']: row['status'] for row in rows if job_ids is None or row['id'] in job_ids}
+
+def print_job_summary(conn, job_ids=None):
+    """One line per job: stage reached, status, attempts and the last error"""
+    rows = conn.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+    print("\n🧾 Report jobs:")
+    for row in rows:
+        if job_ids is not None and row['id'] not in job_ids:
+            continue
+        line = f"   • Job {row['id']} ({row['group_type']}): {row['stage']} - {row['status']}"
+        if row['status'] == 'pending' and row['attempts']:
+            retry_at = datetime.datetime.fromtimestamp(row['next_attempt_at']).strftime('%H:%M:%S')
+            line += f", attempt {row['attempts'] + 1} after {retry_at}"
+        if row['last_error'] and row['status'] != 'done':
+            line += f" ({row['last_error']})"
+        print(line)
+
+# ==============================================================================
+# 6C. REPORT CACHE (content-addressed memoization)
+# ==============================================================================
+
+# Rendered reports stored by content key; an unchanged rerun copies them back out
+REPORT_CACHE_FOLDER = 'Report_Cache'
+
+# Least recently used entries are evicted once the cache grows past this
+REPORT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Config keys that only change how files are delivered, not what is computed
+REPORT_CACHE_IGNORED_KEYS = ('naming', 'workers')
+
+# Rate tables every commission depends on (part of the cache key)
+RATE_TABLES = ['PLAN_MAP', 'PLAN_THRESHOLDS', 'FREQUENCY_PERIODS', 'PLAN_COUNT_LABELS', 'HARRY_DOWNLINE_RATES',
+               'HARRY_MAIN_AGENT_RATES', 'CONFIDENCE_MULTIPLIERS', 'ADAMS_GROUP_AGENTS', 'TIER_RATES']
+
+def file_sha256(path):
+    """SHA-256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def folder_size(folder):
+    """Total bytes of the files under folder (files removed meanwhile count as 0)"""
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def report_cache_key(group_type, config, input_folder=None):
+    """
+    Content key of a report: the payroll files (by content, not mtime), the
+    group config, the files it points to, the rate tables and this module's source
+    """
+    input_folder = input_folder or INPUT_FOLDER
+    inputs = []
+    for root, _, files in os.walk(input_folder):
+        for name in files:
+            if name.endswith(('.csv', '.xlsx', '.xls')) and not name.startswith('~$'):
+                path = os.path.join(root, name)
+                inputs.append([os.path.relpath(path, input_folder).replace(os.sep, '/'), file_sha256(path)])
+    
+    config = {k: v for k, v in (config or {}).items() if k not in REPORT_CACHE_IGNORED_KEYS}
+    # The default assignment table applies whenever it is present, so it counts too
+    referenced = {}
+    assignments_path = config.get('assignments') or (ASSIGNMENTS_FILE if os.path.exists(ASSIGNMENTS_FILE) else None)
+    for name, path in (('assignments', assignments_path), ('reference', config.get('reference'))):
+        if path:
+            referenced[name] = file_sha256(path) if os.path.exists(path) else None
+    
+    rates = {name: repr(globals()[name]) for name in RATE_TABLES}
+    code_version = file_sha256(os.path.abspath(__file__))
+    payload = json.dumps([group_type, config, sorted(inputs), referenced, rates, code_version],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def report_cache_entry(key, cache_folder=None):
+    """
+    The cache entry folder for key, or None
+    
+    A hit touches the entry's metadata; its mtime is the last use LRU eviction goes by.
+    """
+    entry = os.path.join(cache_folder or REPORT_CACHE_FOLDER, key)
+    meta_path = os.path.join(entry, 'entry.json')
+    try:
+        os.utime(meta_path)
+    except OSError:
+        return None
+    return entry
+
+def report_cache_outputs(entry):
+    """File names of the reports stored in a cache entry"""
+    with open(os.path.join(entry, 'entry.json'), encoding='utf-8') as f:
+        return json.load(f)['outputs']
+
+def store_report_cache_entry(staging, key, outputs, model=None, cache_folder=None):
+    """
+    Turn a staging folder of rendered reports into the cache entry for key
+    
+    The folder is renamed into place whole, so readers never see a partial
+    entry; when a concurrent run stored the same key first, its identical
+    entry is kept. Evicts old entries afterwards.
+    Returns: the entry folder
+    """
+    cache_folder = cache_folder or REPORT_CACHE_FOLDER
+    if model is not None:
+        with open(os.path.join(staging, 'model.pkl'), 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(staging, 'entry.json'), 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'outputs': outputs, 'created_at': time.time()}, f)
+    
+    entry = os.path.join(cache_folder, key)
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+    evict_report_cache(cache_folder, keep=key)
+    return entry
+
+def evict_report_cache(cache_folder=None, max_bytes=None, keep=None):
+    """
+    Delete least recently used entries until the cache fits in max_bytes
+    (staging folders left by crashed runs go once they are stale)
+    
+    Returns: keys of the evicted entries
+    """
+    cache_folder = cache_folder or REPORT_CACHE_FOLDER
+    max_bytes = REPORT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        try:
+            if name.startswith('.'):
+                if time.time() - os.path.getmtime(path) > JOB_STALE_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            last_used = os.path.getmtime(os.path.join(path, 'entry.json'))
+        except OSError:
+            continue
+        entries.append((last_used, name, folder_size(path)))
+    
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_folder, name), ignore_errors=True)
+        total -= size
+        evicted.append(name)
+    return evicted
+
+def deliver_cached_outputs(entry, naming=None, folder=None):
+    """Copy a cache entry's reports into the output folder; returns the written paths"""
+    written = []
+    for name in report_cache_outputs(entry):
+        output = start_output(name, naming, folder)
+        shutil.copyfile(os.path.join(entry, name), output['temp'])
+        written.append(finish_output(output))
+    return written
+
+def cached_report_model(group_type, config, input_folder=None):
+    """
+    The commission model stored with an unchanged report, or None (no entry, or
+    the report was built without exports/reconciliation so no model was computed)
+    """
+    entry = report_cache_entry(report_cache_key(group_type, config, input_folder))
+    model_path = os.path.join(entry, 'model.pkl') if entry else None
+    if not model_path or not os.path.exists(model_path):
+        return None
+    with open(model_path, 'rb') as f:
+        return pickle.load(f)
+
+def run_cached_report(group_type, config, input_folder=None):
+    """
+    Build a report through the cache
+    
+    A key that is already cached copies the stored files straight into the
+    output folder. Otherwise the report renders into a staging folder inside
+    the cache (naming mode applied only on delivery, so 'hashed' and
+    'versioned' names stay per-run), becomes the entry and is then delivered.
+    Returns: (written paths, True on a cache hit); no paths when nothing was built
+    """
+    global OUTPUT_FOLDER
+    input_folder = input_folder or INPUT_FOLDER
+    naming = config.get('naming')
+    key = report_cache_key(group_type, config, input_folder)
+    entry = report_cache_entry(key)
+    if entry:
+        return deliver_cached_outputs(entry, naming), True
+    
+    staging = os.path.join(REPORT_CACHE_FOLDER, f".{key}.{os.getpid()}.{uuid.uuid4().hex[:8]}")
+    render_config = {k: v for k, v in config.items() if k != 'naming'}
+    model = None
+    output_folder, OUTPUT_FOLDER = OUTPUT_FOLDER, staging
+    try:
+        if config.get('consolidated'):
+            built = build_consolidated_harry_report(render_config, input_folder) is not None
+        else:
+            packets = process_raw_files(input_folder)
+            built = bool(packets)
+            if packets:
+                model = build_full_report(packets, group_type, render_config)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        OUTPUT_FOLDER = output_folder
+    
+    outputs = []
+    if built and os.path.isdir(staging):
+        outputs = sorted(name for name in os.listdir(staging) if not name.startswith('.'))
+    if not outputs:
+        shutil.rmtree(staging, ignore_errors=True)
+        return [], False
+    entry = store_report_cache_entry(staging, key, outputs, model)
+    return deliver_cached_outputs(entry, naming), False
 
 # ==============================================================================
-# 6. INTERACTIVE CLI
+# 7. INTERACTIVE CLI
 # ==============================================================================
 
 def validate_tier(tier_str):
@@ -1951,6 +4484,28 @@ def get_dynamic_group_config():
         'sub_agents': sub_agents
     }
 
+def get_export_formats():
+    """Ask which data extracts (if any) to write next to the xlsx report"""
+    print("\n📤 Data extracts for payroll/accounting systems (optional)")
+    while True:
+        answer = input(f"   Formats ({', '.join(EXPORT_FORMATS)}) separated by commas, or press Enter to skip: ").strip().lower()
+        if not answer:
+            return []
+        formats = [f.strip() for f in answer.split(',') if f.strip()]
+        invalid = [f for f in formats if f not in EXPORT_FORMATS]
+        if not invalid:
+            return formats
+        print(f"   ❌ Unknown format(s): {', '.join(invalid)}")
+
+def get_reference_workbook():
+    """Ask for an optional client reference workbook to reconcile the report against"""
+    print("\n🔍 Reconciliation against a client reference workbook (optional)")
+    while True:
+        path = input("   Reference .xlsx path, or press Enter to skip: ").strip().strip('"')
+        if not path or os.path.isfile(path):
+            return path or None
+        print(f"   ❌ File not found: {path}")
+
 def get_user_input():
     """Interactive command-line interface to get configuration"""
     print("\n" + "=" * 60)
@@ -1975,9 +4530,13 @@ def get_user_input():
             client_list = list(HARRY_DOWNLINE_RATES.keys())
             for i, client in enumerate(client_list, 1):
                 print(f"{i}. {client}")
+            print(f"0. ALL CLIENTS (one consolidated workbook from {INPUT_FOLDER}/<client> folders)")
             
             while True:
-                client_choice = input(f"\nEnter client number (1-{len(client_list)}): ").strip()
+                client_choice = input(f"\nEnter client number (0-{len(client_list)}): ").strip()
+                if client_choice == '0':
+                    print("\n✅ Selected: All clients (consolidated)")
+                    return GROUP_TYPE_HARRY, {'consolidated': True, 'group_type': GROUP_TYPE_HARRY}
                 try:
                     client_idx = int(client_choice) - 1
                     if 0 <= client_idx < len(client_list):
@@ -2048,9 +4607,10 @@ def get_user_input():
     print("\n" + "-" * 60)
     print("SUB-AGENTS (Below Main Agent)")
     print("-" * 60)
-    print("Note: Sub-agents should have LOWER tiers than the main agent")
+    print("Note: Sub-agents should have LOWER tiers than the agent they report to")
     
     sub_agents = []
+    agents_by_name = {}
     sub_agent_num = 1
     
     while True:
@@ -2062,17 +4622,32 @@ def get_user_input():
                 print("   ℹ️  No sub-agents added (Main agent only)")
             break
         
+        # Sub-agents can report to another sub-agent for deeper hierarchies
+        parent = None
+        if agents_by_name:
+            reports_to = input(f"   Reports to (Enter = {main_agent_name}): ").strip()
+            parent = agents_by_name.get(reports_to)
+            if reports_to and parent is None:
+                print(f"   ⚠️ '{reports_to}' not found, adding under {main_agent_name}")
+        parent_name = parent['name'] if parent else main_agent_name
+        parent_tier = parent['tier'] if parent else main_agent_tier
+        
         # Get sub-agent tier
         while True:
             sub_agent_tier = input(f"   Tier for {sub_agent_name} (70, 60, 50, 45, 40, 35, 30, 25, 20, 15): ").strip()
             if validate_tier(sub_agent_tier):
-                if int(sub_agent_tier) >= int(main_agent_tier):
-                    print(f"   ⚠️ Warning: Sub-agent tier ({sub_agent_tier}) should be LOWER than Main Agent tier ({main_agent_tier})")
+                if int(sub_agent_tier) >= int(parent_tier):
+                    print(f"   ⚠️ Warning: Sub-agent tier ({sub_agent_tier}) should be LOWER than {parent_name}'s tier ({parent_tier})")
                     confirm = input(f"   Continue anyway? (y/n): ").strip().lower()
                     if confirm != 'y':
                         continue
-                print(f"   ✅ Sub-agent added: {sub_agent_name} (Tier {sub_agent_tier})")
-                sub_agents.append({'name': sub_agent_name, 'tier': sub_agent_tier})
+                print(f"   ✅ Sub-agent added: {sub_agent_name} (Tier {sub_agent_tier}) under {parent_name}")
+                agent = {'name': sub_agent_name, 'tier': sub_agent_tier}
+                if parent:
+                    parent.setdefault('sub_agents', []).append(agent)
+                else:
+                    sub_agents.append(agent)
+                agents_by_name[sub_agent_name] = agent
                 break
             else:
                 print("   ❌ Invalid tier! Please choose from: 70, 60, 50, 45, 40, 35, 30, 25, 20, 15")
@@ -2101,9 +4676,12 @@ def get_user_input():
     print(f"\n👤 Main Agent: {main_agent_name} (Tier {main_agent_tier})")
     print(f"   - Earns: Tier {main_agent_tier} rates + Override from sub-agents")
     if sub_agents:
-        print(f"\n👥 Sub-Agents: {len(sub_agents)}")
-        for i, agent in enumerate(sub_agents, 1):
-            print(f"   {i}. {agent['name']} (Tier {agent['tier']}) - Earns: Tier {agent['tier']} rates only")
+        tree = flatten_agent_tree(group_config['main_agent'], sub_agents)
+        print(f"\n👥 Sub-Agents: {len(tree['names']) - 1}")
+        for idx, agent in enumerate(tree['agents'][1:], 1):
+            indent = "   " * (tree['depths'][idx] - 1)
+            earns = "rates + Override from sub-agents" if agent.get('sub_agents') else "rates only"
+            print(f"   {indent}{idx}. {agent['name']} (Tier {agent['tier']}) - Earns: Tier {agent['tier']} {earns}")
     else:
         print(f"\n👥 Sub-Agents: None (Main agent only)")
     
@@ -2115,28 +4693,324 @@ def get_user_input():
     return GROUP_TYPE_OTHER, group_config
 
 # ==============================================================================
-# 7. MAIN EXECUTION
+# 7B. HEADLESS COMMAND LINE (argparse)
 # ==============================================================================
 
-if __name__ == "__main__":
-    # Get user configuration
-    group_type, client_config = get_user_input()
+# --group values -> group types
+GROUP_CHOICES = {
+    'harry': GROUP_TYPE_HARRY,
+    'adam': GROUP_TYPE_ADAM,
+    'tier': GROUP_TYPE_OTHER,
+    'dynamic': GROUP_TYPE_DYNAMIC
+}
+
+def build_arg_parser():
+    """Command-line options; with no --group/--config the interactive wizard runs instead"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='final.py',
+        description="Commission report generator. Run without --group/--config for the interactive wizard.",
+        epilog=(
+            "examples:\n"
+            "  final.py --group harry --client CONFIDENCE --exports csv\n"
+            "  final.py --group harry --all-clients --workers 4\n"
+            "  final.py --group tier --group-name '100 Academy' --main-agent 'Agent 1:35' \\\n"
+            "           --sub-agent 'Agent 2:30' --sub-agent 'Agent 3:25:Agent 2'\n"
+            "  final.py --group dynamic --main-agent 'Alice:10' --sub-agent 'Bob:3,2,1,1'\n"
+            "  final.py --config job.json --input-dir /data/in --output-dir /data/out --queue\n"
+            "  final.py --resume"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    
+    group = parser.add_argument_group('report')
+    group.add_argument('--group', choices=list(GROUP_CHOICES), help="group type to build")
+    group.add_argument('--config', metavar='FILE',
+                       help="JSON file with the group configuration (same keys as the wizard builds, plus optional 'group')")
+    group.add_argument('--client', help="Harry's Group client (default: all clients in one report)")
+    group.add_argument('--all-clients', action='store_true',
+                       help="Harry's Group: one consolidated workbook from <input-dir>/<client> folders")
+    group.add_argument('--group-name', help="tier/dynamic group name")
+    group.add_argument('--main-agent', action='append', default=[], metavar='SPEC',
+                       help="tier: NAME:TIER (once); dynamic: NAME:PERCENT (repeatable)")
+    group.add_argument('--sub-agent', action='append', default=[], metavar='SPEC',
+                       help="tier: NAME:TIER[:REPORTS_TO]; dynamic: NAME:R1600,R1400,R1200,R1000 (repeatable)")
+    group.add_argument('--assignments', metavar='FILE', help=f"agent assignment table (default: {ASSIGNMENTS_FILE} if present)")
+    group.add_argument('--proration', choices=PRORATION_POLICIES,
+                       help="employees who missed a week: all_or_nothing (default) earns nothing, "
+                            "prorated earns on the weeks they paid")
+    
+    io_group = parser.add_argument_group('input/output')
+    io_group.add_argument('--input-dir', help=f"folder with the payroll files (default: {INPUT_FOLDER})")
+    io_group.add_argument('--output-dir', help=f"folder for the reports (default: {OUTPUT_FOLDER})")
+    io_group.add_argument('--sheets', help=f"comma-separated report sections to write ({', '.join(SHEET_SECTIONS)})")
+    io_group.add_argument('--exports', help=f"comma-separated data extracts to write ({', '.join(EXPORT_FORMATS)})")
+    io_group.add_argument('--statements', metavar='FORMATS',
+                          help=f"write one statement per agent, comma-separated ({', '.join(STATEMENT_FORMATS)})")
+    io_group.add_argument('--deduction-codes', metavar='CODES',
+                          help=f"comma-separated extra deduction codes to commission per code and in total ({', '.join(DEDUCTION_CODES)})")
+    io_group.add_argument('--reference', metavar='FILE', help="client reference workbook to reconcile against")
+    io_group.add_argument('--naming', choices=OUTPUT_NAMING_MODES,
+                          help="when the report file exists: overwrite (default), versioned (_v2, _v3...) or hashed (content hash)")
+    io_group.add_argument('--workers', type=int,
+                          help="processes for --all-clients loading and --statements (default: one per CPU)")
+    
+    run_group = parser.add_argument_group('run')
+    run_group.add_argument('--interactive', action='store_true', help="use the interactive wizard")
+    run_group.add_argument('--queue', action='store_true',
+                           help="run as a checkpointed job; a rerun resumes it or skips it once written")
+    run_group.add_argument('--resume', action='store_true', help="run every pending job in the queue and exit")
+    run_group.add_argument('--queue-db', metavar='FILE', help=f"job queue database (default: {JOB_QUEUE_FILE})")
+    run_group.add_argument('--history', nargs='?', const=COMMISSION_HISTORY_FILE, metavar='FILE',
+                           help=f"record the period's commissions and claw back what stopped paying since the last period "
+                                f"(default database: {COMMISSION_HISTORY_FILE})")
+    run_group.add_argument('--no-cache', action='store_true',
+                           help=f"always rebuild instead of reusing an unchanged report from {REPORT_CACHE_FOLDER}/")
+    run_group.add_argument('--timings', action='store_true', help="print how long each stage took")
+    run_group.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                           help="profile the run with cProfile; print the top functions and optionally save the stats")
+    return parser
+
+def split_list(value):
+    """'a, b,c' -> ['a', 'b', 'c']"""
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+def parse_tier_agents(main_specs, sub_specs):
+    """
+    --main-agent NAME:TIER and --sub-agent NAME:TIER[:REPORTS_TO] -> (main_agent, sub_agents tree)
+    
+    Raises ValueError on a malformed spec, an invalid tier or an unknown parent.
+    """
+    if len(main_specs) != 1:
+        raise ValueError("tier groups need exactly one --main-agent NAME:TIER")
+    name, _, tier = main_specs[0].rpartition(':')
+    if not name or not validate_tier(tier):
+        raise ValueError(f"invalid --main-agent '{main_specs[0]}' (expected NAME:TIER with a valid tier)")
+    main_agent = {'name': name, 'tier': tier}
+    
+    sub_agents = []
+    agents_by_name = {}
+    for spec in sub_specs:
+        parts = spec.split(':')
+        if len(parts) not in (2, 3) or not parts[0] or not validate_tier(parts[1]):
+            raise ValueError(f"invalid --sub-agent '{spec}' (expected NAME:TIER[:REPORTS_TO] with a valid tier)")
+        agent = {'name': parts[0], 'tier': parts[1]}
+        reports_to = parts[2] if len(parts) == 3 else main_agent['name']
+        parent = agents_by_name.get(reports_to)
+        if parent is None and reports_to != main_agent['name']:
+            raise ValueError(f"--sub-agent '{spec}' reports to unknown agent '{reports_to}' (list parents first)")
+        parent_tier = parent['tier'] if parent else main_agent['tier']
+        if int(agent['tier']) >= int(parent_tier):
+            print(f"⚠️ Sub-agent tier ({agent['tier']}) of {agent['name']} should be LOWER than {reports_to}'s tier ({parent_tier})")
+        if parent:
+            parent.setdefault('sub_agents', []).append(agent)
+        else:
+            sub_agents.append(agent)
+        agents_by_name[agent['name']] = agent
+    return main_agent, sub_agents
+
+def parse_dynamic_agents(main_specs, sub_specs):
+    """
+    --main-agent NAME:PERCENT and --sub-agent NAME:R1600,R1400,R1200,R1000 -> (main_agents, sub_agents)
+    
+    Raises ValueError on a malformed spec.
+    """
+    main_agents = {}
+    for spec in main_specs:
+        name, _, pct = spec.rpartition(':')
+        try:
+            main_agents[name] = float(pct)
+        except ValueError:
+            name = ''
+        if not name:
+            raise ValueError(f"invalid --main-agent '{spec}' (expected NAME:PERCENT)")
+    if not main_agents:
+        raise ValueError("dynamic groups need at least one --main-agent NAME:PERCENT")
     
-    if group_type is None:
-        exit(0)
+    sub_agents = {}
+    for spec in sub_specs:
+        name, _, rates = spec.rpartition(':')
+        try:
+            values = [float(rate) for rate in rates.split(',')]
+        except ValueError:
+            values = []
+        if not name or len(values) != 4:
+            raise ValueError(f"invalid --sub-agent '{spec}' (expected NAME:R1600,R1400,R1200,R1000)")
+        sub_agents[name] = dict(zip(['1600', '1400', '1200', '1000'], values))
+    return main_agents, sub_agents
+
+def config_from_args(args):
+    """
+    Group type and report config from parsed arguments (and the --config file)
+    
+    Raises ValueError when the options don't describe a complete report.
+    """
+    config = {}
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError(f"{args.config} must hold a JSON object")
+    
+    group_name = args.group or config.pop('group', None)
+    group_type = GROUP_CHOICES.get(group_name, group_name)
+    if group_type not in GROUP_CHOICES.values():
+        raise ValueError(f"unknown or missing group (choose from {', '.join(GROUP_CHOICES)})")
+    
+    if group_type == GROUP_TYPE_HARRY:
+        if args.client:
+            matches = [c for c in HARRY_DOWNLINE_RATES if c.lower() == args.client.lower()]
+            if not matches:
+                raise ValueError(f"unknown client '{args.client}' (choose from {', '.join(HARRY_DOWNLINE_RATES)})")
+            config['selected_client'] = matches[0]
+        if args.all_clients:
+            config['consolidated'] = True
+    elif args.client or args.all_clients:
+        raise ValueError("--client/--all-clients only apply to --group harry")
+    
+    if args.group_name:
+        config['group_name'] = args.group_name
+    if group_type == GROUP_TYPE_OTHER:
+        if args.main_agent:
+            config['main_agent'], config['sub_agents'] = parse_tier_agents(args.main_agent, args.sub_agent)
+        elif 'main_agent' not in config:
+            raise ValueError("tier groups need --main-agent NAME:TIER (or a --config file with main_agent)")
+    elif group_type == GROUP_TYPE_DYNAMIC:
+        if args.main_agent:
+            config['main_agents'], config['sub_agents'] = parse_dynamic_agents(args.main_agent, args.sub_agent)
+        elif not config.get('main_agents'):
+            raise ValueError("dynamic groups need --main-agent NAME:PERCENT (or a --config file with main_agents)")
+    elif args.main_agent or args.sub_agent:
+        raise ValueError("--main-agent/--sub-agent only apply to --group tier or dynamic")
+    
+    for key, value in (('sheets', split_list(args.sheets)), ('exports', split_list(args.exports)),
+                       ('statements', split_list(args.statements)),
+                       ('deduction_codes', [code.upper() for code in split_list(args.deduction_codes)])):
+        if value:
+            config[key] = value
+    unknown_exports = set(config.get('exports', [])) - set(EXPORT_FORMATS)
+    if unknown_exports:
+        raise ValueError(f"unknown export format(s) {', '.join(sorted(unknown_exports))} (choose from {', '.join(EXPORT_FORMATS)})")
+    unknown_statements = set(config.get('statements', [])) - set(STATEMENT_FORMATS)
+    if unknown_statements:
+        raise ValueError(f"unknown statement format(s) {', '.join(sorted(unknown_statements))} (choose from {', '.join(STATEMENT_FORMATS)})")
+    unknown_codes = set(config.get('deduction_codes', [])) - set(DEDUCTION_CODES)
+    if unknown_codes:
+        raise ValueError(f"unknown deduction code(s) {', '.join(sorted(unknown_codes))} (choose from {', '.join(DEDUCTION_CODES)})")
+    for key in ('reference', 'assignments', 'workers', 'naming', 'proration', 'history'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    proration_policy(config)
+    
+    config['group_type'] = group_type
+    return group_type, config
+
+def run_report(group_type, client_config, show_timings=False, use_cache=True):
+    """
+    Process the input files and build the configured report; True when a report was written
     
-    # Process files
+    With use_cache, unchanged inputs/config reuse the stored report (see run_cached_report).
+    Runs that record a commission history always rebuild, since clawbacks depend on it.
+    """
     print("\n" + "=" * 60)
     print("PROCESSING FILES")
     print("=" * 60)
     
-    packets = process_raw_files()
-    
-    if packets:
-        build_full_report(packets, group_type, client_config)
+    start = time.perf_counter()
+    if use_cache and not client_config.get('history'):
+        written, cache_hit = run_cached_report(group_type, client_config)
+        report_built = bool(written)
+        if cache_hit:
+            print("\n♻️ Input files, configuration and rates are unchanged; reusing the cached report")
+        if written:
+            print(f"\n💾 Saved to {OUTPUT_FOLDER}:")
+            for path in written:
+                print(f"   • {os.path.basename(path)}")
+        if show_timings:
+            print(f"\n⏱️ {'Cached report' if cache_hit else 'Processing + building report'}: {time.perf_counter() - start:.2f}s")
+    elif client_config.get('consolidated'):
+        report_built = build_consolidated_harry_report(client_config) is not None
+        if show_timings:
+            print(f"\n⏱️ Consolidated report: {time.perf_counter() - start:.2f}s")
+    else:
+        packets = process_raw_files()
+        processed = time.perf_counter()
+        report_built = bool(packets)
+        if packets:
+            build_full_report(packets, group_type, client_config)
+        if show_timings:
+            print(f"\n⏱️ Processing files: {processed - start:.2f}s")
+            print(f"⏱️ Building report: {time.perf_counter() - processed:.2f}s")
+    
+    if report_built:
         print("\n" + "=" * 60)
         print("✅ REPORT GENERATION COMPLETE!")
         print("=" * 60)
-        print(f"\n📁 Check the Output folder for your report.")
+        print(f"\n📁 Check the {OUTPUT_FOLDER} folder for your report.")
+    else:
+        print(f"\n❌ No files to process. Please add files to {INPUT_FOLDER} folder.")
+    return report_built
+
+def main(argv=None):
+    """Entry point: headless when --group/--config is given, otherwise the interactive wizard"""
+    global INPUT_FOLDER, OUTPUT_FOLDER
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    
+    if args.input_dir:
+        INPUT_FOLDER = args.input_dir
+    if args.output_dir:
+        OUTPUT_FOLDER = args.output_dir
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    
+    if args.resume:
+        conn = open_job_queue(args.queue_db)
+        statuses = run_job_queue(conn, wait=False)
+        print_job_summary(conn)
+        return 0 if all(status == 'done' for status in statuses.values()) else 1
+    
+    if args.interactive or not (args.group or args.config):
+        prepare_folders()
+        group_type, client_config = get_user_input()
+        if group_type is None:
+            return 0
+        client_config['exports'] = get_export_formats()
+        if not client_config.get('consolidated'):
+            client_config['reference'] = get_reference_workbook()
     else:
-        print("\n❌ No files to process. Please add files to Input_Raw folder.")
+        try:
+            group_type, client_config = config_from_args(args)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        prepare_folders()
+    
+    if args.queue:
+        conn = open_job_queue(args.queue_db)
+        job_id = enqueue_report_job(conn, group_type, client_config)
+        statuses = run_job_queue(conn, [job_id], wait=False)
+        print_job_summary(conn, [job_id])
+        return 0 if statuses.get(job_id) == 'done' else 1
+    
+    if args.profile is None:
+        return 0 if run_report(group_type, client_config, args.timings, not args.no_cache) else 1
+    
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    report_built = profiler.runcall(run_report, group_type, client_config, args.timings, not args.no_cache)
+    print("\n" + "=" * 60)
+    print("PROFILE (top 25 by cumulative time)")
+    print("=" * 60)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if args.profile:
+        profiler.dump_stats(args.profile)
+        print(f"💾 Profile stats saved: {args.profile}")
+    return 0 if report_built else 1
+
+# ==============================================================================
+# 8. MAIN EXECUTION
+# ==============================================================================
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""
+Golden-output regression harness for final.py
+
+Runs every group type over the bundled example data (plus a synthetic next
+month for the commission history runs), snapshots the generated workbooks
+(cell values and formula text) and the in-memory commission model (the values
+those formulas evaluate to), and compares both against the golden snapshots
+stored in golden/. Build timings are recorded next to the snapshots.
+
+    python regression.py             # compare against golden/
+    python regression.py --update    # rewrite golden/ after an intended change
+    python regression.py --repeat 3  # best-of-3 timings
+    python regression.py --startup   # only the cold-start checks
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import openpyxl
+
+import final
+
+# ==============================================================================
+# CONFIGURATION
+# ==============================================================================
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(PROJECT_DIR, 'golden')
+
+# Dataset name -> folder of raw payroll confirmation reports
+DATASETS = {
+    'input_raw': os.path.join(PROJECT_DIR, 'Input_Raw'),
+    'example_1': os.path.join(PROJECT_DIR, '..', 'more example data', 'example 1'),
+    'example_2': os.path.join(PROJECT_DIR, '..', 'more example data', 'example 2'),
+    'example_3': os.path.join(PROJECT_DIR, '..', 'more example data', 'example 3'),
+}
+
+# Agent tree of the tier runs
+TIER_GROUP = {
+    'group_name': 'Regression Tier',
+    'main_agent': {'name': 'Agent 1', 'tier': '50'},
+    'sub_agents': [
+        {'name': 'Agent 2', 'tier': '35', 'sub_agents': [{'name': 'Agent 4', 'tier': '20'}]},
+        {'name': 'Agent 3', 'tier': '25'}
+    ]
+}
+
+# Run name -> (group type, config) - one run per builder path, plus the optional money paths
+RUNS = {
+    'harry_all_clients': (final.GROUP_TYPE_HARRY, {}),
+    'harry_confidence': (final.GROUP_TYPE_HARRY, {'selected_client': 'CONFIDENCE'}),
+    'adam': (final.GROUP_TYPE_ADAM, {}),
+    'dynamic': (final.GROUP_TYPE_DYNAMIC, {
+        'group_name': 'Regression Dynamic',
+        'main_agents': {'Agent A': 10, 'Agent B': 5},
+        'sub_agents': {'Agent S': {'1600': 3, '1400': 2, '1200': 1, '1000': 1}}
+    }),
+    'tier': (final.GROUP_TYPE_OTHER, TIER_GROUP),
+    'harry_prorated': (final.GROUP_TYPE_HARRY, {'proration': 'prorated'}),
+    'tier_prorated': (final.GROUP_TYPE_OTHER, dict(TIER_GROUP, proration='prorated')),
+    'harry_deduction_codes': (final.GROUP_TYPE_HARRY, {'deduction_codes': ['PPCREWARD']}),
+    'harry_statements': (final.GROUP_TYPE_HARRY, {'statements': ['xlsx']}),
+    'tier_statements': (final.GROUP_TYPE_OTHER, dict(TIER_GROUP, statements=['xlsx'])),
+}
+
+# Run name -> (group type, config) built over two periods with a commission history:
+# the dataset, then a copy shifted into the next month (see next_period_packets)
+HISTORY_RUNS = {
+    'harry_history': (final.GROUP_TYPE_HARRY, {}),
+    'tier_history': (final.GROUP_TYPE_OTHER, TIER_GROUP),
+    'harry_history_prorated': (final.GROUP_TYPE_HARRY, {'proration': 'prorated'}),
+    'tier_history_prorated': (final.GROUP_TYPE_OTHER, dict(TIER_GROUP, proration='prorated')),
+}
+
+# Days the second history period is shifted by (lands in the next month)
+NEXT_PERIOD_DAYS = 35
+
+# Libraries final.py must not load at import time (they load when a stage needs them)
+LAZY_MODULES = ['pandas', 'numpy', 'xlsxwriter', 'openpyxl', 'multiprocessing']
+
+# Floats are compared after rounding to this many decimals
+FLOAT_DECIMALS = 9
+
+# Differences printed per run before the rest are only counted
+MAX_DIFFS_SHOWN = 10
+
+# ==============================================================================
+# SNAPSHOTS
+# ==============================================================================
+
+def normalize_value(value):
+    """JSON-safe, rounding-stable form of a cell or model value"""
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return None if value != value else value.isoformat()  # NaT
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float):
+        return None if math.isnan(value) else round(value, FLOAT_DECIMALS) + 0.0
+    if isinstance(value, int):
+        return value
+    return str(value)
+
+def snapshot_workbook(path):
+    """{sheet: {cell: value or formula text}} for every non-empty cell"""
+    workbook = openpyxl.load_workbook(path)
+    try:
+        return {
+            ws.title: {
+                cell.coordinate: normalize_value(getattr(cell.value, 'text', cell.value))
+                for row in ws.iter_rows() for cell in row if cell.value is not None
+            }
+            for ws in workbook.worksheets
+        }
+    finally:
+        workbook.close()
+
+def snapshot_workbooks(folder):
+    """{file name: workbook snapshot} of every xlsx written to a folder"""
+    return {
+        name: snapshot_workbook(os.path.join(folder, name))
+        for name in sorted(os.listdir(folder)) if name.endswith('.xlsx')
+    }
+
+def snapshot_model(model):
+    """{table: [row records]} of the commission model"""
+    return {
+        name: [{col: normalize_value(v) for col, v in record.items()} for record in df.to_dict('records')]
+        for name, df in model['tables'].items()
+    }
+
+def copy_raw_reports(source, target):
+    """Copy the payroll reports of a dataset, leaving out client reference workbooks"""
+    for name in sorted(os.listdir(source)):
+        path = os.path.join(source, name)
+        if not name.endswith(('.csv', '.xlsx', '.xls')) or name.startswith('~$'):
+            continue
+        if name.endswith('.xlsx'):
+            workbook = openpyxl.load_workbook(path, read_only=True)
+            is_reference = 'Commissions' in workbook.sheetnames
+            workbook.close()
+            if is_reference:
+                continue
+        shutil.copy(path, target)
+
+def next_period_packets(packets):
+    """
+    The packets shifted into the next month, where the first employee paid in
+    the most weeks (perfect ones first) has their first deduction reversed but
+    keeps paying afterwards, and the second one stops paying in the last week
+    """
+    matrix = final.build_payment_matrix(packets)
+    most_paid = (-matrix['paid'].sum(axis=1)).argsort(kind='stable')
+    reversed_ssn, lapsed_ssn = matrix['ssns'][most_paid[:2]]
+    
+    shifted = []
+    for week_idx, packet in enumerate(packets):
+        df = packet['df'].copy()
+        ssns = packet['ssn_table'][packet['ssn_keys']]
+        col = df.columns.get_loc(packet['ded_col'])
+        if week_idx == 0:
+            df.iloc[ssns == reversed_ssn, col] *= -1
+        if week_idx == len(packets) - 1:
+            df.iloc[ssns == lapsed_ssn, col] = 0
+        shifted.append(dict(packet, df=df, date=packet['date'] + datetime.timedelta(days=NEXT_PERIOD_DAYS)))
+    return shifted
+
+def run_dataset(source, repeat=1):
+    """
+    Build every RUNS report for one dataset in a scratch folder
+
+    Returns: ({'runs': {run: {'workbooks': ..., 'model': ...}}}, {step: best seconds})
+    """
+    snapshot = {'runs': {}}
+    timings = {}
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_folder = os.path.join(work_dir, 'Input_Raw')
+        output_folder = os.path.join(work_dir, 'Output')
+        os.makedirs(input_folder)
+        copy_raw_reports(source, input_folder)
+
+        # Scratch cwd so a local Agent_Assignments.csv can't leak into the run
+        os.chdir(work_dir)
+        final.INPUT_FOLDER, final.OUTPUT_FOLDER = input_folder, output_folder
+        try:
+            for attempt in range(repeat):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    packets = final.process_raw_files(input_folder)
+                    elapsed = time.perf_counter() - start
+                timings['process_raw_files'] = min(elapsed, timings.get('process_raw_files', elapsed))
+
+            for run_name, (group_type, config) in RUNS.items():
+                for attempt in range(repeat):
+                    shutil.rmtree(output_folder, ignore_errors=True)
+                    os.makedirs(output_folder)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        start = time.perf_counter()
+                        final.build_full_report(packets, group_type, dict(config))
+                        elapsed = time.perf_counter() - start
+                    timings[run_name] = min(elapsed, timings.get(run_name, elapsed))
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    model = final.build_commission_model(packets, group_type, dict(config))
+                snapshot['runs'][run_name] = {
+                    'workbooks': snapshot_workbooks(output_folder),
+                    'model': snapshot_model(model)
+                }
+            
+            # Second period only: its ledger, clawbacks and Clawbacks sheet
+            next_packets = next_period_packets(packets)
+            for run_name, (group_type, config) in HISTORY_RUNS.items():
+                history_config = dict(config, history=os.path.join(work_dir, f"{run_name}.sqlite"))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    final.build_full_report(packets, group_type, dict(history_config))
+                for attempt in range(repeat):
+                    shutil.rmtree(output_folder, ignore_errors=True)
+                    os.makedirs(output_folder)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        start = time.perf_counter()
+                        model = final.build_full_report(next_packets, group_type, dict(history_config))
+                        elapsed = time.perf_counter() - start
+                    timings[run_name] = min(elapsed, timings.get(run_name, elapsed))
+                
+                snapshot['runs'][run_name] = {
+                    'workbooks': snapshot_workbooks(output_folder),
+                    'model': snapshot_model(model)
+                }
+        finally:
+            os.chdir(cwd)
+
+    return snapshot, timings
+
+def run_startup(repeat=1):
+    """
+    Time a cold `import final` and a cold CLI start up to its first prompt
+    (stdin is closed, so the script stops at that prompt), each in a fresh
+    interpreter inside an empty folder
+    
+    Returns: ({step: best seconds}, [heavy modules loaded by the import])
+    """
+    timings = {}
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    check = f"import sys, final; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    steps = {
+        'import_final': [sys.executable, '-c', check],
+        'cold_start_to_prompt': [sys.executable, os.path.join(PROJECT_DIR, 'final.py')]
+    }
+    loaded = []
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        for step, command in steps.items():
+            for attempt in range(repeat):
+                start = time.perf_counter()
+                result = subprocess.run(command, cwd=work_dir, env=env, stdin=subprocess.DEVNULL,
+                                        capture_output=True, text=True)
+                elapsed = time.perf_counter() - start
+                timings[step] = min(elapsed, timings.get(step, elapsed))
+            if step == 'import_final':
+                loaded = [m for m in result.stdout.strip().split(',') if m]
+    
+    return timings, loaded
+
+# ==============================================================================
+# COMPARISON
+# ==============================================================================
+
+def flatten(tree, prefix=()):
+    """{path tuple: leaf} of a nested dict/list snapshot"""
+    if isinstance(tree, dict):
+        items = tree.items()
+    elif isinstance(tree, list):
+        items = enumerate(tree)
+    else:
+        return {prefix: tree}
+    flat = {}
+    for key, value in items:
+        flat.update(flatten(value, prefix + (str(key),)))
+    return flat
+
+def compare_snapshots(golden, actual):
+    """Differences as [(path, golden value, actual value)], '<missing>' for absent paths"""
+    golden_flat, actual_flat = flatten(golden), flatten(actual)
+    diffs = []
+    for path in sorted(golden_flat.keys() | actual_flat.keys()):
+        expected = golden_flat.get(path, '<missing>')
+        found = actual_flat.get(path, '<missing>')
+        if expected != found:
+            diffs.append((path, expected, found))
+    return diffs
+
+def golden_path(dataset):
+    return os.path.join(GOLDEN_DIR, f"{dataset}.json")
+
+def load_golden(dataset):
+    path = golden_path(dataset)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_golden(dataset, snapshot, timings):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with open(golden_path(dataset), 'w', encoding='utf-8') as f:
+        json.dump(dict(snapshot, timings=timings), f, indent=1, sort_keys=True, ensure_ascii=False)
+        f.write('\n')
+
+def print_timings(timings, golden_timings):
+    for step, seconds in timings.items():
+        before = golden_timings.get(step)
+        change = f"  (golden {before:.3f}s, x{before / seconds:.2f})" if before and seconds else ""
+        print(f"   ⏱️ {step:<20} {seconds:.3f}s{change}")
+
+# ==============================================================================
+# MAIN
+# ==============================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare final.py reports against golden outputs")
+    parser.add_argument('--update', action='store_true', help="rewrite the golden snapshots")
+    parser.add_argument('--dataset', action='append', choices=list(DATASETS),
+                        help="limit to one dataset (repeatable)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per step; the fastest time is kept")
+    parser.add_argument('--startup', action='store_true', help="only run the cold-start checks")
+    args = parser.parse_args(argv)
+    repeat = max(args.repeat, 1)
+
+    failed = []
+    print("\n🚀 startup")
+    timings, loaded = run_startup(repeat)
+    golden = load_golden('startup')
+    print_timings(timings, (golden or {}).get('timings', {}))
+    if args.update:
+        save_golden('startup', {}, timings)
+    if loaded:
+        print(f"   ❌ Loaded at import time: {', '.join(loaded)}")
+        failed.append('startup')
+    else:
+        print("   ✅ No heavy libraries loaded at import time")
+
+    for dataset in [] if args.startup else args.dataset or list(DATASETS):
+        print(f"\n📂 {dataset}")
+        snapshot, timings = run_dataset(DATASETS[dataset], repeat)
+        golden = load_golden(dataset)
+        print_timings(timings, (golden or {}).get('timings', {}))
+
+        if args.update:
+            save_golden(dataset, snapshot, timings)
+            print(f"   💾 Golden output written: {os.path.relpath(golden_path(dataset), PROJECT_DIR)}")
+            continue
+        if golden is None:
+            print("   ❌ No golden output (run with --update first)")
+            failed.append(dataset)
+            continue
+
+        golden.pop('timings', None)
+        diffs = compare_snapshots(golden, snapshot)
+        if not diffs:
+            print("   ✅ Matches golden output")
+            continue
+
+        failed.append(dataset)
+        print(f"   ❌ {len(diffs)} difference(s)")
+        for path, expected, found in diffs[:MAX_DIFFS_SHOWN]:
+            print(f"      • {' / '.join(path)}: golden={expected!r} actual={found!r}")
+        if len(diffs) > MAX_DIFFS_SHOWN:
+            print(f"      … {len(diffs) - MAX_DIFFS_SHOWN} more")
+
+    if failed:
+        print(f"\n❌ Regression check failed: {', '.join(failed)}")
+        return 1
+    print("\n✅ Regression check passed")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())